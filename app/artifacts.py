@@ -0,0 +1,151 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+from functools import lru_cache
+
+from config import get_environment
+from store import get_store
+from boilerplate import normalize
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# Bump when the artifact layout or the way sentences are found changes.  Old artifacts are then rebuilt.
+ARTIFACT_VERSION = 2
+
+
+@lru_cache(maxsize=None)
+def sentence_detector():
+    """
+    nltk punkt sentence trainer, loaded once per process from NLTK_DATA.  Nothing is downloaded at run time, the
+    Docker image gets punkt when it is built.
+    """
+    import nltk
+    if ev.nltk_data not in nltk.data.path:
+        nltk.data.path.insert(0, ev.nltk_data)
+    try:
+        return nltk.data.load('tokenizers/punkt/english.pickle')
+    except LookupError:
+        raise LookupError(f'punkt is missing.  Install it with: python -m nltk.downloader -d {ev.nltk_data} punkt')\
+            from None
+
+
+def stable_hash(text: str):
+    """ 64 bit hash that is the same in every process and every run, unlike hash() """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def fingerprint(text: str):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def artifact_name(file_name: str):
+    return os.path.splitext(file_name)[0] + '.sent'
+
+
+class SentenceArtifact:
+    """
+    Everything create_diff needs to know about a cleaned filing besides its text.
+
+    line_hashes   stable hash of every line
+    sentences     (start, end, first line, last line, hash, normalized hash) of every punkt sentence.  start and
+                  end are offsets into the lines joined with a space, the same string create_diff used to tokenize.
+                  The normalized hash is what the boilerplate dictionary is keyed by.
+    """
+    __slots__ = ('fingerprint', 'line_hashes', 'sentences')
+
+    def __init__(self, fingerprint, line_hashes, sentences):
+        self.fingerprint = fingerprint
+        self.line_hashes = line_hashes
+        self.sentences = sentences
+
+    @classmethod
+    def build(cls, text: str):
+        lines = text.splitlines()
+        line_starts = list()
+        offset = 0
+        for line in lines:
+            line_starts.append(offset)
+            offset += len(line) + 1
+
+        joined = ' '.join(lines)
+        sentences = list()
+        line = 0
+        for start, end in sentence_detector().span_tokenize(joined):
+            while line + 1 < len(line_starts) and line_starts[line + 1] <= start:
+                line += 1
+            last_line = line
+            while last_line + 1 < len(line_starts) and line_starts[last_line + 1] < end:
+                last_line += 1
+            sentence = joined[start:end]
+            sentences.append((start, end, line, last_line, stable_hash(sentence), stable_hash(normalize(sentence))))
+        return cls(fingerprint(text), [stable_hash(line) for line in lines], sentences)
+
+    def dump(self):
+        return zlib.compress(json.dumps({
+            'version': ARTIFACT_VERSION,
+            'fingerprint': self.fingerprint,
+            'line_hashes': self.line_hashes,
+            'sentences': self.sentences
+        }, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def load(cls, content: bytes):
+        data = json.loads(zlib.decompress(content).decode('utf-8'))
+        if data.get('version') != ARTIFACT_VERSION:
+            return None
+        return cls(data['fingerprint'], data['line_hashes'], [tuple(sentence) for sentence in data['sentences']])
+
+    def unique_sentences(self, text: str, other, boilerplate=frozenset()):
+        """
+        Sentences of text that are not already in the other filing.  A sentence is dropped when the other filing
+        has the exact same sentence or every line it spans, or when it is boilerplate, i.e. its normalized hash is
+        in the boilerplate dictionary.  Set lookups over hashes, no tokenizing.
+        """
+        other_lines = set(other.line_hashes)
+        other_sentences = set(sentence[4] for sentence in other.sentences)
+        joined = ' '.join(text.splitlines())
+
+        sentences = list()
+        hits = 0
+        for start, end, first_line, last_line, sentence_hash, normalized_hash in self.sentences:
+            if sentence_hash in other_sentences:
+                continue
+            if normalized_hash in boilerplate:
+                hits += 1
+                continue
+            if all(self.line_hashes[line] in other_lines for line in range(first_line, last_line + 1)):
+                continue
+            sentences.append(joined[start:end])
+        metrics.count('sentences', 'boilerplate', len(self.sentences))
+        metrics.count('hits', 'boilerplate', hits)
+        return sentences
+
+
+def write_artifact(file_name: str, text: str):
+    """ Build and save the sidecar artifact of a cleaned filing """
+    artifact = SentenceArtifact.build(text)
+    # dump() is compressed already
+    get_store().put(artifact_name(file_name), artifact.dump(), level=0)
+    return artifact
+
+
+def load_artifact(file_name: str, text: str, content=None):
+    """
+    The artifact of a cleaned filing.  Rebuilt when it is missing, from an older version or its fingerprint
+    does not match the text, so a rerun only recomputes filings that changed.  content is the stored artifact
+    when the caller already read it from the store.
+    """
+    try:
+        if content is None:
+            content = get_store().get(artifact_name(file_name))
+        artifact = SentenceArtifact.load(content) if content else None
+        if artifact and artifact.fingerprint == fingerprint(text):
+            return artifact
+    except (ValueError, zlib.error):
+        pass
+    logger.debug(f'Rebuilding sentence artifact for {file_name}.')
+    return write_artifact(file_name, text)
@@ -0,0 +1,961 @@
+"""
+Offline benchmarks for the download, clean and diff code.
+
+Everything runs against a corpus on disk: master.zip files, filing index pages, 10-Q HTML and iXBRL documents,
+the SEC ticker file and daily price bars.  The end to end run starts main.py against a local stand-in for
+www.sec.gov (see edgar_standin.py) that can add latency and answer with 429s, so no run ever touches the SEC
+or Yahoo.
+
+    python benchmark.py                      # run everything and compare against the baseline
+    python benchmark.py --save-baseline      # run everything and make the results the new baseline
+    python benchmark.py --only micro         # skip the end to end run
+    python benchmark.py --only startup       # just the import time of main and pipeline
+    python benchmark.py --only watch         # watch mode against the stand-in's latest filings feed
+    python benchmark.py --record 320193 789019 --year 2020    # record a real corpus from the SEC
+
+Without --corpus a synthetic corpus is generated once into output/benchmark/corpus.  It is seeded, so every
+machine benchmarks the same bytes.  Results are compared by median seconds per benchmark.  Anything slower
+than the baseline by more than --threshold, or producing a different number of rows or differences, fails the
+run with exit code 1.
+
+App modules are imported only after the environment is pointed at a scratch folder, since every module reads
+its config when it is imported.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import html
+import random
+import shutil
+import zipfile
+import asyncio
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import date, timedelta
+
+from edgar_standin import StandIn
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+BENCHMARK_FOLDER = os.path.join(DIR_PATH, 'output', 'benchmark')
+CORPUS_VERSION = 2
+YEAR = 2020
+FILING_DAYS = {'QTR1': (2, 10), 'QTR2': (5, 11), 'QTR3': (8, 10), 'QTR4': (11, 9)}
+
+SENTENCE_TEMPLATES = [
+    'Revenue increased {p}% to ${m} million for the three months ended {d} compared to the same period last year.',
+    'Net income for the quarter was ${m} million, or ${c} per diluted share.',
+    'Operating expenses increased by ${m} million primarily due to higher personnel costs.',
+    'Cash and cash equivalents totaled ${m} million as of {d}.',
+    'We repurchased {n} shares of our common stock for an aggregate of ${m} million during the quarter.',
+    'Gross margin decreased to {p}% as a result of changes in product mix and supply chain costs.',
+    'The Company had ${m} million of outstanding borrowings under its revolving credit facility.',
+    'Research and development expenses were ${m} million, an increase of {p}% year over year.',
+    'We recorded an impairment charge of ${m} million related to goodwill in the {s} segment.',
+    'Our effective tax rate for the period was {p}% compared to {q}% in the prior year period.',
+    'The pandemic continues to affect demand for our products in the {s} segment.',
+    'Management believes existing cash will be sufficient to fund operations for at least the next twelve months.',
+    'The Company adopted the new lease accounting standard on a modified retrospective basis.',
+    'Sales in the {s} segment decreased {p}% due to lower volumes and unfavorable foreign exchange.',
+    'We entered into an agreement to acquire {s} Holdings for approximately ${m} million in cash.',
+    'Depreciation and amortization expense was ${m} million for the period.',
+    'Inventories increased ${m} million reflecting higher raw material costs.',
+    'Capital expenditures were ${m} million and are expected to be approximately ${n} million for the year.',
+    'There were no material changes to the risk factors disclosed in our annual report on Form 10-K.',
+    'The Company is subject to various legal proceedings arising in the ordinary course of business.',
+    'Interest expense increased to ${m} million due to the issuance of senior notes in {d}.',
+    'Deferred revenue was ${m} million, of which {p}% is expected to be recognized within twelve months.',
+    'We paid quarterly dividends of ${c} per share totaling ${m} million.',
+    'Customer {s} accounted for {p}% of total revenue during the quarter.',
+    'Restructuring charges of ${m} million consisted primarily of severance and facility exit costs.',
+    'Foreign currency translation adjustments reduced comprehensive income by ${m} million.',
+    'The fair value of our long-term debt was approximately ${m} million as of {d}.',
+    'Stock-based compensation expense was ${m} million for the three months ended {d}.',
+]
+SEGMENTS = ['Industrial', 'Consumer', 'Healthcare', 'Energy', 'Software', 'Services', 'Aerospace', 'Retail']
+MONTHS = ['March 31, 2020', 'June 30, 2020', 'September 30, 2020', 'December 31, 2019']
+TABLE_ROWS = ['Revenue', 'Cost of revenue', 'Gross profit', 'Research and development', 'Selling, general and '
+              'administrative', 'Operating income', 'Interest expense', 'Income before taxes', 'Provision for taxes',
+              'Net income', 'Basic earnings per share', 'Diluted earnings per share']
+NOISE_FORMS = ['8-K', '10-K', '4', '10-Q/A', 'SC 13G', 'S-1', 'DEF 14A', '3']
+
+# Only the stages that use them may load these.  Starting the app must not.
+HEAVY_MODULES = ('bs4', 'lxml', 'nltk', 'fuzzywuzzy', 'aiohttp', 'yfinance', 'pandas', 'numpy')
+STARTUP_PROBE = '''
+import sys, json, time
+started = time.perf_counter()
+import main, pipeline
+seconds = time.perf_counter() - started
+print(json.dumps({'seconds': seconds, 'heavy': sorted(set(name.split('.')[0] for name in sys.modules) & set(%r))}))
+'''
+
+
+def render(rng: random.Random, template: int):
+    return SENTENCE_TEMPLATES[template].format(
+        p=rng.randint(1, 60), q=rng.randint(1, 60), m=f'{rng.uniform(1, 900):.1f}', c=f'{rng.uniform(0.1, 9):.2f}',
+        n=f'{rng.randint(1000, 900000):,}', d=rng.choice(MONTHS), s=rng.choice(SEGMENTS))
+
+
+def next_quarter_sentences(rng: random.Random, sentences):
+    """ Most of a 10-Q is the same as last quarter.  Some numbers move, a few sentences come and go. """
+    evolved = list()
+    for template, text in sentences:
+        roll = rng.random()
+        if roll < 0.04:
+            continue
+        if roll < 0.15:
+            text = render(rng, template)
+        evolved.append((template, text))
+    for _ in range(max(1, len(sentences) // 20)):
+        template = rng.randrange(len(SENTENCE_TEMPLATES))
+        evolved.insert(rng.randrange(len(evolved) + 1), (template, render(rng, template)))
+    return evolved
+
+
+def number(rng: random.Random, ixbrl: bool, name: str):
+    value = f'{rng.randint(100, 99999):,}'
+    if ixbrl:
+        return (f'<ix:nonFraction name="us-gaap:{name.replace(" ", "")}" contextRef="c1" unitRef="usd" '
+                f'decimals="-3" scale="3">{value}</ix:nonFraction>')
+    return value
+
+
+def filing_html(rng: random.Random, company: str, quarter: str, sentences, ixbrl: bool):
+    parts = list()
+    if ixbrl:
+        parts.append('<html xmlns="http://www.w3.org/1999/xhtml" xmlns:ix="http://www.xbrl.org/2013/inlineXBRL">'
+                     '<head><title>10-Q</title></head><body><div style="display:none"><ix:header><ix:hidden>'
+                     '<ix:nonNumeric name="dei:DocumentType" contextRef="c1">10-Q</ix:nonNumeric></ix:hidden>'
+                     '<ix:resources></ix:resources></ix:header></div>')
+    else:
+        parts.append('<html><head><title>10-Q</title></head><body>')
+    parts.append(f'<div style="text-align:center"><font size="4"><b>UNITED STATES SECURITIES AND EXCHANGE COMMISSION'
+                 f'</b></font><br/><b>FORM 10-Q</b><br/><span>{company}</span><br/><span>{quarter} {YEAR}</span>'
+                 f'</div><hr style="page-break-after:always"/>')
+
+    for position in range(0, len(sentences), 6):
+        if position % 48 == 0:
+            parts.append('<table cellpadding="0" cellspacing="0" style="width:100%">')
+            for row_number, row in enumerate(TABLE_ROWS):
+                background = ' style="background-color:#CCEEFF"' if row_number % 2 == 0 else ''
+                parts.append(f'<tr{background}><td><font size="2">{row}</font></td><td>$</td>'
+                             f'<td style="text-align:right">{number(rng, ixbrl, row)}</td><td>$</td>'
+                             f'<td style="text-align:right">{number(rng, ixbrl, row)}</td></tr>')
+            parts.append('</table>')
+        paragraph = ' '.join(f'<span style="font-family:Times New Roman">{text}</span>'
+                             for _, text in sentences[position:position + 6])
+        parts.append(f'<p style="margin:0pt"><font size="2">{paragraph}</font></p><div>&#160;</div>')
+        if position % 60 == 0:
+            parts.append(f'<div style="text-align:center"><font size="2">{position // 60 + 1}</font></div>'
+                         '<hr style="page-break-after:always"/>')
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def index_html(cik: int, company: str, accepted: str, document_href: str):
+    return f'''<html><head><title>EDGAR Filing Documents</title></head><body>
+<div id="formDiv"><div class="formGrouping">
+<div class="infoHead">Filing Date</div><div class="info">{accepted[:10]}</div>
+<div class="infoHead">Accepted</div><div class="info">{accepted}</div>
+</div></div>
+<div id="filerDiv"><span class="companyName">{company} (Filer) CIK: {cik:010d}</span></div>
+<table class="tableFile" summary="Document Format Files">
+<tr><th scope="col">Seq</th><th scope="col">Description</th><th scope="col">Document</th><th scope="col">Type</th>
+<th scope="col">Size</th></tr>
+<tr><td scope="row">1</td><td scope="row">10-Q</td><td scope="row"><a href="{document_href}">doc.htm</a></td>
+<td scope="row">10-Q</td><td scope="row">1</td></tr>
+<tr class="blueRow"><td scope="row">2</td><td scope="row">EX-31.1</td><td scope="row">
+<a href="/Archives/edgar/data/{cik}/ex31.htm">ex31.htm</a></td><td scope="row">EX-31.1</td><td scope="row">1</td></tr>
+</table></body></html>'''
+
+
+def submission_txt(rng: random.Random, cik: int, company: str, accession: str, accepted: str, document_name: str,
+                   document: str, ixbrl: bool):
+    """
+    The complete submission .txt: SGML header, the 10-Q, an exhibit and an XBRL instance bigger than the 10-Q,
+    which a reader that stops after the 10-Q never downloads.
+    """
+    compact = accepted.replace('-', '').replace(':', '').replace(' ', '')
+    facts = list()
+    for context in range(len(document) // 200):
+        for row in TABLE_ROWS[:2]:
+            name = row.replace(' ', '').replace(',', '')
+            facts.append(f'<us-gaap:{name} contextRef="c{context}" unitRef="usd" decimals="-3">'
+                         f'{rng.randint(100, 99999) * 1000}</us-gaap:{name}>')
+    facts = '\n'.join(facts)
+    wrapped = f'<XBRL>\n{document}\n</XBRL>' if ixbrl else document
+    return f'''<SEC-DOCUMENT>{accession}.txt : {compact[:8]}
+<SEC-HEADER>{accession}.hdr.sgml : {compact[:8]}
+<ACCEPTANCE-DATETIME>{compact}
+ACCESSION NUMBER:\t\t{accession}
+CONFORMED SUBMISSION TYPE:\t10-Q
+PUBLIC DOCUMENT COUNT:\t\t3
+FILED AS OF DATE:\t\t{compact[:8]}
+
+FILER:
+\tCOMPANY DATA:
+\t\tCOMPANY CONFORMED NAME:\t\t\t{company}
+\t\tCENTRAL INDEX KEY:\t\t\t{cik:010d}
+</SEC-HEADER>
+<DOCUMENT>
+<TYPE>10-Q
+<SEQUENCE>1
+<FILENAME>{document_name}
+<DESCRIPTION>10-Q
+<TEXT>
+{wrapped}
+</TEXT>
+</DOCUMENT>
+<DOCUMENT>
+<TYPE>EX-31.1
+<SEQUENCE>2
+<FILENAME>ex31.htm
+<DESCRIPTION>EX-31.1
+<TEXT>
+<html><body><p>I, the Chief Executive Officer of {company}, certify that I have reviewed this report.</p></body></html>
+</TEXT>
+</DOCUMENT>
+<DOCUMENT>
+<TYPE>EX-101.INS
+<SEQUENCE>3
+<FILENAME>{document_name.replace('.htm', '.xml')}
+<DESCRIPTION>XBRL INSTANCE DOCUMENT
+<TEXT>
+<XBRL>
+<?xml version="1.0" encoding="utf-8"?>
+<xbrl xmlns="http://www.xbrl.org/2003/instance">
+{facts}
+</xbrl>
+</XBRL>
+</TEXT>
+</DOCUMENT>
+</SEC-DOCUMENT>
+'''
+
+
+def write_file(path: str, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as corpus_file:
+        corpus_file.write(content.encode('utf-8') if isinstance(content, str) else content)
+
+
+def master_zip(quarter: str, lines):
+    header = (f'Description:           Master Index of EDGAR Dissemination Feed\n'
+              f'Last Data Received:    {quarter} {YEAR}\n'
+              f'Comments:              webmaster@sec.gov\n'
+              f'Anonymous FTP:         ftp://ftp.sec.gov/edgar/\n\n\n\n'
+              f'CIK|Company Name|Form Type|Date Filed|Filename\n'
+              f'{"-" * 80}\n')
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # Fixed timestamp, so the same lines always give the same bytes
+        info = zipfile.ZipInfo('master.idx', date_time=(YEAR, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zip_file.writestr(info, header + '\n'.join(lines) + '\n')
+    return content.getvalue()
+
+
+def build_corpus(folder: str, companies=12, sentences=220, noise=4000, seed=7):
+    """
+    Generate the synthetic corpus: one 10-Q per company per quarter of 2020, every other company filing
+    iXBRL, plus the ticker file and a year of daily bars per ticker.  The same seed gives the same bytes.
+    """
+    rng = random.Random(seed)
+    index_lines = {quarter: list() for quarter in FILING_DAYS}
+    tickers = list()
+
+    for number_of_company in range(companies):
+        cik = 9900001 + number_of_company
+        company = f'BENCHMARK CORP {number_of_company}'
+        ticker = f'BM{number_of_company:02d}'
+        tickers.append(f'{ticker.lower()}\t{cik}')
+        ixbrl = number_of_company % 2 == 1
+
+        company_sentences = [(template, render(rng, template))
+                             for template in (rng.randrange(len(SENTENCE_TEMPLATES)) for _ in range(sentences))]
+        for sequence, (quarter, (month, day)) in enumerate(FILING_DAYS.items(), start=1):
+            if sequence > 1:
+                company_sentences = next_quarter_sentences(rng, company_sentences)
+            filed = date(YEAR, month, day) + timedelta(days=number_of_company % 3)
+            # Most are accepted after the close, some during trading hours and get no price change
+            hour = 16 + number_of_company % 3 if number_of_company % 5 else 11
+            accepted = f'{filed.isoformat()} {hour:02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}'
+
+            accession = f'{cik:010d}-20-{sequence:06d}'
+            folder_name = accession.replace('-', '')
+            document = f'/Archives/edgar/data/{cik}/{folder_name}/bm{number_of_company:02d}-10q{sequence}.htm'
+            document_href = f'/ix?doc={document}' if ixbrl else document
+
+            html = filing_html(rng, company, quarter, company_sentences, ixbrl)
+            write_file(os.path.join(folder, document.lstrip('/')), html)
+            write_file(os.path.join(folder, 'Archives', 'edgar', 'data', str(cik), f'{accession}-index.html'),
+                       index_html(cik, company, accepted, document_href))
+            write_file(os.path.join(folder, 'Archives', 'edgar', 'data', str(cik), f'{accession}.txt'),
+                       submission_txt(rng, cik, company, accession, accepted, os.path.basename(document), html,
+                                      ixbrl))
+            index_lines[quarter].append(f'{cik}|{company}|10-Q|{filed.isoformat()}|'
+                                        f'edgar/data/{cik}/{accession}.txt')
+
+        bars = ['Date,Open,Close']
+        price = rng.uniform(10, 300)
+        day = date(YEAR, 1, 1)
+        while day < date(YEAR + 1, 1, 31):
+            if day.weekday() < 5:
+                open_price = price
+                price = max(1.0, price * (1 + rng.gauss(0, 0.02)))
+                bars.append(f'{day.isoformat()},{open_price:.2f},{price:.2f}')
+            day += timedelta(days=1)
+        write_file(os.path.join(folder, 'prices', f'{ticker}.csv'), '\n'.join(bars) + '\n')
+
+    for quarter, lines in index_lines.items():
+        month, day = FILING_DAYS[quarter]
+        for _ in range(noise):
+            cik = rng.randint(1000, 1800000)
+            lines.append(f'{cik}|NOISE COMPANY {cik}|{rng.choice(NOISE_FORMS)}|'
+                         f'{date(YEAR, month, rng.randint(1, 28)).isoformat()}|'
+                         f'edgar/data/{cik}/{cik:010d}-20-{rng.randint(1, 999999):06d}.txt')
+        rng.shuffle(lines)
+        write_file(os.path.join(folder, 'Archives', 'edgar', 'full-index', str(YEAR), quarter, 'master.zip'),
+                   master_zip(quarter, lines))
+
+    write_file(os.path.join(folder, 'include', 'ticker.txt'), '\n'.join(tickers) + '\n')
+    write_file(os.path.join(folder, 'corpus.json'), json.dumps({'version': CORPUS_VERSION, 'seed': seed,
+                                                                'companies': companies, 'year': YEAR}))
+
+
+def ensure_corpus(folder: str):
+    try:
+        with open(os.path.join(folder, 'corpus.json')) as corpus_file:
+            if json.load(corpus_file).get('version') == CORPUS_VERSION:
+                return
+    except (OSError, ValueError):
+        pass
+    print(f'Generating benchmark corpus in {folder}')
+    build_corpus(folder)
+
+
+def environment(work: str, corpus: str, url=None, requests_per_second=100):
+    """ Environment variables that keep a run inside the work folder and the corpus """
+    env = {
+        'OUTPUT_CLEANED_FILES': os.path.join(work, 'cleaned_files'),
+        'OUTPUT_DB': os.path.join(work, 'db'),
+        'OUTPUT_LOG_FILES': os.path.join(work, 'logs'),
+        'OUTPUT_HTTP_CACHE': os.path.join(work, 'http_cache'),
+        'OUTPUT_METRICS': os.path.join(work, 'metrics'),
+        'OUTPUT_FILING_STORE': os.path.join(work, 'filing_store'),
+        'PRICE_PROVIDER': 'file',
+        'PRICE_FILES_FOLDER': os.path.join(corpus, 'prices'),
+        'HTTP_CACHE': '0',
+        'LOGGING_LEVEL': 'ERROR',
+        'SEC_ANALYZE_SINCE_FY': str(YEAR),
+        'SEC_REQUESTS_PER_SECOND': str(requests_per_second),
+    }
+    if url:
+        env['SEC_WEBSITE'] = url
+        env['SEC_TICKER_URL'] = url + '/include/ticker.txt'
+    for folder in ('OUTPUT_CLEANED_FILES', 'OUTPUT_DB', 'OUTPUT_LOG_FILES', 'OUTPUT_METRICS'):
+        os.makedirs(env[folder], exist_ok=True)
+    return env
+
+
+def corpus_files(corpus: str, suffix: str, contains=''):
+    matches = list()
+    for root, _, files in os.walk(os.path.join(corpus, 'Archives')):
+        for name in files:
+            if name.endswith(suffix) and contains in name:
+                matches.append(os.path.join(root, name))
+    return sorted(matches)
+
+
+def measure(name: str, func, items: int, repeat: int):
+    timings = list()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    result = {'seconds': round(statistics.median(timings), 4), 'min': round(min(timings), 4), 'items': items,
+              'repeat': repeat}
+    print(f'{name:<24} {result["seconds"]:>9.3f}s median {result["min"]:>9.3f}s min  {items} item(s)')
+    return result
+
+
+def run_micro(corpus: str, repeat: int):
+    """ Time the CPU heavy functions in this process, one pass over the corpus per repeat """
+    work = tempfile.mkdtemp(prefix='micro-', dir=BENCHMARK_FOLDER)
+    os.environ.update(environment(work, corpus))
+    import sec
+    from laundry import FilingCleaner
+    from artifacts import write_artifact
+    from differences import create_diff
+
+    results = dict()
+
+    zips = list()
+    for path in corpus_files(corpus, 'master.zip'):
+        with open(path, 'rb') as zip_file:
+            zips.append(zip_file.read())
+    results['master_index_parse'] = measure(
+        'master_index_parse', lambda: [sec.parse_master_zip(content, ('10-Q',)) for content in zips], len(zips),
+        repeat)
+
+    index_pages = list()
+    for path in corpus_files(corpus, '-index.html'):
+        with open(path, 'rb') as index_file:
+            index_pages.append(index_file.read())
+    results['filing_index_parse'] = measure(
+        'filing_index_parse', lambda: [sec.parse_filing_index(content, '10-Q') for content in index_pages],
+        len(index_pages), repeat)
+
+    submissions = list()
+    for path in corpus_files(corpus, '.txt', contains='-'):
+        with open(path, 'rb') as submission_file:
+            submissions.append(submission_file.read())
+    results['submission_parse'] = measure(
+        'submission_parse', lambda: [sec.parse_submission(content, '10-Q') for content in submissions],
+        len(submissions), repeat)
+
+    # Quarter by quarter per CIK, named the way the pipeline names cleaned files
+    documents = list()
+    quarters = dict()
+    for path in corpus_files(corpus, '.htm'):
+        cik = path.split(os.sep)[-3]
+        quarters[cik] = quarters.get(cik, -1) + 1
+        accepted = date(YEAR, 1, 15) + timedelta(days=91 * quarters[cik])
+        with open(path, encoding='utf-8', errors='replace') as document:
+            documents.append((document.read(), {'cik': cik, 'date_accepted': f'{accepted.isoformat()} 17:00:00'}))
+
+    cleaned = list()
+
+    def wash_all():
+        cleaned.clear()
+        for text, data_dict in documents:
+            cleaner = FilingCleaner(text, data_dict)
+            cleaned.append((cleaner.wash(), cleaner.text))
+
+    results['wash'] = measure('wash', wash_all, len(documents), repeat)
+    results['sentence_artifacts'] = measure(
+        'sentence_artifacts', lambda: [write_artifact(file_name, text) for file_name, text in cleaned],
+        len(cleaned), repeat)
+
+    pairs = [{'id': i, 'current_file': cleaned[i][0], 'old_file': cleaned[i - 1][0]}
+             for i in range(1, len(cleaned)) if documents[i][1]['cik'] == documents[i - 1][1]['cik']]
+    results['create_diff'] = measure('create_diff', lambda: [create_diff(pair) for pair in pairs], len(pairs),
+                                     repeat)
+    results.update(run_workers(repeat, pairs))
+    results.update(run_queries(repeat))
+    results.update(run_logging(repeat))
+    shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+# marko_finance the way schema version 0 created it, with the differences inline
+LEGACY_FINANCE_SQL = '''CREATE TABLE marko_finance(
+                            id integer PRIMARY KEY AUTOINCREMENT,
+                            cik integer,
+                            company_name text,
+                            ticker_symbol text,
+                            date_filed text,
+                            date_accepted text,
+                            prc_change text,
+                            prc_change2 text,
+                            file_name text,
+                            url text,
+                            difference_from_last_report text
+                        )'''
+
+LEGACY_PLANNING_SQL = '''SELECT id, cik, file_name, date_accepted, difference_from_last_report, prc_change2
+                         FROM marko_finance ORDER BY cik, date_accepted'''
+
+
+def query_plan(conn, sql: str):
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def index_only(plan):
+    """ Every table scan is answered from an index, no table pages are read """
+    return all('COVERING INDEX' in step or 'PRIMARY KEY' in step for step in plan
+               if step.startswith(('SCAN', 'SEARCH')))
+
+
+def run_logging(repeat: int, records=20000):
+    """
+    Logging through the listener process: every record written, then one call site over its rate limit, then
+    DEBUG calls with a large argument while the level is INFO.  Runs in the micro benchmark's process.
+    """
+    import logging
+    import logs
+
+    log_file = os.path.join(os.environ['OUTPUT_LOG_FILES'], 'benchmark.jsonl')
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    logger = logging.getLogger('marko-polo')
+    logs.start_logging(log_file, rate_limit=0, console=False)
+    logger.setLevel(logging.INFO)
+    history = {date(YEAR, 1, 1) + timedelta(days=day): (100.0 + day, 101.0 + day) for day in range(30)}
+
+    def every_record():
+        for record in range(records):
+            logger.info('CIK: %s Processing %s', record, 'https://www.sec.gov/Archives/edgar/data/1/1.txt')
+
+    def disabled():
+        for record in range(records):
+            logger.debug('CIK: %s Got yahoo finance history\r\n%s', record, history)
+
+    results = dict()
+    results['logging'] = measure('logging', every_record, records, repeat)
+    logs.configure(logs.log_queue(), rate_limit=50)
+    logger.setLevel(logging.INFO)
+    results['logging_sampled'] = measure('logging_sampled', every_record, records, repeat)
+    results['logging_disabled'] = measure('logging_disabled', disabled, records, repeat)
+    logs.stop_logging()
+
+    with open(log_file, encoding='utf-8') as lines:
+        written = sum(1 for _ in lines)
+    results['logging']['checks'] = {'lost': max(0, records * repeat - written)}
+    print(f'{"":<24} {results["logging"]["seconds"] / records * 1e6:.1f}us per record, '
+          f'{results["logging_sampled"]["seconds"] / records * 1e6:.1f}us sampled, '
+          f'{results["logging_disabled"]["seconds"] / records * 1e6:.2f}us below the level')
+    return results
+
+
+def echo(value):
+    return value
+
+
+def timed_diff(data_dict):
+    """ create_diff in a worker, returning how long it took there """
+    from differences import create_diff
+    started = time.perf_counter()
+    create_diff(data_dict)
+    return time.perf_counter() - started
+
+
+def run_workers(repeat: int, pairs, tasks=5000):
+    """
+    The shared worker runtime: small tasks sent one by one against adaptive chunks, and the first diff a fresh
+    worker does, cold and warmed up by its initializer.  The diffs run on the cleaned files run_micro stored.
+    """
+    from config import get_environment
+    from workers import WorkerPool
+
+    results = dict()
+    with WorkerPool(processes=2) as pool:
+        results['pool_unchunked'] = measure(
+            'pool_unchunked', lambda: list(pool.imap_unordered(echo, range(tasks), chunk_seconds=0)), tasks, repeat)
+        results['pool_chunked'] = measure(
+            'pool_chunked', lambda: list(pool.imap_unordered(echo, range(tasks))), tasks, repeat)
+
+    if pairs:
+        ev = get_environment()
+        configured = ev.worker_warm
+        for name, warm in (('first_diff_cold', False), ('first_diff_warm', True)):
+            ev.worker_warm = warm
+            timings = list()
+            for _ in range(repeat):
+                with WorkerPool(processes=1) as pool:
+                    timings.append(pool.apply_async(timed_diff, (pairs[0],)).get())
+            results[name] = {'seconds': round(statistics.median(timings), 4), 'min': round(min(timings), 4),
+                             'items': 1, 'repeat': repeat}
+            print(f'{name:<24} {results[name]["seconds"]:>9.3f}s median {results[name]["min"]:>9.3f}s min  1 item(s)')
+        ev.worker_warm = configured
+    return results
+
+
+def run_queries(repeat: int, ciks=300, quarters=12):
+    """
+    Diff planning on a marko_finance of schema version 0, the migration, then the same planning on the current
+    schema.  The query plans are checks: planning has to stay index-only.  Runs in the micro benchmark's database.
+    """
+    import db
+    import export
+
+    rng = random.Random(21)
+    rows = list()
+    for cik in range(1, ciks + 1):
+        for quarter in range(quarters):
+            accepted = date(YEAR - 3, 1, 15) + timedelta(days=91 * quarter)
+            difference = ' '.join(rng.choice(SENTENCE_TEMPLATES) for _ in range(100)) if quarter else None
+            rows.append((cik, f'Company {cik}', f'T{cik}', accepted.isoformat(), f'{accepted.isoformat()} 17:00:00',
+                         str(round(rng.uniform(-0.1, 0.1), 5)), str(round(rng.uniform(-0.1, 0.1), 5)),
+                         f'{cik}-{accepted.isoformat()}.txt', '', difference))
+
+    conn = db.connect_to_db()
+    with conn:
+        conn.execute('DROP TABLE IF EXISTS marko_difference')
+        conn.execute('DROP TABLE IF EXISTS marko_finance')
+        conn.execute(LEGACY_FINANCE_SQL)
+        conn.execute('CREATE INDEX indx_cik on marko_finance(cik)')
+        conn.execute('CREATE INDEX indx_date_accepted on marko_finance(date_accepted)')
+        conn.executemany('INSERT INTO marko_finance (cik, company_name, ticker_symbol, date_filed, date_accepted, '
+                         'prc_change, prc_change2, file_name, url, difference_from_last_report) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('PRAGMA user_version = 0')
+    legacy_plan = query_plan(conn, LEGACY_PLANNING_SQL)
+    conn.close()
+
+    def legacy_planning():
+        legacy = db.connect_to_db()
+        legacy.execute(LEGACY_PLANNING_SQL).fetchall()
+        legacy.close()
+
+    results = dict()
+    results['planning_scan_v0'] = measure('planning_scan_v0', legacy_planning, len(rows), repeat)
+    results['planning_scan_v0']['checks'] = {'plan': legacy_plan, 'index_only': index_only(legacy_plan)}
+    results['schema_migration'] = measure('schema_migration', db.create_finance_table, len(rows), 1)
+
+    conn = db.connect_to_db()
+    plans = {
+        'difference_rows': query_plan(conn, db.DIFFERENCE_ROWS_SQL.format(where='')),
+        'cik_difference_rows': query_plan(conn, db.DIFFERENCE_ROWS_SQL.format(where='WHERE f.cik = 1')),
+        'export_edges': query_plan(conn, export.EDGES_SQL)
+    }
+    conn.close()
+    results['planning_scan'] = measure('planning_scan', db.select_difference_rows, len(rows), repeat)
+    results['planning_scan']['checks'] = {'plans': plans,
+                                          'index_only': all(index_only(plan) for plan in plans.values())}
+    results['export_edges'] = measure('export_edges', export.quintile_edges, len(rows), repeat)
+    for name, plan in plans.items():
+        print(f'{"":<24} {name}: {" / ".join(plan)}')
+    return results
+
+
+def run_startup(corpus: str, repeat: int):
+    """
+    Import main and pipeline in a fresh interpreter, repeat times.  Interpreter start up itself is not counted.
+    The heavy modules that got loaded are a check, so one creeping back into start up fails the run.
+    """
+    work = tempfile.mkdtemp(prefix='startup-', dir=BENCHMARK_FOLDER)
+    env = dict(os.environ)
+    env.update(environment(work, corpus))
+    timings = list()
+    heavy = list()
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', STARTUP_PROBE % (HEAVY_MODULES,)], cwd=DIR_PATH, env=env,
+                                   stdout=subprocess.PIPE, check=True)
+        probe = json.loads(completed.stdout.decode('utf-8').splitlines()[-1])
+        timings.append(probe['seconds'])
+        heavy = probe['heavy']
+    shutil.rmtree(work, ignore_errors=True)
+
+    result = {'seconds': round(statistics.median(timings), 4), 'min': round(min(timings), 4), 'items': len(heavy),
+              'repeat': repeat, 'checks': {'heavy_modules': heavy}}
+    print(f'{"cold_start":<24} {result["seconds"]:>9.3f}s median {result["min"]:>9.3f}s min  '
+          f'heavy modules: {", ".join(heavy) or "none"}')
+    return result
+
+
+def run_end_to_end(corpus: str, latency: float, jitter: float, throttle_every: int, requests_per_second: float):
+    """
+    Run main.py in a fresh work folder against the stand-in.  Returns the timing, the row and difference
+    counts to check against the baseline and the per stage summary the run wrote.
+    """
+    work = tempfile.mkdtemp(prefix='e2e-', dir=BENCHMARK_FOLDER)
+    with StandIn(corpus, latency=latency, jitter=jitter, throttle_every=throttle_every) as edgar:
+        env = dict(os.environ)
+        env.update(environment(work, corpus, edgar.url, requests_per_second))
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, os.path.join(DIR_PATH, 'main.py')], cwd=work, env=env)
+        seconds = time.perf_counter() - started
+        requests, throttled = edgar.requests, edgar.throttled
+
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(env['OUTPUT_DB'], 'marko-polo.db'))
+    rows, differences = conn.execute('SELECT (SELECT COUNT(*) FROM marko_finance), '
+                                     '(SELECT COUNT(*) FROM marko_difference)').fetchone()
+    conn.close()
+
+    stages = dict()
+    try:
+        with open(os.path.join(env['OUTPUT_METRICS'], 'run-summary.json')) as summary_file:
+            stages = {stage: {'items': values.get('items'), 'seconds': values.get('seconds')}
+                      for stage, values in json.load(summary_file)['stages'].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+    shutil.rmtree(work, ignore_errors=True)
+
+    # The time the logging calls of the run took, per filing
+    logging_seconds = (stages.get('logging', {}).get('seconds') or 0.0) / max(rows, 1)
+    print(f'{"end_to_end":<24} {seconds:>9.3f}s  exit {completed.returncode}  {requests} request(s) '
+          f'{throttled} throttled  {rows} row(s) {differences} difference(s)  '
+          f'{logging_seconds * 1e3:.2f}ms logging per filing')
+    return {'seconds': round(seconds, 4), 'min': round(seconds, 4), 'items': rows, 'repeat': 1,
+            'exit_code': completed.returncode, 'requests': requests, 'throttled': throttled,
+            'logging_per_filing': round(logging_seconds, 6),
+            'checks': {'rows': rows, 'differences': differences}, 'stages': stages}
+
+
+def corpus_submissions(corpus: str):
+    """ (cik, company, accession, accepted) of every complete submission in the corpus, in acceptance order """
+    submissions = list()
+    for path in corpus_files(corpus, '.txt', contains='-'):
+        with open(path, 'rb') as submission_file:
+            header = submission_file.read(4096).decode('utf-8', errors='replace')
+        accepted = re.search(r'<ACCEPTANCE-DATETIME>(\d{14})', header)
+        company = re.search(r'COMPANY CONFORMED NAME:\s*(.+)', header)
+        cik = re.search(r'CENTRAL INDEX KEY:\s*(\d+)', header)
+        if accepted and company and cik:
+            stamp = accepted.group(1)
+            submissions.append((int(cik.group(1)), company.group(1).strip(), os.path.basename(path)[:-4],
+                                f'{stamp[:4]}-{stamp[4:6]}-{stamp[6:8]} {stamp[8:10]}:{stamp[10:12]}:{stamp[12:]}'))
+    return sorted(submissions, key=lambda submission: submission[3])
+
+
+def atom_feed(submissions):
+    """ The latest filings feed listing the submissions, newest first like the SEC's """
+    entries = list()
+    for cik, company, accession, accepted in reversed(submissions):
+        entries.append(f'''<entry>
+<title>10-Q - {html.escape(company)} ({cik:010d}) (Filer)</title>
+<link rel="alternate" type="text/html" href="/Archives/edgar/data/{cik}/{accession}-index.html"/>
+<summary type="html"> &lt;b&gt;Filed:&lt;/b&gt; {accepted[:10]} &lt;b&gt;AccNo:&lt;/b&gt; {accession}</summary>
+<updated>{accepted.replace(' ', 'T')}-04:00</updated>
+<category scheme="https://www.sec.gov/" label="form type" term="10-Q"/>
+<id>urn:tag:sec.gov,2008:accession-number={accession}</id>
+</entry>''')
+    return ('<?xml version="1.0" encoding="ISO-8859-1" ?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+            '<title>Latest Filings</title>\n' + '\n'.join(entries) + '\n</feed>\n')
+
+
+def watch_probe(corpus: str, latency: float):
+    """
+    Runs in its own interpreter, started by run_watch.  Watch the stand-in's feed while it lists every filing but
+    the last of each CIK, then once more after the last ones show up.  Those have to be diffed against the
+    quarter before within the second poll.
+    """
+    submissions = corpus_submissions(corpus)
+    last = {cik: accession for cik, _, accession, _ in submissions}
+    earlier = [submission for submission in submissions if last[submission[0]] != submission[2]]
+
+    with StandIn(corpus, latency=latency) as edgar:
+        os.environ['SEC_WEBSITE'] = edgar.url
+        os.environ['SEC_TICKER_URL'] = edgar.url + '/include/ticker.txt'
+        import db
+        import sec
+        import metrics
+        from watch import Watcher, ATOM_PATH
+        db.create_finance_table()
+        db.create_master_index_tables()
+        db.create_cik_ticker_tables()
+
+        watcher = Watcher(sec.SEC(), source='atom', interval=0.1)
+        edgar.publish(ATOM_PATH, atom_feed(earlier))
+        asyncio.run(watcher.watch(cycles=1))
+
+        metrics.registry.reset()
+        edgar.publish(ATOM_PATH, atom_feed(submissions))
+        asyncio.run(watcher.watch(cycles=1))
+        summary = metrics.run_summary(metrics.registry.snapshot(), metrics.registry.started, time.time())
+
+    conn = db.connect_to_db()
+    rows, differences = conn.execute('SELECT (SELECT COUNT(*) FROM marko_finance), '
+                                     '(SELECT COUNT(*) FROM marko_difference)').fetchone()
+    conn.close()
+    processing = summary['stages'].get('watch_processing', {})
+    print(json.dumps({'seconds': processing.get('max', 0.0), 'p50': processing.get('p50'),
+                      'items': processing.get('items', 0), 'rows': rows, 'differences': differences,
+                      'failed': watcher.failed}))
+
+
+def run_watch(corpus: str, latency: float):
+    """
+    Watch mode against the stand-in's feed.  seconds is the longest it took from a filing showing up in the feed
+    to its diff being stored.
+    """
+    work = tempfile.mkdtemp(prefix='watch-', dir=BENCHMARK_FOLDER)
+    env = dict(os.environ)
+    env.update(environment(work, corpus))
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--watch-probe', '--corpus', corpus,
+                                '--latency', str(latency)], cwd=DIR_PATH, env=env, stdout=subprocess.PIPE,
+                               check=True)
+    probe = json.loads(completed.stdout.decode('utf-8').splitlines()[-1])
+    shutil.rmtree(work, ignore_errors=True)
+
+    print(f'{"watch":<24} {probe["seconds"]:>9.3f}s max    {probe["p50"] or 0:>9.3f}s p50  {probe["items"]} filing(s) '
+          f'{probe["rows"]} row(s) {probe["differences"]} difference(s)')
+    return {'seconds': round(probe['seconds'], 4), 'min': round(probe['p50'] or 0, 4), 'items': probe['items'],
+            'repeat': 1, 'exit_code': probe['failed'],
+            'checks': {'rows': probe['rows'], 'differences': probe['differences']}}
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """ Regressions against the baseline as lines of text.  Empty when everything is within the threshold. """
+    failures = list()
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f'{name:<24} no baseline')
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        verdict = 'REGRESSION' if ratio > 1 + threshold else 'ok'
+        print(f'{name:<24} {base["seconds"]:>9.3f}s -> {result["seconds"]:>9.3f}s  {ratio:>6.2f}x  {verdict}')
+        if verdict != 'ok':
+            failures.append(f'{name} is {ratio:.2f}x the baseline')
+        if base.get('checks') and result.get('checks') != base['checks']:
+            failures.append(f'{name} produced {result.get("checks")}, the baseline produced {base["checks"]}')
+        if result.get('exit_code'):
+            failures.append(f'{name} exited with {result["exit_code"]}')
+    return failures
+
+
+def record_corpus(folder: str, ciks, year: int):
+    """
+    Record a real corpus from the SEC: the filings of the given CIKs in every quarter of year, their index
+    pages and documents, their tickers and their daily bars from Yahoo.  master.idx keeps only the lines of
+    those CIKs.  Needs network access and SEC_USER_AGENT set.
+    """
+    os.environ.update(environment(tempfile.mkdtemp(prefix='record-', dir=BENCHMARK_FOLDER), folder))
+    os.environ['HTTP_CACHE'] = '1'
+    from config import get_environment
+    from fetch import fetch_url
+    from prices import YahooPriceProvider
+    import sec
+
+    ev = get_environment()
+    wanted = set(str(cik) for cik in ciks)
+    ranges = dict()
+    for quarter in FILING_DAYS:
+        response = fetch_url(f'{ev.sec_website}/Archives/edgar/full-index/{year}/{quarter}/master.zip')
+        if response is None:
+            continue
+        with zipfile.ZipFile(io.BytesIO(response.body)) as edgar_file:
+            lines = edgar_file.read('master.idx').decode('utf-8', errors='replace').splitlines()
+        kept = [line for line in lines if line.split('|')[0] in wanted]
+        write_file(os.path.join(folder, 'Archives', 'edgar', 'full-index', str(year), quarter, 'master.zip'),
+                   master_zip(quarter, kept))
+
+        for cik, _, form_type, date_filed, file_name in (line.split('|') for line in kept):
+            if form_type not in ev.sec_form_types:
+                continue
+            submission = fetch_url(f'{ev.sec_website}/Archives/{file_name}')
+            if submission is not None:
+                write_file(os.path.join(folder, 'Archives', file_name), submission.body)
+            index_path = f'/Archives/{file_name.replace(".txt", "-index.html")}'
+            index_page = fetch_url(ev.sec_website + index_path)
+            if index_page is None:
+                continue
+            write_file(os.path.join(folder, index_path.lstrip('/')), index_page.body)
+            document = sec.parse_filing_index(index_page.body, form_type)
+            if document is None:
+                continue
+            href = document[0]
+            response = fetch_url(ev.sec_website + href)
+            if response is not None:
+                write_file(os.path.join(folder, href.lstrip('/')), response.body)
+            start, end = ranges.get(cik, (date_filed, date_filed))
+            ranges[cik] = (min(start, date_filed), max(end, date_filed))
+
+    tickers = list()
+    response = fetch_url(ev.sec_ticker_url, immutable=False)
+    for line in response.body.decode('utf-8').splitlines():
+        ticker, _, cik = line.partition('\t')
+        if cik in wanted:
+            tickers.append(line)
+    write_file(os.path.join(folder, 'include', 'ticker.txt'), '\n'.join(tickers) + '\n')
+
+    provider = YahooPriceProvider()
+    for line in tickers:
+        ticker, _, cik = line.partition('\t')
+        if cik not in ranges:
+            continue
+        start = date.fromisoformat(ranges[cik][0]) - timedelta(days=5)
+        end = date.fromisoformat(ranges[cik][1]) + timedelta(days=5)
+        bars = provider.fetch_many([ticker.upper()], start, end).get(ticker.upper(), [])
+        write_file(os.path.join(folder, 'prices', f'{ticker.upper()}.csv'),
+                   'Date,Open,Close\n' + ''.join(f'{day.isoformat()},{open_price},{close_price}\n'
+                                                 for day, open_price, close_price in bars))
+    write_file(os.path.join(folder, 'corpus.json'), json.dumps({'version': CORPUS_VERSION, 'recorded': True,
+                                                                'ciks': sorted(wanted), 'year': year}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks against a recorded EDGAR corpus')
+    parser.add_argument('--corpus', help='corpus folder, a synthetic one is generated when left out')
+    parser.add_argument('--only', choices=['micro', 'e2e', 'startup', 'watch'], help='run just one kind of benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='passes per micro benchmark, the median counts')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stand-in adds to every response')
+    parser.add_argument('--jitter', type=float, default=0.01, help='up to this many random seconds more')
+    parser.add_argument('--throttle-every', type=int, default=25, help='answer every Nth request with a 429')
+    parser.add_argument('--rate', type=float, default=100, help='SEC_REQUESTS_PER_SECOND of the end to end run')
+    parser.add_argument('--baseline', default=os.path.join(BENCHMARK_FOLDER, 'baseline.json'))
+    parser.add_argument('--threshold', type=float, default=0.15, help='allowed slowdown, 0.15 is 15%%')
+    parser.add_argument('--import-budget', type=float, default=0.5,
+                        help='seconds importing main and pipeline may take')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--record', nargs='+', metavar='CIK', help='record a real corpus for these CIKs')
+    parser.add_argument('--year', type=int, default=YEAR, help='year to record')
+    parser.add_argument('--watch-probe', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.watch_probe:
+        watch_probe(args.corpus, args.latency)
+        return 0
+
+    os.makedirs(BENCHMARK_FOLDER, exist_ok=True)
+    if args.record:
+        record_corpus(args.corpus or os.path.join(BENCHMARK_FOLDER, 'recorded'), args.record, args.year)
+        return 0
+
+    corpus = os.path.abspath(args.corpus or os.path.join(BENCHMARK_FOLDER, 'corpus'))
+    if not args.corpus:
+        ensure_corpus(corpus)
+
+    results = dict()
+    if args.only in (None, 'startup'):
+        results['cold_start'] = run_startup(corpus, args.repeat)
+    if args.only in (None, 'e2e'):
+        # First, before the micro benchmarks import the app modules into this process
+        results['end_to_end'] = run_end_to_end(corpus, args.latency, args.jitter, args.throttle_every, args.rate)
+    if args.only in (None, 'watch'):
+        results['watch'] = run_watch(corpus, args.latency)
+    if args.only in (None, 'micro'):
+        results.update(run_micro(corpus, args.repeat))
+
+    # The import budget holds with or without a baseline
+    budget_failures = list()
+    startup = results.get('cold_start')
+    if startup and startup['seconds'] > args.import_budget:
+        budget_failures.append(f'cold_start took {startup["seconds"]:.3f}s, the budget is {args.import_budget:.3f}s')
+    if startup and startup['checks']['heavy_modules']:
+        budget_failures.append(f'cold_start loaded {", ".join(startup["checks"]["heavy_modules"])}')
+    planning = results.get('planning_scan')
+    if planning and not planning['checks']['index_only']:
+        budget_failures.append('diff planning reads table pages, it is no longer index-only')
+    for failure in budget_failures:
+        print(f'FAILED: {failure}')
+
+    run = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'corpus': corpus,
+        'results': results
+    }
+    with open(os.path.join(BENCHMARK_FOLDER, 'latest.json'), 'w') as latest:
+        json.dump(run, latest, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(run, baseline_file, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 1 if budget_failures else 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}.  Run with --save-baseline first.')
+        return 1 if budget_failures else 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('machine') != run['machine']:
+        print('Baseline was recorded on a different machine or python.  Timings may not compare.')
+
+    failures = compare(results, baseline, args.threshold)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures or budget_failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
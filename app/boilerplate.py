@@ -0,0 +1,173 @@
+import re
+import time
+import zlib
+import logging
+import threading
+
+from config import get_environment
+from store import get_store
+import db
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+MONTH = re.compile(r'\b(?:january|february|march|april|may|june|july|august|september|october|november|december)\b')
+NUMBER = re.compile(r'\d+(?:[.,]\d+)*')
+NOT_A_WORD = re.compile(r'[^a-z#]+')
+
+
+def normalize(sentence: str):
+    """
+    Fold the parts of a sentence that change every quarter: case, punctuation, numbers and month names.
+    'As of June 30, 2020 the Company had...' and 'As of March 31, 2021 the company had...' become the same.
+    """
+    sentence = NUMBER.sub('#', sentence.lower())
+    sentence = MONTH.sub('#', sentence)
+    return NOT_A_WORD.sub(' ', sentence).strip()
+
+
+def create_boilerplate_tables():
+    """
+    sentence_counts   per normalized sentence hash, how many filings and how many distinct CIKs used it
+    sentence_ciks     the (hash, cik) pairs seen, so a CIK counts once for a sentence across every update
+    boilerplate       the hashes used by at least boilerplate_min_ciks CIKs, the dictionary create_diff reads
+    boilerplate_counted   the artifacts already counted, so an update only reads new filings
+
+    Counts made before sentence_ciks existed counted changes of CIK, not CIKs.  They are dropped, with the
+    dictionary built from them, and the next update counts every filing again.
+    """
+    conn = db.connect_to_db()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        tables = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        if 'sentence_counts' in tables and 'sentence_ciks' not in tables:
+            logger.info('Counting boilerplate sentences again, by distinct CIK.')
+            conn.execute('DROP TABLE sentence_counts')
+            conn.execute('DELETE FROM boilerplate')
+            conn.execute('DELETE FROM boilerplate_counted')
+        conn.execute('''CREATE TABLE IF NOT EXISTS sentence_counts(
+                            hash integer PRIMARY KEY,
+                            filings integer,
+                            ciks integer
+                        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS sentence_ciks(
+                            hash integer,
+                            cik text,
+                            PRIMARY KEY (hash, cik)
+                        ) WITHOUT ROWID''')
+        conn.execute('CREATE TABLE IF NOT EXISTS boilerplate(hash integer PRIMARY KEY)')
+        conn.execute('CREATE TABLE IF NOT EXISTS boilerplate_counted(name text PRIMARY KEY)')
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def update_dictionary(min_ciks=None, chunk_size=200):
+    """
+    Count the normalized sentences of every cleaned filing not counted yet and move the ones that crossed
+    min_ciks into the boilerplate dictionary.  Returns the number of filings counted.
+
+    A filing counts a sentence once however often it repeats it, and a CIK once however many of its filings use
+    it, whichever update counted them.
+    """
+    from artifacts import load_artifact, SentenceArtifact
+
+    min_ciks = min_ciks or ev.boilerplate_min_ciks
+    create_boilerplate_tables()
+    store = get_store()
+    conn = db.connect_to_db()
+    done = set(row[0] for row in conn.execute('SELECT name FROM boilerplate_counted'))
+    names = sorted(name for name in store.names('.sent') if name not in done)
+    counted = 0
+    added = 0
+
+    for start in range(0, len(names), chunk_size):
+        chunk = names[start:start + chunk_size]
+        records = store.get_many(chunk)
+        filings = list()
+        for name in chunk:
+            try:
+                artifact = SentenceArtifact.load(records[name]) if name in records else None
+            except (ValueError, zlib.error):
+                artifact = None
+            if artifact is None:
+                # Written by an older version, without normalized hashes
+                file_name = name[:-len('.sent')] + '.txt'
+                text = store.get_text(file_name)
+                if text is None:
+                    continue
+                artifact = load_artifact(file_name, text)
+            filings.append((name, name.split('-')[0], set(sentence[5] for sentence in artifact.sentences)))
+
+        with metrics.timed('boilerplate_count'):
+            for name, cik, hashes in filings:
+                with conn:
+                    # Claimed in the same transaction as the counts, so two processes never count a filing twice
+                    if not conn.execute('INSERT OR IGNORE INTO boilerplate_counted (name) VALUES (?)',
+                                        (name,)).rowcount:
+                        continue
+                    conn.executemany('INSERT OR IGNORE INTO sentence_counts (hash, filings, ciks) VALUES (?, 0, 0)',
+                                     ((sentence_hash,) for sentence_hash in hashes))
+                    conn.executemany('UPDATE sentence_counts SET filings = filings + 1 WHERE hash = ?',
+                                     ((sentence_hash,) for sentence_hash in hashes))
+                    # Only the sentences this CIK never used before gain a CIK
+                    new_to_cik = [sentence_hash for sentence_hash in hashes if conn.execute(
+                        'INSERT OR IGNORE INTO sentence_ciks (hash, cik) VALUES (?, ?)', (sentence_hash, cik)).rowcount]
+                    conn.executemany('UPDATE sentence_counts SET ciks = ciks + 1 WHERE hash = ?',
+                                     ((sentence_hash,) for sentence_hash in new_to_cik))
+                    added += conn.executemany(
+                        'INSERT OR IGNORE INTO boilerplate (hash) SELECT hash FROM sentence_counts '
+                        'WHERE hash = ? AND ciks >= ?',
+                        ((sentence_hash, min_ciks) for sentence_hash in new_to_cik)).rowcount
+                counted += 1
+
+    size = conn.execute('SELECT COUNT(*) FROM boilerplate').fetchone()[0]
+    conn.close()
+    if counted:
+        logger.info(f'Counted the sentences of {counted} filing(s). {added} new boilerplate sentence(s), '
+                    f'{size} in the dictionary.')
+    return counted
+
+
+class Dictionary:
+    """ The boilerplate hashes of one process, read again every boilerplate_refresh_seconds """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = frozenset()
+        self.loaded = None
+
+    def get(self):
+        with self.lock:
+            if self.loaded is None or time.monotonic() - self.loaded > ev.boilerplate_refresh_seconds:
+                create_boilerplate_tables()
+                conn = db.connect_to_db()
+                self.hashes = frozenset(row[0] for row in conn.execute('SELECT hash FROM boilerplate'))
+                conn.close()
+                self.loaded = time.monotonic()
+            return self.hashes
+
+
+_dictionary = Dictionary()
+
+
+def dictionary():
+    """ frozenset of the boilerplate sentence hashes, empty when BOILERPLATE is off """
+    if not ev.boilerplate:
+        return frozenset()
+    return _dictionary.get()
+
+
+def report():
+    """ Log how much of the diff input the dictionary dropped """
+    sentences = int(metrics.total('sentences', 'boilerplate'))
+    if sentences:
+        hits = int(metrics.total('hits', 'boilerplate'))
+        logger.info(f'Boilerplate dictionary dropped {hits} of {sentences} sentence(s) ({hits / sentences:.1%}) '
+                    f'before fuzzy matching.')
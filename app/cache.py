@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+from config import get_environment
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+CacheEntry = namedtuple('CacheEntry', ['url', 'body', 'headers', 'stored_at'])
+
+# Only these headers are kept with a cached body.  Enough to decode it and to revalidate it.
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def is_immutable(url: str):
+    """
+    Filed documents never change once they are on EDGAR.  Everything else (full-index, daily-index, feeds)
+    can change and has to be revalidated with a conditional GET.
+    """
+    return '/Archives/edgar/data/' in url
+
+
+class HttpCache:
+    """
+    Compressed on-disk cache of EDGAR responses keyed by url.
+
+    Bodies are zlib compressed files under output/http_cache.  A small sqlite index keeps the validators
+    (ETag / Last-Modified), sizes and last access time used for LRU eviction once the cache is bigger than
+    http_cache_max_mb.
+    """
+
+    def __init__(self, folder=None, max_bytes=None):
+        self.folder = folder or ev.output_http_cache
+        self.max_bytes = max_bytes or ev.http_cache_max_mb * 1024 * 1024
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.folder, 'index.db'), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS http_cache(
+                                key text PRIMARY KEY,
+                                url text,
+                                headers text,
+                                size integer,
+                                stored_at real,
+                                last_access real
+                            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS indx_last_access on http_cache(last_access)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM http_cache').fetchone()[0]
+
+    @staticmethod
+    def make_key(url: str):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, url: str):
+        """ Return the CacheEntry for url or None """
+        key = self.make_key(url)
+        with self.lock:
+            row = self.conn.execute('SELECT headers, stored_at FROM http_cache WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE http_cache SET last_access=? WHERE key=?', (time.time(), key))
+            self.conn.commit()
+
+        try:
+            with open(self.path_for(key), 'rb') as cached_file:
+                body = zlib.decompress(cached_file.read())
+        except (OSError, zlib.error) as error:
+            logger.warning(f'Cache entry for {url} is unreadable, dropping it. Error: {error}')
+            self.delete(key)
+            return None
+        return CacheEntry(url, body, json.loads(row[0]), row[1])
+
+    def put(self, url: str, body: bytes, headers):
+        key = self.make_key(url)
+        kept_headers = {name: headers[name] for name in KEPT_HEADERS if headers and headers.get(name)}
+        compressed = zlib.compress(body, 6)
+
+        path = self.path_for(key)
+        Path(os.path.dirname(path)).mkdir(exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as cached_file:
+            cached_file.write(compressed)
+        os.replace(temp_path, path)
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM http_cache WHERE key=?', (key,)).fetchone()
+            if row:
+                self.total_bytes -= row[0]
+            self.conn.execute('INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, url, json.dumps(kept_headers), len(compressed), now, now))
+            self.conn.commit()
+            self.total_bytes += len(compressed)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def touch(self, url: str):
+        """ A 304 told us the cached copy is still good """
+        with self.lock:
+            self.conn.execute('UPDATE http_cache SET stored_at=?, last_access=? WHERE key=?',
+                              (time.time(), time.time(), self.make_key(url)))
+            self.conn.commit()
+
+    def delete(self, key: str):
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM http_cache WHERE key=?', (key,)).fetchone()
+            if row:
+                self.total_bytes -= row[0]
+                self.conn.execute('DELETE FROM http_cache WHERE key=?', (key,))
+                self.conn.commit()
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """ Drop least recently used entries until we are back under 90% of the size cap """
+        target = self.max_bytes * 0.9
+        logger.info(f'HTTP cache is {self.total_bytes} bytes, evicting down to {int(target)} bytes.')
+        with self.lock:
+            rows = self.conn.execute('SELECT key FROM http_cache ORDER BY last_access').fetchall()
+        for (key,) in rows:
+            if self.total_bytes <= target:
+                break
+            self.delete(key)
+
+    def conditional_headers(self, entry: CacheEntry):
+        """ Headers for a conditional GET revalidating a cached entry """
+        headers = dict()
+        if entry.headers.get('ETag'):
+            headers['If-None-Match'] = entry.headers['ETag']
+        if entry.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = entry.headers['Last-Modified']
+        return headers
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,7 +1,17 @@
 import os
 import multiprocessing
+from functools import lru_cache
 from dotenv import load_dotenv
-from distutils import util
+
+
+def strtobool(value: str):
+    """ distutils.util.strtobool.  Importing distutils alone takes longer than the rest of start up. """
+    value = value.lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError(f'invalid truth value {value!r}')
 
 
 class Environment:
@@ -11,6 +21,11 @@ class Environment:
         self.logging_level = 'DEBUG'
         self.logging_format = '%(asctime)s %(levelname)5s %(message)s File: %(filename)s Line: %(lineno)s'
         self.logging_date_format = '%H:%M:%S'
+        # The log file of a run is JSON lines, one object per record.  0 writes the plain text format instead.
+        self.logging_json = '1'
+        # Records per second let through from one logging call below WARNING, the rest are counted and dropped.
+        # 0 lets everything through.
+        self.logging_rate_limit = 50
         self.number_of_cores = None
 
         # output folders
@@ -19,13 +34,114 @@ class Environment:
         self.output_cleaned_files = os.path.join(self.output_folder, 'cleaned_files')
         self.output_log_files = os.path.join(self.output_folder, "logs")
         self.output_db = os.path.join(self.output_folder, "db")
+        self.output_http_cache = os.path.join(self.output_folder, "http_cache")
+        self.output_metrics = os.path.join(self.output_folder, "metrics")
+        self.output_filing_store = os.path.join(self.output_folder, "filing_store")
+        self.export_folder = os.path.join(self.output_folder, "training_data")
 
         # sec stuff
         self.sec_website = 'https://www.sec.gov'
         self.sec_ticker_url = self.sec_website + '/include/ticker.txt'
         self.sec_analyze_since_fy = 2020
         self.sec_analyze_quarter = None
+        # Form types downloaded and diffed in one pass, comma separated, e.g. 10-Q,10-K,10-Q/A.
+        # SEC_FORM_TYPE, the one form older versions handled, is used when SEC_FORM_TYPES is not set.
+        self.sec_form_types = None
         self.sec_form_type = '10-Q'
+        self.sec_ticker_refresh_hours = 24
+
+        # sec fetching.  SEC fair access asks for no more than 10 requests per second and a declared user agent.
+        self.sec_user_agent = 'marko-polo admin@example.com'
+        self.sec_requests_per_second = 10
+        self.sec_fetch_concurrency = 16
+        self.sec_http_timeout = 60
+        self.sec_max_retries = 5
+        self.master_index_concurrency = 4
+        self.plan_chunk_size = 5000
+        # 'submission' streams the 10-Q and acceptance time out of the complete submission .txt in one request.
+        # 'index' reads them from the -index.html page and then downloads the 10-Q, two requests.
+        self.sec_document_source = 'submission'
+
+        # http cache.  Offline only replays what is already in the cache.
+        self.http_cache = '1'
+        self.http_cache_max_mb = 10240
+        self.sec_offline = '0'
+
+        # filing store.  Cleaned filings are packed into segment files of up to this size.
+        self.store_segment_mb = 256
+
+        # worker processes.  Memory of a task is estimated as its document size times the factor.  0 budget is half
+        # of physical memory.  Workers are replaced after max tasks or max rss, 0 turns either off.
+        self.worker_memory_budget_mb = 0
+        self.worker_memory_factor = 15
+        self.worker_max_tasks = 500
+        self.worker_max_rss_mb = 2048
+        self.worker_task_timeout = 600
+        # One set of workers serves every stage of a run.  Warm loads stop words, punkt, the matcher and the store
+        # once when a worker starts.  imap_unordered sends small items in chunks of about chunk seconds of work.
+        self.worker_warm = '1'
+        self.worker_chunk_seconds = 0.5
+
+        # work queue.  Work is leased for lease seconds and renewed while a process is alive.  An item is given up
+        # after max attempts.  The pipeline claims claim size CIKs at a time.
+        self.work_lease_seconds = 300
+        self.work_max_attempts = 3
+        self.work_claim_size = 4
+
+        # database writer
+        self.sqlite_timeout = 30
+        self.writer_batch_size = 500
+        self.writer_flush_seconds = 2
+
+        # prices.  'yahoo' or 'file' to read <price_files_folder>/<TICKER>.csv files with Date,Open,Close columns.
+        self.price_provider = 'yahoo'
+        self.price_files_folder = os.path.join(self.dir_path, 'input', 'prices')
+        self.price_batch_size = 50
+        # Reports of the last backfill days stored without prices (watch mode) are priced once the days after exist
+        self.price_backfill_days = 14
+        # A ticker the provider returned no bars for (failed, delisted) is asked again after this many seconds
+        self.price_empty_retry_seconds = 3600
+
+        # nltk data.  punkt is read from here and never downloaded at run time.
+        self.nltk_data = os.path.join(self.dir_path, 'input', 'nltk_data')
+
+        # differences.  'index' only fuzzy matches candidates from a q-gram index, 'brute' matches everything.
+        self.diff_matcher = 'index'
+
+        # boilerplate.  Sentences used by at least min ciks companies are dropped before fuzzy matching.  Workers
+        # read the dictionary again every refresh seconds, the pipeline counts new filings just as often.
+        self.boilerplate = '1'
+        self.boilerplate_min_ciks = 10
+        self.boilerplate_refresh_seconds = 60
+
+        # pipeline.  Every stage has a bounded queue and its own workers.  Zero means pick a default.
+        self.pipeline_queue_size = 64
+        self.pipeline_fetch_workers = 0
+        self.pipeline_clean_workers = 0
+        self.pipeline_enrich_workers = 4
+        self.pipeline_diff_workers = 0
+        self.pipeline_diff_interval = 5
+        self.pipeline_report_seconds = 30
+
+        # watch mode.  Poll the 'atom' latest filings feed or the 'daily' index every interval seconds.  Zero
+        # cycles watches until interrupted.
+        self.watch = '0'
+        self.watch_source = 'atom'
+        self.watch_interval = 30
+        self.watch_concurrency = 4
+        self.watch_cycles = 0
+
+        # metrics.  profile_slowest=N keeps a cProfile (or 'tracemalloc') report of the N slowest pool calls.
+        self.profile_slowest = 0
+        self.profile_mode = 'cprofile'
+        self.profile_stages = 'clean_filing,create_diff'
+
+        # training data export.  'csv', 'jsonl' or 'parquet' (needs pyarrow).  Incremental only appends new rows.
+        self.export_format = 'csv'
+        self.export_compress = '0'
+        self.export_shard_rows = 50000
+        self.export_chunk_rows = 1000
+        self.export_incremental = '0'
 
         # where to start
         self.get_differences = '0'
@@ -48,5 +164,69 @@ class Environment:
             # Assign current cpu count
             self.number_of_cores = multiprocessing.cpu_count()
 
-        self.get_differences = bool(util.strtobool(self.get_differences))
-        self.create_report = bool(util.strtobool(self.create_report))
+        self.sec_form_types = tuple(form_type.strip() for form_type in
+                                    (self.sec_form_types or self.sec_form_type).split(',') if form_type.strip())
+        self.sec_requests_per_second = float(self.sec_requests_per_second)
+        self.sec_fetch_concurrency = int(self.sec_fetch_concurrency)
+        self.sec_http_timeout = float(self.sec_http_timeout)
+        self.sec_max_retries = int(self.sec_max_retries)
+        self.master_index_concurrency = int(self.master_index_concurrency)
+        self.plan_chunk_size = int(self.plan_chunk_size)
+        self.store_segment_mb = int(self.store_segment_mb)
+        self.worker_memory_budget_mb = int(self.worker_memory_budget_mb)
+        self.worker_memory_factor = float(self.worker_memory_factor)
+        self.worker_max_tasks = int(self.worker_max_tasks)
+        self.worker_max_rss_mb = int(self.worker_max_rss_mb)
+        self.worker_task_timeout = float(self.worker_task_timeout)
+        self.worker_chunk_seconds = float(self.worker_chunk_seconds)
+        self.work_lease_seconds = float(self.work_lease_seconds)
+        self.work_max_attempts = int(self.work_max_attempts)
+        self.work_claim_size = int(self.work_claim_size)
+        self.sqlite_timeout = float(self.sqlite_timeout)
+        self.writer_batch_size = int(self.writer_batch_size)
+        self.writer_flush_seconds = float(self.writer_flush_seconds)
+        self.price_batch_size = int(self.price_batch_size)
+        self.price_backfill_days = int(self.price_backfill_days)
+        self.price_empty_retry_seconds = float(self.price_empty_retry_seconds)
+        self.sec_ticker_refresh_hours = float(self.sec_ticker_refresh_hours)
+        self.http_cache_max_mb = int(self.http_cache_max_mb)
+        self.pipeline_queue_size = int(self.pipeline_queue_size)
+        self.pipeline_fetch_workers = int(self.pipeline_fetch_workers) or self.sec_fetch_concurrency
+        # More than the pool has processes, so the pool can pick the largest waiting filing
+        self.pipeline_clean_workers = int(self.pipeline_clean_workers) or self.number_of_cores * 2
+        self.pipeline_enrich_workers = int(self.pipeline_enrich_workers)
+        self.pipeline_diff_workers = int(self.pipeline_diff_workers) or self.number_of_cores * 2
+        self.pipeline_diff_interval = float(self.pipeline_diff_interval)
+        self.pipeline_report_seconds = float(self.pipeline_report_seconds)
+        self.watch_interval = float(self.watch_interval)
+        self.watch_concurrency = int(self.watch_concurrency)
+        self.watch_cycles = int(self.watch_cycles)
+        self.logging_rate_limit = float(self.logging_rate_limit)
+        self.boilerplate_min_ciks = int(self.boilerplate_min_ciks)
+        self.boilerplate_refresh_seconds = float(self.boilerplate_refresh_seconds)
+        self.profile_slowest = int(self.profile_slowest)
+        self.profile_stages = frozenset(stage.strip() for stage in self.profile_stages.split(','))
+
+        self.export_shard_rows = int(self.export_shard_rows)
+        self.export_chunk_rows = int(self.export_chunk_rows)
+
+        self.http_cache = strtobool(self.http_cache)
+        self.sec_offline = strtobool(self.sec_offline)
+        self.export_compress = strtobool(self.export_compress)
+        self.export_incremental = strtobool(self.export_incremental)
+        self.boilerplate = strtobool(self.boilerplate)
+        self.watch = strtobool(self.watch)
+        self.logging_json = strtobool(self.logging_json)
+        self.worker_warm = strtobool(self.worker_warm)
+
+        self.get_differences = strtobool(self.get_differences)
+        self.create_report = strtobool(self.create_report)
+
+
+@lru_cache(maxsize=None)
+def get_environment():
+    """
+    The Environment shared by every module, so .env and the environment variables are read once per process.
+    Environment() still builds a fresh one.
+    """
+    return Environment()
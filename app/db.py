@@ -1,96 +1,558 @@
-from config import Environment
+from config import get_environment
 import os
+import time
+import zlib
+import queue
 import sqlite3
 import logging
+import calendar
+import threading
 
-ev = Environment()
+import metrics
+
+ev = get_environment()
 logger = logging.getLogger(ev.app_name)
 
 
 def connect_to_db():
     db_location = os.path.join(ev.output_db, 'marko-polo.db')
-    return sqlite3.connect(db_location)
+    return sqlite3.connect(db_location, timeout=ev.sqlite_timeout)
 
 
-def insert_into_finance(finance_data):
-    try:
-        conn = connect_to_db()
-        cursor = conn.cursor()
-
-        prc_change2 = None
-
-        if 'prc_change2' in finance_data:
-            prc_change2 = finance_data['prc_change2']
-
-        sql = '''INSERT INTO marko_finance 
-                    (
-                        cik, 
-                        company_name, 
-                        url, 
-                        date_filed, 
-                        date_accepted, 
-                        ticker_symbol, 
-                        file_name, 
-                        prc_change, 
-                        prc_change2
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        '''
-
-        cursor.execute(sql, (
+INSERT_FINANCE_SQL = '''INSERT INTO marko_finance
+                            (
+                                cik,
+                                company_name,
+                                url,
+                                date_filed,
+                                date_accepted,
+                                ticker_symbol,
+                                file_name,
+                                form_type,
+                                prc_change,
+                                prc_change2
+                            )
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPDATE_DIFFERENCE_SQL = 'INSERT OR REPLACE INTO marko_difference (id, difference) VALUES (?, ?)'
+
+UPDATE_PRICES_SQL = 'UPDATE marko_finance SET ticker_symbol = ?, prc_change = ?, prc_change2 = ? WHERE id = ?'
+
+ACCEPTED_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def to_epoch(date_accepted):
+    """ 'YYYY-MM-DD HH:MM:SS' as stored in marko_finance: the EDGAR (Eastern) wall clock counted as if it were UTC """
+    if date_accepted is None:
+        return None
+    return calendar.timegm(time.strptime(date_accepted, ACCEPTED_FORMAT))
+
+
+def from_epoch(seconds: int):
+    return time.strftime(ACCEPTED_FORMAT, time.gmtime(seconds))
+
+
+def compress_difference(difference: str):
+    return zlib.compress(difference.encode('utf-8'))
+
+
+def decompress_difference(content: bytes):
+    return zlib.decompress(content).decode('utf-8')
+
+
+class BatchWriter:
+    """
+    The one writer to marko-polo.db.
+
+    Everybody else hands rows to write() and moves on.  A background thread groups them per statement and
+    commits them with executemany in one transaction once writer_batch_size rows are waiting or
+    writer_flush_seconds have passed.  flush() waits until everything written so far is committed and close()
+    commits whatever is left, so a row handed to the writer is never lost on a clean shutdown.
+
+        with BatchWriter() as writer:
+            writer.insert_finance(finance_data)
+    """
+    _stop = object()
+
+    def __init__(self, batch_size=None, flush_seconds=None):
+        self.batch_size = batch_size or ev.writer_batch_size
+        self.flush_seconds = flush_seconds or ev.writer_flush_seconds
+        self.queue = queue.Queue()
+        self.rows_written = 0
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, sql: str, params):
+        self.queue.put((sql, params))
+
+    def insert_finance(self, finance_data: dict):
+        self.write(INSERT_FINANCE_SQL, (
             finance_data['cik'],
             finance_data['company_name'],
             finance_data['url'],
             finance_data['date_filed'],
-            finance_data['date_accepted'],
+            to_epoch(finance_data['date_accepted']),
             finance_data['ticker_symbol'],
             finance_data['file_name'],
+            finance_data['form_type'],
             finance_data['prc_change'],
-            prc_change2
+            finance_data.get('prc_change2')
         ))
-        conn.commit()
+
+    def update_difference(self, record_id, difference: str):
+        self.write(UPDATE_DIFFERENCE_SQL, (record_id, compress_difference(difference)))
+
+    def update_prices(self, record_id, finance_data: dict):
+        self.write(UPDATE_PRICES_SQL, (finance_data['ticker_symbol'], finance_data['prc_change'],
+                                       finance_data.get('prc_change2'), record_id))
+
+    def flush(self):
+        """ Block until every row written before this call is committed """
+        done = threading.Event()
+        self.queue.put(done)
+        with metrics.timed('db_flush_wait'):
+            done.wait()
+
+    def close(self):
+        self.queue.put(self._stop)
+        self.thread.join()
+
+    def commit(self, conn, pending: dict):
+        for sql, rows in pending.items():
+            try:
+                with metrics.timed('db_commit'), conn:
+                    conn.executemany(sql, rows)
+                self.rows_written += len(rows)
+                metrics.count('rows', 'db_commit', len(rows))
+            except sqlite3.Error as error:
+                if 'locked' in str(error):
+                    metrics.count('locked', 'db_commit')
+                # Find the bad rows instead of dropping the whole batch
+                logger.error(f'Batch of {len(rows)} row(s) failed, retrying one at a time. Error: {error}')
+                for row in rows:
+                    try:
+                        with conn:
+                            conn.execute(sql, row)
+                        self.rows_written += 1
+                    except sqlite3.Error as row_error:
+                        logger.error(f'Could not write record into database: {row}. Error: {row_error}')
+        pending.clear()
+
+    def run(self):
+        conn = connect_to_db()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+
+        pending = dict()
+        pending_count = 0
+        last_commit = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_seconds - (time.monotonic() - last_commit))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                sql, params = item
+                pending.setdefault(sql, list()).append(params)
+                pending_count += 1
+
+            # flush() and close() always commit, otherwise wait for a full batch or the timer
+            control = item is not None and not isinstance(item, tuple)
+            if control or pending_count >= self.batch_size or time.monotonic() - last_commit >= self.flush_seconds:
+                self.commit(conn, pending)
+                pending_count = 0
+                last_commit = time.monotonic()
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is self._stop:
+                break
         conn.close()
-    except Exception as e:
-        logger.error(f'Could not insert record into database: {finance_data}. Error: {e}')
+        logger.info(f'Database writer finished. {self.rows_written} row(s) written.')
 
 
 def truncate_finance():
     conn = connect_to_db()
-    cursor = conn.cursor()
-    sql = "DELETE FROM marko_finance"
-    cursor.execute(sql)
-    conn.commit()
+    with conn:
+        conn.execute('DELETE FROM marko_difference')
+        conn.execute('DELETE FROM marko_finance')
     conn.close()
 
 
+# PRAGMA user_version of marko-polo.db.  Bump it and add a migration to MIGRATIONS to change marko_finance.
+SCHEMA_VERSION = 2
+
+FINANCE_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS marko_finance(
+                            id integer PRIMARY KEY AUTOINCREMENT,
+                            cik integer,
+                            company_name text,
+                            ticker_symbol text,
+                            date_filed text,
+                            date_accepted integer,
+                            prc_change real,
+                            prc_change2 real,
+                            file_name text,
+                            url text,
+                            form_type text
+                        )'''
+
+# The new sentences of a report, zlib compressed.  Kept out of marko_finance so scanning it never reads them.
+DIFFERENCE_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS marko_difference(
+                               id integer PRIMARY KEY,
+                               difference blob
+                           )'''
+
+FINANCE_INDEXES_SQL = [
+    # Used by the resume planner to find filings we already have
+    'CREATE INDEX IF NOT EXISTS indx_cik_date_filed on marko_finance(cik, date_filed, form_type)',
+    # Covers select_difference_rows and the export edges, so planning diffs never reads a table page
+    'CREATE INDEX IF NOT EXISTS indx_cik_date_accepted on marko_finance'
+    '(cik, date_accepted, form_type, prc_change2, file_name)'
+]
+
+
+def migrate_typed_finance(conn):
+    """
+    Version 1.  Dates accepted become epoch seconds, price changes REAL and the differences move, compressed,
+    to marko_difference.
+    """
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='marko_finance'").fetchone()
+    conn.execute('ALTER TABLE marko_finance RENAME TO marko_finance_v0')
+    conn.execute(FINANCE_TABLE_SQL)
+    conn.execute(DIFFERENCE_TABLE_SQL)
+    conn.execute('''INSERT INTO marko_finance
+                        (id, cik, company_name, ticker_symbol, date_filed, date_accepted, prc_change, prc_change2,
+                         file_name, url)
+                    SELECT
+                        id,
+                        cik,
+                        company_name,
+                        ticker_symbol,
+                        date_filed,
+                        CAST(strftime('%s', date_accepted) AS integer),
+                        CAST(NULLIF(prc_change, '') AS real),
+                        CAST(NULLIF(prc_change2, '') AS real),
+                        file_name,
+                        url
+                    FROM
+                        marko_finance_v0''')
+
+    cursor = conn.execute('SELECT id, difference_from_last_report FROM marko_finance_v0 '
+                          'WHERE difference_from_last_report IS NOT NULL')
+    while True:
+        rows = cursor.fetchmany(500)
+        if not rows:
+            break
+        conn.executemany('INSERT INTO marko_difference (id, difference) VALUES (?, ?)',
+                         ((row_id, compress_difference(difference)) for row_id, difference in rows))
+    conn.execute('DROP TABLE marko_finance_v0')
+
+    # Ids of deleted rows must not come back, exported_rows remembers them
+    if sequence:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name='marko_finance'", sequence)
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'marko_finance', ? "
+                     "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name='marko_finance')", sequence)
+
+
+def migrate_form_type(conn):
+    """
+    Version 2.  The form type of every report, so 10-Qs, 10-Ks and amendments can share the table.  Everything
+    stored before was of the one form SEC_FORM_TYPE named.  The indexes are created again with form_type in them.
+    """
+    # Version 1 created the table from FINANCE_TABLE_SQL, which has the column by now
+    columns = set(row[1] for row in conn.execute('PRAGMA table_info(marko_finance)'))
+    if 'form_type' not in columns:
+        conn.execute('ALTER TABLE marko_finance ADD COLUMN form_type text')
+    conn.execute('UPDATE marko_finance SET form_type = ? WHERE form_type IS NULL', (ev.sec_form_type,))
+    conn.execute('DROP INDEX IF EXISTS indx_cik_date_filed')
+    conn.execute('DROP INDEX IF EXISTS indx_cik_date_accepted')
+
+
+MIGRATIONS = {1: migrate_typed_finance, 2: migrate_form_type}
+
+
 def create_finance_table():
+    """
+    Create marko_finance and marko_difference, or migrate them from the version recorded in PRAGMA user_version.
+    All the migrations run in one transaction, so a database is never left half migrated and two processes
+    starting at once migrate it only once.
+    """
+    conn = connect_to_db()
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'marko-polo.db is at schema version {version}, this version only knows up to '
+                               f'{SCHEMA_VERSION}.')
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='marko_finance'").fetchone():
+            logger.info('Creating sqlite table marko_finance')
+            conn.execute(FINANCE_TABLE_SQL)
+            conn.execute(DIFFERENCE_TABLE_SQL)
+        else:
+            for target in range(version + 1, SCHEMA_VERSION + 1):
+                logger.info(f'Migrating marko_finance to schema version {target}.')
+                started = time.monotonic()
+                MIGRATIONS[target](conn)
+                logger.info(f'Migrated marko_finance to schema version {target} in '
+                            f'{time.monotonic() - started:.1f}s.')
+
+        for sql in FINANCE_INDEXES_SQL:
+            conn.execute(sql)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def create_master_index_tables():
+    """
+    master_index holds the filings parsed out of the quarterly EDGAR master.zip files.
+    master_index_quarters remembers which quarters have been ingested and whether they are closed.
+    """
     conn = connect_to_db()
-    cursor = conn.cursor()
-
-    sql = "SELECT name FROM sqlite_master WHERE type='table' and name='marko_finance'"
-    cursor.execute(sql)
-    results = cursor.fetchall()
-    if len(results) <= 0:
-        logger.info('Started creating sqlite table marko_finance')
-        sql = '''CREATE TABLE IF NOT EXISTS marko_finance(
-                        id integer PRIMARY KEY AUTOINCREMENT,
+    conn.execute('''CREATE TABLE IF NOT EXISTS master_index(
+                        file_name text PRIMARY KEY,
                         cik integer,
                         company_name text,
-                        ticker_symbol text, 
-                        date_filed text, 
-                        date_accepted text,
-                        prc_change text,
-                        prc_change2 text,
-                        file_name text,
-                        url text,
-                        difference_from_last_report text
-                    )'''
-        cursor.execute(sql)
-
-        sql = 'CREATE INDEX indx_cik on marko_finance(cik)'
-        conn.execute(sql)
-
-        sql = 'CREATE INDEX indx_date_accepted on marko_finance(date_accepted)'
-        conn.execute(sql)
-        logger.info('Finished creating sqlite table marko_finance')
+                        form_type text,
+                        date_filed text
+                    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS indx_master_plan on master_index(form_type, cik, date_filed, file_name)')
+    # select_pending_filings walks the filings of every form type in (cik, date_filed) order
+    conn.execute('CREATE INDEX IF NOT EXISTS indx_master_cik on master_index(cik, date_filed, file_name, form_type)')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS master_index_quarters(
+                        year integer,
+                        quarter text,
+                        form_types text,
+                        closed integer,
+                        records integer,
+                        ingested_at text,
+                        PRIMARY KEY (year, quarter, form_types)
+                    )''')
+    conn.commit()
+    conn.close()
+
+
+def form_types_key(form_types):
+    """ Quarters are ingested per set of form types.  Asking for a form type not ingested yet re-ingests them. """
+    if isinstance(form_types, str):
+        form_types = [form_types]
+    return ','.join(sorted(form_types))
+
+
+def get_ingested_quarters(form_types):
+    """
+    Closed quarters already in master_index with all of form_types.  These never change so they do not need to be
+    downloaded again.  A quarter ingested for 10-Q and 10-K covers a run that only asks for 10-Q.
+    """
+    wanted = set(form_types_key(form_types).split(','))
+    conn = connect_to_db()
+    sql = 'SELECT year, quarter, form_types FROM master_index_quarters WHERE closed=1'
+    results = conn.execute(sql).fetchall()
+    conn.close()
+    return set((year, quarter) for year, quarter, key in results if wanted <= set(key.split(',')))
+
+
+def form_type_filter(form_types):
+    """ The IN list and parameters of a query over form_types """
+    form_types = tuple(form_types)
+    return ', '.join('?' * len(form_types)), form_types
+
+
+def insert_master_index(year, quarter, closed, form_types, records):
+    conn = connect_to_db()
+    with conn:
+        conn.executemany('''INSERT OR IGNORE INTO master_index
+                                (file_name, cik, company_name, form_type, date_filed)
+                                VALUES (?, ?, ?, ?, ?)''', records)
+        conn.execute('''INSERT OR REPLACE INTO master_index_quarters
+                            (year, quarter, form_types, closed, records, ingested_at)
+                            VALUES (?, ?, ?, ?, ?, datetime('now'))''',
+                     (year, quarter, form_types_key(form_types), int(closed), len(records)))
+    conn.close()
+
+
+def insert_watched_filings(records):
+    """
+    Add the filings watch mode found in the feed to master_index.  Returns the file names that were not there yet.
+    A filing the batch run or an earlier watch already knows is not processed again.
+    """
+    conn = connect_to_db()
+    new = list()
+    with conn:
+        for record in records:
+            if conn.execute('''INSERT OR IGNORE INTO master_index
+                                   (file_name, cik, company_name, form_type, date_filed)
+                                   VALUES (?, ?, ?, ?, ?)''', record).rowcount:
+                new.append(record[0])
+    conn.close()
+    return new
+
+
+def select_pending_filings(form_types, after, limit):
+    """
+    One chunk of filings in master_index without a row in marko_finance, ordered by (cik, date_filed, file_name)
+    and starting after the given key.  The + keeps sqlite on indx_master_cik: by form type, several form types
+    would be sorted again for every chunk.
+    """
+    placeholders, form_types = form_type_filter(form_types)
+    conn = connect_to_db()
+    sql = f'''SELECT
+                 m.cik,
+                 m.company_name,
+                 m.form_type,
+                 m.date_filed,
+                 m.file_name
+             FROM
+                 master_index m
+             WHERE
+                 +m.form_type IN ({placeholders}) AND
+                 (m.cik, m.date_filed, m.file_name) > (?, ?, ?) AND
+                 NOT EXISTS (SELECT 1 FROM marko_finance f
+                             WHERE f.cik = m.cik AND f.date_filed = m.date_filed AND f.form_type = m.form_type)
+             ORDER BY
+                 m.cik,
+                 m.date_filed,
+                 m.file_name
+             LIMIT ?'''
+    results = conn.execute(sql, (*form_types, *after, limit)).fetchall()
+    conn.close()
+    return results
+
+
+def select_cik_pending_filings(form_types, cik):
+    """ The filings of one CIK that select_pending_filings would plan, in the same order """
+    placeholders, form_types = form_type_filter(form_types)
+    conn = connect_to_db()
+    sql = f'''SELECT
+                 m.cik,
+                 m.company_name,
+                 m.form_type,
+                 m.date_filed,
+                 m.file_name
+             FROM
+                 master_index m
+             WHERE
+                 m.form_type IN ({placeholders}) AND
+                 m.cik = ? AND
+                 NOT EXISTS (SELECT 1 FROM marko_finance f
+                             WHERE f.cik = m.cik AND f.date_filed = m.date_filed AND f.form_type = m.form_type)
+             ORDER BY
+                 m.date_filed,
+                 m.file_name'''
+    results = conn.execute(sql, (*form_types, cik)).fetchall()
+    conn.close()
+    return results
+
+
+def select_pending_date_ranges(form_types):
+    """ (cik, first date filed, last date filed) over the filings select_pending_filings will plan """
+    placeholders, form_types = form_type_filter(form_types)
+    conn = connect_to_db()
+    sql = f'''SELECT
+                 m.cik,
+                 MIN(m.date_filed),
+                 MAX(m.date_filed)
+             FROM
+                 master_index m
+             WHERE
+                 m.form_type IN ({placeholders}) AND
+                 NOT EXISTS (SELECT 1 FROM marko_finance f
+                             WHERE f.cik = m.cik AND f.date_filed = m.date_filed AND f.form_type = m.form_type)
+             GROUP BY
+                 m.cik'''
+    results = conn.execute(sql, form_types).fetchall()
+    conn.close()
+    return results
+
+
+def select_unpriced_reports(accepted_after: int, accepted_before: int):
+    """ (id, cik, date_accepted, form_type) of the reports accepted in [after, before) without prc_change2 """
+    conn = connect_to_db()
+    results = conn.execute('SELECT id, cik, date_accepted, form_type FROM marko_finance '
+                           'WHERE prc_change2 IS NULL AND date_accepted >= ? AND date_accepted < ?',
+                           (accepted_after, accepted_before)).fetchall()
+    conn.close()
+    return results
+
+
+def create_cik_ticker_tables():
+    """ cik_ticker keeps the SEC and custom CIK -> ticker mappings.  app_metadata remembers when SEC was asked. """
+    conn = connect_to_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS cik_ticker(
+                        cik text,
+                        ticker text,
+                        source text,
+                        PRIMARY KEY (cik, source)
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS app_metadata(
+                        key text PRIMARY KEY,
+                        value text
+                    )''')
+    conn.commit()
+    conn.close()
+
+
+DIFFERENCE_ROWS_SQL = '''SELECT
+                             f.id,
+                             f.cik,
+                             f.file_name,
+                             f.date_accepted,
+                             f.form_type,
+                             EXISTS (SELECT 1 FROM marko_difference d WHERE d.id = f.id),
+                             f.prc_change2
+                         FROM
+                             marko_finance f
+                         {where}
+                         ORDER BY
+                             f.cik,
+                             f.date_accepted'''
+
+
+def select_report_id(cik, file_name: str):
+    conn = connect_to_db()
+    row = conn.execute('SELECT MAX(id) FROM marko_finance WHERE cik = ? AND file_name = ?', (cik, file_name)).fetchone()
+    conn.close()
+    return row[0]
+
+
+def select_previous_report(cik, date_accepted: int, form_types):
+    """ (file_name, date_accepted) of the last report of one of form_types of cik accepted before date_accepted """
+    placeholders, form_types = form_type_filter(form_types)
+    conn = connect_to_db()
+    row = conn.execute(f'SELECT file_name, date_accepted FROM marko_finance WHERE cik = ? AND date_accepted < ? AND '
+                       f'form_type IN ({placeholders}) ORDER BY date_accepted DESC LIMIT 1',
+                       (cik, date_accepted, *form_types)).fetchone()
+    conn.close()
+    return row
+
+
+def select_difference_rows(cik=None):
+    """
+    (id, cik, file_name, date accepted in epoch seconds, form_type, has a difference, prc_change2) of every
+    report, or every report of one CIK, in the order differences.plan_differences expects.  Answered from
+    indx_cik_date_accepted and the primary key of marko_difference alone.
+    """
+    conn = connect_to_db()
+    if cik is None:
+        results = conn.execute(DIFFERENCE_ROWS_SQL.format(where='')).fetchall()
+    else:
+        results = conn.execute(DIFFERENCE_ROWS_SQL.format(where='WHERE f.cik = ?'), (cik,)).fetchall()
     conn.close()
+    return results
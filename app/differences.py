@@ -1,46 +1,49 @@
-import os
 import db
-from datetime import datetime
 import logging
-from config import Environment
-from fuzzywuzzy import process, fuzz
-import nltk
-import multiprocessing
-
-ev = Environment()
+from config import get_environment
+from artifacts import load_artifact, artifact_name
+from store import get_store
+from workers import shared_pool
+from work_queue import WorkQueue
+import boilerplate
+import metrics
+
+ev = get_environment()
 logger = logging.getLogger(ev.app_name)
 
-# nltk punkt sentence trainer.
-nltk.download('punkt')
-detector = nltk.data.load('tokenizers/punkt/english.pickle')
-
 
 def create_diff(data_dict):
+    """
+    Find the sentences of the current report that are not in the last report.  Runs in the pool.
+    Returns (record id, new sentences) for the database writer, or None when nothing is new.
+    """
     current_report_file = data_dict['current_file']
     last_report_file = data_dict['old_file']
     record_id = data_dict['id']
 
-    with open(os.path.join(ev.output_cleaned_files, current_report_file)) as current_report:
-        current_report_list = current_report.read().splitlines()
+    # Both reports and their artifacts in one index lookup
+    records = get_store().get_many([current_report_file, last_report_file,
+                                    artifact_name(current_report_file), artifact_name(last_report_file)])
+    current_report_text = records[current_report_file].decode('utf-8')
+    last_report_text = records[last_report_file].decode('utf-8')
 
-    with open(os.path.join(ev.output_cleaned_files, last_report_file)) as current_report:
-        last_report_list = current_report.read().splitlines()
+    # Sentence boundaries and line hashes were computed when the files were cleaned.
+    current_artifact = load_artifact(current_report_file, current_report_text,
+                                     records.get(artifact_name(current_report_file)))
+    last_artifact = load_artifact(last_report_file, last_report_text, records.get(artifact_name(last_report_file)))
 
-    # remove exact lines from each other
-    current_report_dedup_list = [line for line in current_report_list if line not in last_report_list]
-    last_report_dedup_list = [line for line in last_report_list if line not in current_report_list]
-
-    # list of sentences in each file
-    current_report_sentences = list(detector.tokenize(' '.join(current_report_dedup_list).strip()))
-    last_report_sentences = list(detector.tokenize(' '.join(last_report_dedup_list).strip()))
+    # remove exact lines and sentences from each other, and the boilerplate every company files each quarter
+    common = boilerplate.dictionary()
+    current_report_sentences = current_artifact.unique_sentences(current_report_text, last_artifact, common)
+    last_report_sentences = last_artifact.unique_sentences(last_report_text, current_artifact, common)
 
     # for each new sentence in the report look to see if we have a fuzzy match of 85% of better against any
     # sentence in the older report.  If not consider it a new sentence.
-    new_sentences = list()
-    for sentence in current_report_sentences:
-        match = process.extractOne(sentence, last_report_sentences, score_cutoff=85, scorer=fuzz.QRatio)
-        if match is None:
-            new_sentences.append(sentence)
+    # Imported here so only the diff stage pays for fuzzywuzzy
+    from matcher import find_new_sentences
+    with metrics.timed('diff_match'):
+        new_sentences = find_new_sentences(current_report_sentences, last_report_sentences)
+    metrics.count('sentences', 'diff_match', len(current_report_sentences))
 
     if new_sentences:
         new_sentence = '\n'.join(new_sentences)
@@ -49,62 +52,116 @@ def create_diff(data_dict):
         if len(new_sentence) > 60000:
             new_sentence = new_sentence[:59999]
 
-        conn = db.connect_to_db()
-        cursor = conn.cursor()
-        sql = 'UPDATE marko_finance SET difference_from_last_report=? WHERE id=?'
-        cursor.execute(sql, (new_sentence, record_id))
-        conn.commit()
-        conn.close()
-        logger.info(f'Difference logged between {current_report_file} and {last_report_file}')
-    return
+        logger.info('Difference found between %s and %s', current_report_file, last_report_file)
+        return record_id, new_sentence
+    return None
 
 
-def get_differences():
-    logger.info(f'Started processing differences.')
+# Form type -> (form types of the report it is diffed against, fewest and most weeks from that report to it).
+# The first 10-Q of a fiscal year follows the 10-K, not the third quarter's 10-Q.
+PAIRINGS = {
+    '10-Q': (('10-Q', '10-K'), 9, 17),
+    '10-K': (('10-K',), 48, 56),
+}
+
+
+def pairing(form_type: str):
+    """ PAIRINGS of form_type.  An amendment is diffed against the report it amends, other forms like with like """
+    if form_type in PAIRINGS:
+        return PAIRINGS[form_type]
+    if form_type.endswith('/A'):
+        return (form_type[:-2],), 0, 53
+    return (form_type,), 9, 17
 
-    conn = db.connect_to_db()
-    sql = '''SELECT 
-                id, 
-                cik, 
-                file_name, 
-                date_accepted, 
-                difference_from_last_report,
-                prc_change2 
-            FROM 
-                marko_finance 
-            ORDER BY 
-                cik, 
-                date_accepted'''
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    results = cursor.fetchall()
 
+def consecutive(old_accepted: int, new_accepted: int, form_type='10-Q'):
+    """
+    The report of form_type (accepted, epoch seconds) follows the other one: 9 to 17 weeks later for a 10-Q,
+    counted in whole days.
+    """
+    _, fewest, most = pairing(form_type)
+    week_difference = ((new_accepted - old_accepted) // 86400) / 7
+    return fewest <= week_difference <= most
+
+
+def plan_differences(results):
+    """
+    Pair each report with the last report of the same CIK before it that pairing allows, when the two are
+    consecutive and the newer one has a price change but no difference yet.  results are rows of
+    select_difference_rows, ordered by cik and date_accepted.
+    """
     old_cik = None
-    old_date = None
-    old_filename = None
+    # form type -> (date accepted, file name) of the last report of old_cik of that form
+    last_reports = dict()
 
-    find_differences_list = list()
     for record in results:
-        (record_id, cik, filename, date_accepted, difference, prc_change) = record
-        converted_date = datetime.strptime(date_accepted, '%Y-%m-%d %H:%M:%S')
-
-        if prc_change and difference is None and cik == old_cik:
-            week_difference = (converted_date - old_date).days / 7
-            if 9 <= week_difference <= 17:
-                find_differences_list.append({
-                    'id': record_id,
-                    'cik': cik,
-                    'current_file': filename,
-                    'old_file': old_filename
-                })
-        old_cik = cik
-        old_date = converted_date
-        old_filename = filename
-    conn.close()
-
-    with multiprocessing.Pool(processes=ev.number_of_cores) as pool:
-        pool.map(create_diff, find_differences_list)
-    pool.close()
-    pool.join()
+        (record_id, cik, filename, date_accepted, form_type, has_difference, prc_change) = record
+        if cik != old_cik:
+            old_cik = cik
+            last_reports = dict()
+
+        previous_forms, _, _ = pairing(form_type)
+        previous = max((last_reports[previous_form] for previous_form in previous_forms
+                        if previous_form in last_reports), default=None)
+        if (prc_change is not None and not has_difference and previous is not None
+                and consecutive(previous[0], date_accepted, form_type)):
+            yield {
+                'id': record_id,
+                'cik': cik,
+                'current_file': filename,
+                'old_file': previous[1]
+            }
+        last_reports[form_type] = (date_accepted, filename)
+
+
+def add_sizes(find_differences_list):
+    """ Size of a diff is the size of both reports, so the biggest ones can be started first """
+    names = set()
+    for data_dict in find_differences_list:
+        names.update((data_dict['current_file'], data_dict['old_file']))
+    sizes = get_store().sizes(names)
+    for data_dict in find_differences_list:
+        data_dict['size'] = sizes.get(data_dict['current_file'], 0) + sizes.get(data_dict['old_file'], 0)
+    return find_differences_list
+
+
+def get_differences():
+    """
+    Plan every missing difference into the 'diff' work queue, then work through the queue.  Any number of
+    processes sharing the database can run this at once.  Each claims a batch, diffs it, commits the results and
+    only then completes the batch, so a crash leaves the batch to the next claimer once its lease runs out.
+    A diff that found nothing new is done and not planned again.
+    """
+    logger.info(f'Started processing differences.')
 
+    if ev.boilerplate:
+        boilerplate.update_dictionary()
+
+    work = WorkQueue('diff')
+    find_differences_list = add_sizes(list(plan_differences(db.select_difference_rows())))
+    work.enqueue((data_dict['id'], data_dict, data_dict['size']) for data_dict in find_differences_list)
+
+    # Workers only compute.  Every UPDATE goes through the one database writer, as the diffs finish.
+    with shared_pool() as pool, db.BatchWriter() as writer, work:
+        diff = metrics.Instrumented(create_diff)
+        while True:
+            claimed = work.claim(pool.processes * 8)
+            if not claimed:
+                break
+            failed = set()
+
+            def fail(data_dict, error):
+                key = str(data_dict['id'])
+                failed.add(key)
+                work.fail(key, error)
+
+            for result in pool.imap_unordered(diff, [data_dict for _, data_dict in claimed],
+                                              size=lambda data_dict: data_dict['size'], failed=fail):
+                result = metrics.unwrap(result)
+                if result:
+                    writer.update_difference(*result)
+            writer.flush()
+            work.complete([key for key, _ in claimed if key not in failed])
+
+    boilerplate.report()
     logger.info(f'Finished processing differences.')
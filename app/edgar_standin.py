@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import mimetypes
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger('marko-polo')
+
+
+class StandIn:
+    """
+    Local stand-in for www.sec.gov serving a recorded corpus.  A request for /Archives/edgar/... is answered
+    with <root>/Archives/edgar/..., so a corpus is just the SEC url layout on disk.
+
+    latency         seconds added to every response, plus up to jitter seconds more
+    throttle_every  every Nth request is answered with 429 and Retry-After, like SEC fair access does
+    missing         paths that do not exist answer 404
+
+    publish() serves a document from memory instead, for feeds that change while a test runs.
+
+    Random jitter is seeded so two runs see the same delays in the same order.
+
+        with StandIn('corpus', latency=0.05, throttle_every=20) as edgar:
+            os.environ['SEC_WEBSITE'] = edgar.url
+    """
+
+    def __init__(self, root: str, latency=0.0, jitter=0.0, throttle_every=0, retry_after='0', seed=1, port=0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.published = dict()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='edgar-standin', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_request(self):
+        """ (delay, throttle) for the next request """
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.random.random() * self.jitter
+            throttle = bool(self.throttle_every) and self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+        return delay, throttle
+
+    def publish(self, path: str, content, content_type='application/atom+xml'):
+        """ Answer requests for path, whatever their query string, with content """
+        with self.lock:
+            self.published[path] = (content.encode('utf-8') if isinstance(content, str) else content, content_type)
+
+    def resolve(self, path: str):
+        """ The corpus file of a url path, following /ix?doc= links to the document itself """
+        url = urlsplit(path)
+        if url.path == '/ix':
+            path = parse_qs(url.query).get('doc', [''])[0]
+        else:
+            path = url.path
+        file_path = os.path.abspath(os.path.join(self.root, path.lstrip('/')))
+        if not file_path.startswith(self.root + os.sep) or not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    def handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                delay, throttle = standin.next_request()
+                if delay:
+                    time.sleep(delay)
+
+                if throttle:
+                    self.send_response(429)
+                    self.send_header('Retry-After', standin.retry_after)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                with standin.lock:
+                    published = standin.published.get(urlsplit(self.path).path)
+                if published:
+                    body, content_type = published
+                else:
+                    file_path = standin.resolve(self.path)
+                    if file_path is None:
+                        self.send_error(404)
+                        return
+
+                    with open(file_path, 'rb') as corpus_file:
+                        body = corpus_file.read()
+                    content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+                if content_type.startswith(('text/', 'application/atom')):
+                    content_type += '; charset=utf-8'
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client read what it needed and hung up
+                    return
+                with standin.lock:
+                    standin.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f'Stand-in: {format % args}')
+
+        return Handler
+
+
+if __name__ == '__main__':
+    # python edgar_standin.py <corpus folder> [port] [latency] [throttle every]
+    logging.basicConfig(level=logging.DEBUG)
+    server = StandIn(sys.argv[1], port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000,
+                     latency=float(sys.argv[3]) if len(sys.argv) > 3 else 0.0,
+                     throttle_every=int(sys.argv[4]) if len(sys.argv) > 4 else 0)
+    print(f'Serving {server.root} on {server.url}')
+    server.server.serve_forever()
@@ -0,0 +1,248 @@
+import os
+import csv
+import gzip
+import json
+import logging
+from bisect import bisect_left
+from datetime import datetime
+
+from config import get_environment
+import db
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+QUINTILES = 5
+
+TRAINING_DATA_SQL = '''SELECT
+                           f.id,
+                           d.difference,
+                           f.prc_change2
+                       FROM
+                           marko_finance f
+                           JOIN marko_difference d ON d.id = f.id
+                       WHERE
+                           f.id > ? AND
+                           f.prc_change2 IS NOT NULL
+                           {pending}
+                       ORDER BY
+                           f.id
+                       LIMIT ?'''
+
+EDGES_SQL = '''SELECT prc_change2 FROM marko_finance f
+               WHERE prc_change2 IS NOT NULL AND EXISTS (SELECT 1 FROM marko_difference d WHERE d.id = f.id)'''
+
+NOT_EXPORTED = 'AND NOT EXISTS (SELECT 1 FROM exported_rows e WHERE e.name = ? AND e.id = f.id)'
+
+
+def create_export_tables():
+    conn = db.connect_to_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS export_state(
+                        name text PRIMARY KEY,
+                        edges text,
+                        exported_at text
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS exported_rows(
+                        name text,
+                        id integer,
+                        PRIMARY KEY (name, id)
+                    )''')
+    conn.commit()
+    conn.close()
+
+
+def quantile(values, q: float):
+    """ Linear interpolation between the closest ranks, numpy's (and so pandas.qcut's) default """
+    position = q * (len(values) - 1)
+    below = int(position)
+    above = min(below + 1, len(values) - 1)
+    return values[below] + (values[above] - values[below]) * (position - below)
+
+
+def quintile_edges():
+    """
+    The bin edges pandas.qcut(prc_change2, 5) would use, from one pass over prc_change2 alone.
+    Only the floats are held in memory, never the difference text.
+    """
+    conn = db.connect_to_db()
+    values = sorted(row[0] for row in conn.execute(EDGES_SQL))
+    conn.close()
+    if not values:
+        return None
+    edges = [quantile(values, i / QUINTILES) for i in range(QUINTILES + 1)]
+    if len(set(edges)) != len(edges):
+        raise ValueError(f'Bin edges must be unique: {edges}')
+    return edges
+
+
+def quintile(edges, value: float):
+    """ qcut's label: bins are (low, high], the first one also includes the lowest value """
+    return bisect_left(edges, value, 1, QUINTILES) - 1
+
+
+class ShardWriter:
+    """
+    Writes rows to <folder>/<prefix>-<run>-<shard>.<format>[.gz], starting a new shard every shard_rows rows.
+
+    Each shard is written to a .tmp file and renamed when it is complete, and the ids in it are recorded in
+    exported_rows only then.  A run that dies halfway never leaves a partial shard or loses rows for the next
+    incremental export.
+    """
+
+    def __init__(self, folder: str, prefix: str, export_format: str, compress: bool, shard_rows: int):
+        self.folder = folder
+        self.name = prefix
+        self.prefix = f'{prefix}-{datetime.now().strftime("%Y%m%dT%H%M%S")}'
+        self.export_format = export_format
+        self.compress = compress
+        self.shard_rows = shard_rows
+        self.shard = 0
+        self.rows = 0
+        self.ids = list()
+        self.path = None
+        self.file = None
+        self.writer = None
+        self.shards = list()
+        os.makedirs(folder, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        elif self.file:
+            self.file.close()
+            os.remove(self.path + '.tmp')
+
+    def open(self):
+        extension = {'csv': 'csv', 'jsonl': 'jsonl', 'parquet': 'parquet'}[self.export_format]
+        if self.compress and self.export_format != 'parquet':
+            extension += '.gz'
+        self.path = os.path.join(self.folder, f'{self.prefix}-{self.shard:05d}.{extension}')
+        # Two exports within the same second
+        while os.path.exists(self.path):
+            self.shard += 1
+            self.path = os.path.join(self.folder, f'{self.prefix}-{self.shard:05d}.{extension}')
+
+        if self.export_format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            schema = pyarrow.schema([('differ', pyarrow.string()), ('prc_change2', pyarrow.int8())])
+            self.file = pyarrow.parquet.ParquetWriter(self.path + '.tmp', schema,
+                                                      compression='gzip' if self.compress else 'snappy')
+            return
+        if self.compress:
+            self.file = gzip.open(self.path + '.tmp', 'wt', encoding='utf-8', newline='')
+        else:
+            self.file = open(self.path + '.tmp', 'w', encoding='utf-8', newline='')
+        if self.export_format == 'csv':
+            self.writer = csv.writer(self.file, lineterminator='\n')
+
+    def write(self, rows):
+        """ rows are (id, differ, label) """
+        while rows:
+            if self.file is None:
+                self.open()
+            take = rows[:self.shard_rows - self.rows]
+            rows = rows[len(take):]
+
+            if self.export_format == 'csv':
+                self.writer.writerows((differ, label) for _, differ, label in take)
+            elif self.export_format == 'jsonl':
+                self.file.writelines(json.dumps({'differ': differ, 'prc_change2': label}) + '\n'
+                                     for _, differ, label in take)
+            else:
+                import pyarrow
+                self.file.write_table(pyarrow.table({'differ': [differ for _, differ, _ in take],
+                                                     'prc_change2': [label for _, _, label in take]},
+                                                    schema=self.file.schema))
+            self.ids.extend(row_id for row_id, _, _ in take)
+            self.rows += len(take)
+            if self.rows >= self.shard_rows:
+                self.close_shard()
+
+    def close_shard(self):
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+        conn = db.connect_to_db()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO exported_rows (name, id) VALUES (?, ?)',
+                             ((self.name, row_id) for row_id in self.ids))
+        conn.close()
+        logger.info(f'Wrote {self.rows} row(s) to {self.path}.')
+        self.shards.append(self.path)
+        self.shard += 1
+        self.rows = 0
+        self.ids = list()
+        self.file = None
+        self.writer = None
+
+    def finish(self):
+        if self.file is not None:
+            self.close_shard()
+
+
+def remove_shards(folder: str, prefix: str):
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name.startswith(prefix + '-'):
+            os.remove(os.path.join(folder, name))
+
+
+def export_training_data(incremental=None, name='training_data'):
+    """
+    Stream the reports with a difference and a price change into training data shards: the difference text with
+    line breaks flattened, and the quintile (0 - 4) of prc_change2.
+
+    Rows are read EXPORT_CHUNK_ROWS at a time by id, so memory does not grow with the history.  A full export
+    replaces the previous shards and computes the quintile edges.  An incremental export only appends the rows
+    not exported yet, labelled with the edges of the last full export so every shard uses the same bins.
+    """
+    incremental = ev.export_incremental if incremental is None else incremental
+    create_export_tables()
+    conn = db.connect_to_db()
+    state = conn.execute('SELECT edges FROM export_state WHERE name=?', (name,)).fetchone()
+    conn.close()
+
+    if incremental and state:
+        edges = json.loads(state[0])
+    else:
+        incremental = False
+        edges = quintile_edges()
+        if edges is None:
+            logger.info('No training data to export.')
+            return list()
+        remove_shards(ev.export_folder, name)
+        conn = db.connect_to_db()
+        with conn:
+            conn.execute('DELETE FROM exported_rows WHERE name=?', (name,))
+            conn.execute('INSERT OR REPLACE INTO export_state (name, edges, exported_at) VALUES (?, ?, ?)',
+                         (name, json.dumps(edges), datetime.now().isoformat()))
+        conn.close()
+
+    logger.info(f'Started {"incremental" if incremental else "full"} export of training data. Edges: {edges}')
+    sql = TRAINING_DATA_SQL.format(pending=NOT_EXPORTED if incremental else '')
+    pending = (name,) if incremental else ()
+    last_id = -1
+    exported = 0
+    with ShardWriter(ev.export_folder, name, ev.export_format, ev.export_compress, ev.export_shard_rows) as writer:
+        while True:
+            conn = db.connect_to_db()
+            chunk = conn.execute(sql, (last_id,) + pending + (ev.export_chunk_rows,)).fetchall()
+            conn.close()
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            writer.write([(row_id, db.decompress_difference(differ).replace('\r', ' ').replace('\n', ' '),
+                           quintile(edges, prc_change)) for row_id, differ, prc_change in chunk])
+            exported += len(chunk)
+
+    if incremental:
+        conn = db.connect_to_db()
+        with conn:
+            conn.execute('UPDATE export_state SET exported_at=? WHERE name=?', (datetime.now().isoformat(), name))
+        conn.close()
+    logger.info(f'Finished export of {exported} row(s) into {len(writer.shards)} shard(s) in {ev.export_folder}.')
+    return writer.shards
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import random
+import time
+import urllib.request
+from collections import namedtuple
+from urllib.error import HTTPError
+
+from config import get_environment
+from cache import HttpCache, is_immutable
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# SEC answers with these when we go over the fair access limit or it is overloaded.  Both are worth retrying.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+FetchResult = namedtuple('FetchResult', ['url', 'status', 'body', 'headers'])
+
+
+def decode_body(result: FetchResult, default_encoding='ISO-8859-1'):
+    """
+    Decode a response body the same way requests does.  Use the charset from the Content-Type header and
+    fall back to ISO-8859-1 for text responses that do not declare one.
+    """
+    content_type = result.headers.get('Content-Type', '') if result.headers else ''
+    encoding = default_encoding
+    for part in content_type.split(';')[1:]:
+        key, _, value = part.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            encoding = value.strip('"\'')
+    try:
+        return result.body.decode(encoding, errors='replace')
+    except LookupError:
+        return result.body.decode(default_encoding, errors='replace')
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every coroutine that talks to the SEC.  Every request, no matter which filing it
+    belongs to, takes a token so the combined request rate stays under sec_requests_per_second.
+
+    When the SEC pushes back (429 / 503) the whole bucket is paused, not just the request that got the error.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Fetcher:
+    """
+    Asyncio HTTP client for EDGAR.
+
+    One Fetcher holds one pool of keep-alive connections and one RateLimiter, so it should be shared by all
+    the work of a run.  Use it as an async context manager:
+
+        async with Fetcher() as fetcher:
+            result = await fetcher.get(url)
+    """
+
+    def __init__(self, requests_per_second=None, concurrency=None, timeout=None, max_retries=None, cache=None):
+        self.requests_per_second = requests_per_second or ev.sec_requests_per_second
+        self.concurrency = concurrency or ev.sec_fetch_concurrency
+        self.timeout = timeout or ev.sec_http_timeout
+        self.max_retries = ev.sec_max_retries if max_retries is None else max_retries
+        self.cache = cache
+        self.owns_cache = False
+        self.limiter = None
+        self.session = None
+
+    async def __aenter__(self):
+        if self.cache is None and ev.http_cache:
+            self.cache = HttpCache()
+            self.owns_cache = True
+
+        import aiohttp
+        # Created here and not in __init__ so the lock and session bind to the running event loop.
+        self.limiter = RateLimiter(self.requests_per_second)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency,
+                                         ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={'User-Agent': ev.sec_user_agent, 'Accept-Encoding': 'gzip, deflate'}
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        if self.owns_cache:
+            self.cache.close()
+
+    def retry_delay(self, attempt: int, retry_after=None):
+        """ Honor Retry-After when the SEC sends it, otherwise exponential backoff with jitter """
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(60.0, (2 ** attempt) + random.random())
+
+    async def get(self, url: str, immutable=None, until=None):
+        """
+        GET a url.  Returns a FetchResult or None when the url does not exist or we gave up retrying.
+
+        Immutable urls (filed documents by default) are answered straight from the cache.  Mutable ones are
+        revalidated with a conditional GET.  In offline mode only the cache is used.
+
+        With until(body, start) the body is streamed and the download stops as soon as until returns True, start
+        being where the newest chunk begins.  Such a partial body is cached apart from the full one.
+        """
+        with metrics.timed('sec_fetch'):
+            result = await self.fetch(url, immutable, until)
+        if result is None:
+            metrics.count('misses', 'sec_fetch')
+        else:
+            metrics.add_bytes('sec_fetch', 'in', len(result.body))
+        return result
+
+    async def fetch(self, url: str, immutable=None, until=None):
+        import aiohttp
+        if immutable is None:
+            immutable = is_immutable(url)
+        cache_key = url if until is None else url + '#partial'
+
+        loop = asyncio.get_event_loop()
+        entry = None
+        headers = None
+        if self.cache:
+            entry = await loop.run_in_executor(None, self.cache.get, cache_key)
+            if entry and (immutable or ev.sec_offline):
+                metrics.count('cache_hits', 'sec_fetch')
+                return FetchResult(url, 200, entry.body, entry.headers)
+            if entry:
+                headers = self.cache.conditional_headers(entry)
+
+        if ev.sec_offline:
+            logger.error(f'Offline and {url} is not in the cache.')
+            return None
+
+        for attempt in range(self.max_retries + 1):
+            with metrics.timed('sec_rate_limit'):
+                await self.limiter.acquire()
+            if attempt:
+                metrics.count('retries', 'sec_fetch')
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304 and entry:
+                        metrics.count('not_modified', 'sec_fetch')
+                        self.cache.touch(cache_key)
+                        return FetchResult(url, 200, entry.body, entry.headers)
+
+                    if response.status in RETRY_STATUSES:
+                        metrics.count(f'status_{response.status}', 'sec_fetch')
+                        delay = self.retry_delay(attempt, response.headers.get('Retry-After'))
+                        logger.warning(f'SEC returned {response.status} for {url}.  '
+                                       f'Backing off {delay:.1f} seconds. Attempt {attempt + 1}')
+                        self.limiter.pause(delay)
+                        continue
+
+                    if response.status == 404:
+                        logger.error(f'Could not find {url}.')
+                        return None
+
+                    response.raise_for_status()
+                    body = await response.read() if until is None else await read_until(response, until)
+                    if self.cache:
+                        await loop.run_in_executor(None, self.cache.put, cache_key, body, response.headers)
+                    return FetchResult(url, response.status, body, response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                # A 403 (undeclared automated tool) or another 4xx will not change by asking again
+                if isinstance(error, aiohttp.ClientResponseError) and error.status not in RETRY_STATUSES:
+                    metrics.count(f'status_{error.status}', 'sec_fetch')
+                    logger.error(f'SEC returned {error.status} for {url}.  Not retrying.')
+                    return None
+                metrics.count('network_errors', 'sec_fetch')
+                delay = self.retry_delay(attempt)
+                logger.warning(f'Encountered an error retrieving {url}.  Retrying in {delay:.1f} seconds. '
+                               f'Error: {error!r}')
+                await asyncio.sleep(delay)
+
+        logger.error(f'Gave up retrieving {url} after {self.max_retries + 1} attempts.')
+        return None
+
+
+async def read_until(response, until, chunk_size=65536):
+    """ Stream a body until until(body, start) has seen enough.  The rest of it is never downloaded. """
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        start = len(body)
+        body += chunk
+        if until(body, start):
+            metrics.count('cut_short', 'sec_fetch')
+            break
+    return bytes(body)
+
+
+def fetch_url(url: str, immutable=None, cache=None):
+    """
+    Blocking GET through the http cache, for the few places that do not run on the event loop.
+    Returns a FetchResult or None when the url does not exist.
+    """
+    if immutable is None:
+        immutable = is_immutable(url)
+
+    entry = cache.get(url) if cache else None
+    if entry and (immutable or ev.sec_offline):
+        return FetchResult(url, 200, entry.body, entry.headers)
+    if ev.sec_offline:
+        logger.error(f'Offline and {url} is not in the cache.')
+        return None
+
+    request = urllib.request.Request(url, headers={'User-Agent': ev.sec_user_agent})
+    if entry:
+        for name, value in cache.conditional_headers(entry).items():
+            request.add_header(name, value)
+
+    try:
+        with metrics.timed('sec_fetch_sync'), urllib.request.urlopen(request, timeout=ev.sec_http_timeout) as response:
+            body = response.read()
+            headers = dict(response.headers.items())
+        metrics.add_bytes('sec_fetch_sync', 'in', len(body))
+    except HTTPError as http_error:
+        if http_error.code == 304 and entry:
+            cache.touch(url)
+            return FetchResult(url, 200, entry.body, entry.headers)
+        if http_error.code == 404:
+            return None
+        raise
+
+    if cache:
+        cache.put(url, body, headers)
+    return FetchResult(url, 200, body, headers)
+
+
+async def drain(items, worker, concurrency: int):
+    """
+    Run worker(item) for every item with at most `concurrency` running at once.
+
+    Items are pulled lazily from the iterable so a large work list never has to be turned into tasks up front.
+    """
+    iterator = iter(items)
+
+    async def consume():
+        for item in iterator:
+            try:
+                await worker(item)
+            except Exception as error:
+                logger.exception(f'Encountered an exception processing {item}: {error}')
+
+    await asyncio.gather(*(consume() for _ in range(max(concurrency, 1))))
+
+
+def run_in_pool(pool, func, *args, size=0):
+    """
+    Submit func(*args) to a workers.WorkerPool and return an asyncio future for the result.
+    This lets the event loop keep downloading while the CPU pool cleans.  The worker's metrics come back
+    with the result and are merged into this process.  size (bytes of the document) orders the work and
+    bounds the memory in flight.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def set_exception(error):
+        if not future.done():
+            future.set_exception(error)
+
+    pool.apply_async(metrics.Instrumented(func), args,
+                     callback=lambda result: loop.call_soon_threadsafe(set_result, metrics.unwrap(result)),
+                     error_callback=lambda error: loop.call_soon_threadsafe(set_exception, error),
+                     size=size)
+    return future
@@ -1,11 +1,14 @@
 from datetime import datetime, timedelta
-import yfinance as yf
+from prices import PriceStore
 import logging
-import requests
 import os
-from config import Environment
+from functools import lru_cache
+from config import get_environment
+from fetch import fetch_url, decode_body
+from cache import HttpCache
+import db
 
-ev = Environment()
+ev = get_environment()
 logger = logging.getLogger(ev.app_name)
 
 
@@ -17,35 +20,98 @@ def price_rate_change(price1, price2):
     return round((price1 - price2) / price2, 5)
 
 
-def generate_cik_to_ticker_dict():
+def download_cik_to_ticker():
     """
-    Download the ticker.txt file from SEC.
+    Download the ticker.txt file from SEC.  Returns (cik, ticker) pairs in file order.
+    Revalidated through the http cache so an unchanged file is not downloaded again.
     """
-    cik_to_ticker_dict = dict()
     logger.info(f'Getting ticker / cik map from {ev.sec_ticker_url}.')
-    ticker = requests.get(ev.sec_ticker_url)
-    lines = ticker.text.splitlines()
-    for line in lines:
-        (ticker_symbol, cik) = line.split('\t')
-        if cik in cik_to_ticker_dict:
-            logger.debug(f'CIK {cik} is already mapped to {cik_to_ticker_dict[cik]}.  Not mapping to {ticker_symbol}')
-        else:
-            cik_to_ticker_dict[cik] = ticker_symbol
-
+    cache = HttpCache() if ev.http_cache else None
+    try:
+        response = fetch_url(ev.sec_ticker_url, immutable=False, cache=cache)
+    finally:
+        if cache:
+            cache.close()
+    if response is None:
+        raise RuntimeError(f'Could not retrieve {ev.sec_ticker_url}')
+
+    pairs = list()
+    for line in decode_body(response, 'utf-8').splitlines():
+        if '\t' in line:
+            (ticker_symbol, cik) = line.split('\t')
+            pairs.append((cik, ticker_symbol))
+    return pairs
+
+
+def read_custom_cik_to_ticker():
+    """ Our own mappings from input/cik_to_ticker.txt.  Format is CIK TICKER """
+    pairs = list()
     with open(os.path.join(ev.dir_path, 'input', 'cik_to_ticker.txt')) as cik_input:
         for line in cik_input:
             if not line.startswith('#') and len(line) > 5:
                 cik, ticker_symbol = line.strip().split(' ')
                 if cik and ticker_symbol:
-                    # Allow custom ticker to override SEC one.  SEC does not seem up to date.
-                    cik_to_ticker_dict[cik] = ticker_symbol
-    return cik_to_ticker_dict
+                    pairs.append((cik, ticker_symbol))
+    return pairs
+
+
+def refresh_cik_to_ticker():
+    """
+    Refresh the cik_ticker table.  The SEC map is downloaded again once it is older than
+    sec_ticker_refresh_hours.  The custom mappings are cheap and reloaded every time.
+    """
+    conn = db.connect_to_db()
+    row = conn.execute("SELECT value FROM app_metadata WHERE key='cik_ticker_refreshed_at'").fetchone()
+    refreshed_at = datetime.fromisoformat(row[0]) if row else None
+
+    if refreshed_at is None or datetime.now() - refreshed_at > timedelta(hours=ev.sec_ticker_refresh_hours):
+        try:
+            pairs = download_cik_to_ticker()
+            with conn:
+                conn.execute("DELETE FROM cik_ticker WHERE source='sec'")
+                # The first ticker listed for a CIK wins
+                conn.executemany("INSERT OR IGNORE INTO cik_ticker (cik, ticker, source) VALUES (?, ?, 'sec')", pairs)
+                conn.execute("INSERT OR REPLACE INTO app_metadata (key, value) VALUES ('cik_ticker_refreshed_at', ?)",
+                             (datetime.now().isoformat(),))
+        except Exception as e:
+            if refreshed_at is None:
+                raise
+            logger.error(f'Could not refresh ticker / cik map, using the one from {refreshed_at}. Error: {e}')
+
+    with conn:
+        conn.execute("DELETE FROM cik_ticker WHERE source='custom'")
+        conn.executemany("INSERT OR REPLACE INTO cik_ticker (cik, ticker, source) VALUES (?, ?, 'custom')",
+                         read_custom_cik_to_ticker())
+    conn.close()
+
+
+def generate_cik_to_ticker_dict():
+    """
+    CIK -> ticker symbol dict from the cik_ticker table, refreshing the table first if needed.
+    """
+    refresh_cik_to_ticker()
+    get_cik_to_ticker_dict.cache_clear()
+    return get_cik_to_ticker_dict()
+
+
+def load_cik_to_ticker_dict():
+    """ Read the cik_ticker table.  Custom mappings override SEC ones.  SEC does not seem up to date. """
+    conn = db.connect_to_db()
+    rows = conn.execute("SELECT cik, ticker FROM cik_ticker ORDER BY source='custom'").fetchall()
+    conn.close()
+    return dict(rows)
+
+
+@lru_cache(maxsize=None)
+def get_cik_to_ticker_dict():
+    """ The map for this process, read from sqlite once.  Nothing has to be pickled to pool workers. """
+    return load_cik_to_ticker_dict()
 
 
-def get_financial(data_dict, cik_to_ticker_dict):
+def get_financial(data_dict, cik_to_ticker_dict, prices: PriceStore):
     """
-    This will pull financial data from Yahoo.  If the report is on a Friday then we will not
-    process the data as too many things can happen over the weekend which could influence the stock.
+    This will pull financial data from the price store (Yahoo by default).  If the report is on a Friday then we
+    will not process the data as too many things can happen over the weekend which could influence the stock.
 
     Best days to gather data is Monday, Tuesday, Wednesday (with no holidays).
     """
@@ -56,53 +122,54 @@ def get_financial(data_dict, cik_to_ticker_dict):
     try:
         ticker_symbol = cik_to_ticker_dict[cik]
         data_dict['ticker_symbol'] = ticker_symbol
-        logger.debug(f'CIK: {cik_log} Ticker symbol is {ticker_symbol}.')
+        logger.debug('CIK: %s Ticker symbol is %s.', cik_log, ticker_symbol)
     except KeyError:
-        logger.error(f'CIK: {cik_log} Could not find {cik} in ticker feed.')
+        logger.error('CIK: %s Could not find %s in ticker feed.', cik_log, cik)
         return data_dict
 
     accepted_date = datetime.strptime(data_dict['date_accepted'], '%Y-%m-%d %H:%M:%S')
     end_date = accepted_date + timedelta(days=3)
-    logger.debug(f'CIK: {cik_log} Ticker: {ticker_symbol} Accepted date {accepted_date}.  End date is {end_date}')
+    logger.debug('CIK: %s Ticker: %s Accepted date %s.  End date is %s', cik_log, ticker_symbol, accepted_date,
+                 end_date)
 
     if not (16 <= accepted_date.hour <= 19):
-        logging.info(f'CIK: {cik_log} Ticker: {ticker_symbol} 10-Q is outside time frame.  '
-                     'Must be submitted between 4pm and 7pm.')
+        logger.info('CIK: %s Ticker: %s %s is outside time frame.  Must be submitted between 4pm and 7pm.',
+                    cik_log, ticker_symbol, data_dict.get('form_type', '10-Q'))
         return data_dict
 
     accepted_date = accepted_date.date()
     # Get the stock history between start and end date
     try:
-        hist = yf.Ticker(ticker_symbol).history(start=accepted_date, end=end_date)
-        if hist.empty:
-            logger.error(f'CIK: {cik_log} Ticker: {ticker_symbol} Could not find a history in yFinance.')
+        hist = prices.daily_bars(ticker_symbol, accepted_date, end_date.date() + timedelta(days=1))
+        if not hist:
+            logger.error('CIK: %s Ticker: %s Could not find a history in yFinance.', cik_log, ticker_symbol)
             return data_dict
-        logger.debug(f'CIK: {cik_log} Ticker: {ticker_symbol} Got yahoo finance history\r\n{hist}')
+        # Formatted only when DEBUG is on and the record is not rate limited
+        logger.debug('CIK: %s Ticker: %s Got yahoo finance history\r\n%s', cik_log, ticker_symbol, hist)
     except Exception as e:
-        logging.error(f'CIK: {cik_log} Ticker: {ticker_symbol} yFinance encountered an error: {e}')
+        logger.error('CIK: %s Ticker: %s yFinance encountered an error: %s', cik_log, ticker_symbol, e)
         return data_dict
 
     # See if there is any history for the next day
     next_business_day = accepted_date + timedelta(days=1)
-    if next_business_day not in hist.index:
-        logger.debug(f'CIK: {cik_log} Ticker: {ticker_symbol} No stock history for {next_business_day}.')
+    if next_business_day not in hist:
+        logger.debug('CIK: %s Ticker: %s No stock history for %s.', cik_log, ticker_symbol, next_business_day)
         return data_dict
 
-    price1 = hist.loc[next_business_day]['Open']
-    price2 = hist.loc[next_business_day]['Close']
+    (price1, price2) = hist[next_business_day]
     data_dict['prc_change'] = price_rate_change(price2, price1)
-    logger.debug(f'CIK: {cik_log} Ticker: {ticker_symbol} Next business day {next_business_day} '
-                 f'Open: {price1} Close: {price2}')
+    logger.debug('CIK: %s Ticker: %s Next business day %s Open: %s Close: %s', cik_log, ticker_symbol,
+                 next_business_day, price1, price2)
 
     # See if there is any history for following business day
     following_business_day = next_business_day + timedelta(days=1)
-    if following_business_day not in hist.index:
+    if following_business_day not in hist:
         data_dict['error'] = f'No stock history for {following_business_day}'
         return data_dict
 
-    price1 = hist.loc[next_business_day]['Open']
-    price2 = hist.loc[following_business_day]['Open']
-    logger.debug(f'CIK: {cik_log} Ticker: {ticker_symbol} Next business day {next_business_day} '
-                 f'Open: {price1}.  Following business day Open: {price2}')
+    price1 = hist[next_business_day][0]
+    price2 = hist[following_business_day][0]
+    logger.debug('CIK: %s Ticker: %s Next business day %s Open: %s.  Following business day Open: %s', cik_log,
+                 ticker_symbol, next_business_day, price1, price2)
     data_dict['prc_change2'] = price_rate_change(price2, price1)
     return data_dict
@@ -1,67 +1,203 @@
-from bs4 import BeautifulSoup
-from config import Environment
+from bs4 import BeautifulSoup, NavigableString, Tag
+from config import get_environment
+from functools import lru_cache
 import html
 import re
+import time
 import logging
 import os
 
-ev = Environment()
+import metrics
+from store import get_store
+
+ev = get_environment()
 logger = logging.getLogger(ev.app_name)
 
+STOP_WORDS_FILE = os.path.join(ev.dir_path, 'input', 'stopwords.txt')
+
+# Compiled once per process instead of once per filing
+WHITESPACE = re.compile(r'\s+')
+WORD = re.compile(r'\b(\w+)\b\s*')
+NON_ALPHA_TOKEN = re.compile(r'\s[^a-zA-Z\s]+?(?=(\.*\s))')
+NOT_ALPHANUMERIC = re.compile(r'[^A-Za-z0-9]+')
+UNWRAP_TAGS = frozenset(['span', 'font', 'b', 'i', 'u', 'strong', 'img'])
+
+
+@lru_cache(maxsize=None)
+def load_stop_words():
+    """ Read input/stopwords.txt once per process """
+    with open(STOP_WORDS_FILE) as stop_words_file:
+        return frozenset(line.strip().lower() for line in stop_words_file)
+
+
+@lru_cache(maxsize=None)
+def stop_word_pattern():
+    """
+    The original one big alternation of every stop word.  Only used to settle non ascii words, where
+    re.IGNORECASE folds characters (Kelvin sign, long s) that str.lower() does not.
+    """
+    return re.compile(r'\b(' + r'|'.join(load_stop_words()) + r')\b\s*', re.IGNORECASE)
+
+
+def remove_stop_words(text: str):
+    """
+    Remove every stop word and the whitespace after it.  Tokenizes into words and looks each one up in a set,
+    which gives the same result as substituting the big stop word regex.
+    """
+    stop_words = load_stop_words()
+
+    def replace(match):
+        word = match.group(1)
+        if word.isascii():
+            return '' if word.lower() in stop_words else match.group(0)
+        return '' if stop_word_pattern().fullmatch(match.group(0)) else match.group(0)
+
+    return WORD.sub(replace, text)
+
+
+def has_bg_color(value: str):
+    return 'background-color' in value or 'bgcolor' in value
+
+
+def contains_bg_color(node, in_row=False):
+    """
+    True when the markup of any table row under node mentions background-color or bgcolor.  Gives the same
+    answer as checking str(row) for every row, without rendering any of them.
+    """
+    text_run = list()
+    for child in node.children:
+        if isinstance(child, NavigableString):
+            if in_row:
+                text_run.append(child)
+            continue
+
+        # Strings next to each other render as one, so check them together
+        if text_run:
+            if has_bg_color(''.join(text_run)):
+                return True
+            text_run = list()
+
+        if not isinstance(child, Tag):
+            continue
+
+        row = in_row or child.name == 'tr'
+        if row:
+            if has_bg_color(child.name):
+                return True
+            for key, value in child.attrs.items():
+                if isinstance(value, list):
+                    value = ' '.join(value)
+                if has_bg_color(key) or has_bg_color(str(value)):
+                    return True
+        if contains_bg_color(child, row):
+            return True
+    return bool(text_run) and has_bg_color(''.join(text_run))
+
+
+def is_attached(tag):
+    """ False when tag sits inside something that was already extracted from the document """
+    parent = tag.parent
+    while parent is not None:
+        if isinstance(parent, BeautifulSoup):
+            return True
+        parent = parent.parent
+    return False
+
+
+def form_suffix(form_type):
+    """ 10-Qs keep the file name they always had, other forms filed the same day get their own: -10K, -10QA """
+    if form_type in (None, '10-Q'):
+        return ''
+    return '-' + NOT_ALPHANUMERIC.sub('', form_type)
+
 
 class FilingCleaner:
     def __init__(self, text, data_dict):
-        self.stop_words = set(line.strip().lower() for line in open('input/stopwords.txt'))
-        self.soup = BeautifulSoup(html.unescape(re.sub(r'\s+', ' ', text)), "lxml")
+        self.timings = dict()
+        started = time.perf_counter()
+        self.stop_words = load_stop_words()
+        self.soup = BeautifulSoup(html.unescape(WHITESPACE.sub(' ', text)), "lxml")
+        self.timings['parse'] = time.perf_counter() - started
         self.data_dict = data_dict
         self.text = ''
 
-    def remove_numerical_tables(self):
-        def get_digit_percentage(table):
-            if len(table) > 0.0:
-                numbers = sum([char.isdigit() for char in table])
-                length = len(table)
-                return numbers / length
-            else:
-                return 1
-
-        def contains_bg_color(table):
-            for row in table.find_all('tr'):
-                colored_bg = 'background-color' in str(row) or 'bgcolor' in str(row)
-                if colored_bg:
-                    return True
-            return False
-
-        [x.extract() for x in self.soup.find_all('table') if contains_bg_color(x)]
-        [x.extract() for x in self.soup.find_all('table') if get_digit_percentage(x.get_text()) > 0.15]
+    def prune(self):
+        """
+        Remove xbrli tags, local links, colored and numeric tables and unwrap basic html tags.
 
-    def wash(self):
-        logger.debug(f'CIK: {self.data_dict["cik"]}. Started cleaning file.')
+        One walk over the tree collects every candidate.  They are then removed in the same order the separate
+        find_all passes used to, so the result is the same.
+        """
+        xbrli_tags = list()
+        local_links = list()
+        tables = list()
+        unwrap_tags = list()
+        for tag in self.soup.find_all(True):
+            name = tag.name
+            if name.startswith('xbrli:'):
+                xbrli_tags.append(tag)
+            elif name == 'a':
+                href = tag.get('href')
+                if href and href[0] == '#':
+                    local_links.append(tag)
+            elif name == 'table':
+                tables.append(tag)
+            elif name in UNWRAP_TAGS:
+                unwrap_tags.append(tag)
 
         # Remove xml xbrli and local href
-        [x.extract() for x in self.soup.find_all(re.compile("^xbrli:"))]
-        [x.extract() for x in self.soup.find_all('a', href=True) if len(x['href']) > 0 and x['href'][0] == '#']
+        [x.extract() for x in xbrli_tags]
+        [x.extract() for x in local_links]
+
+        # Remove colored tables and then tables that are mostly numbers
+        tables = [x for x in tables if is_attached(x)]
+        [x.extract() for x in tables if contains_bg_color(x)]
+        for table in tables:
+            if is_attached(table) and self.get_digit_percentage(table.get_text()) > 0.15:
+                table.extract()
+
+        [x.unwrap() for x in unwrap_tags]
 
-        # Remove and colored and numeric tables and basic html tags
-        self.remove_numerical_tables()
-        [x.unwrap() for x in self.soup.find_all(['span', 'font', 'b', 'i', 'u', 'strong', 'img'])]
+    @staticmethod
+    def get_digit_percentage(table):
+        if len(table) > 0.0:
+            numbers = sum(map(str.isdigit, table))
+            length = len(table)
+            return numbers / length
+        else:
+            return 1
+
+    def wash(self):
+        logger.debug('CIK: %s. Started cleaning file.', self.data_dict['cik'])
+
+        started = time.perf_counter()
+        self.prune()
 
         # clean up
         self.soup.smooth()
+        self.timings['prune'] = time.perf_counter() - started
 
+        started = time.perf_counter()
         text = self.soup.get_text('\n', strip=True)
-        pattern = re.compile(r'\b(' + r'|'.join(self.stop_words) + r')\b\s*', re.IGNORECASE)
-        text = pattern.sub('', text)
-        pattern = re.compile('\s[^a-zA-Z\s]+?(?=(\.*\s))')
-        text = pattern.sub('', text)
+        self.timings['text'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        text = remove_stop_words(text)
+        text = NON_ALPHA_TOKEN.sub('', text)
 
         self.text = '\n'.join(
-            filter(lambda line: len(line) > 0 and (sum(i.isalpha() for i in line) / len(line) > .5), text.splitlines()))
+            filter(lambda line: len(line) > 0 and (sum(map(str.isalpha, line)) / len(line) > .5), text.splitlines()))
+        self.timings['stop_words'] = time.perf_counter() - started
 
+        started = time.perf_counter()
         file_date, _ = self.data_dict['date_accepted'].split(' ')
-        file_name = f'{self.data_dict["cik"]}-{file_date}.txt'
-        with open(os.path.join(ev.output_cleaned_files, file_name), 'w') as file:
-            file.write(self.text)
+        file_name = f'{self.data_dict["cik"]}-{file_date}{form_suffix(self.data_dict.get("form_type"))}.txt'
+        get_store().put(file_name, self.text)
+        self.timings['write'] = time.perf_counter() - started
 
-        logger.debug(f'CIK: {self.data_dict["cik"]}. Finished cleaning file {file_name}.')
+        for stage, seconds in self.timings.items():
+            metrics.observe(f'wash_{stage}', seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            timings = ' '.join(f'{stage}: {seconds:.3f}s' for stage, seconds in self.timings.items())
+            logger.debug('CIK: %s. Finished cleaning file %s. %s', self.data_dict['cik'], file_name, timings)
         return file_name
@@ -0,0 +1,217 @@
+import os
+import copy
+import json
+import time
+import queue
+import atexit
+import signal
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+from logging.handlers import QueueHandler
+
+from config import get_environment
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# Attributes every LogRecord has.  Anything else came in through extra= and goes into the JSON line as is.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+_queue = None
+_listener = None
+
+
+class RateLimit(logging.Filter):
+    """
+    Lets through logging_rate_limit records a second from each call site (file and line), with bursts of as many.
+    The rest are dropped before they are formatted or sent and counted in the logging / suppressed counter.
+    The next record let through from that call site carries how many were dropped as 'suppressed'.
+    Warnings and errors always pass.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        # (pathname, lineno) -> [tokens, last refill, suppressed]
+        self.sites = dict()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = [self.rate, now, 0]
+            site[0] = min(self.rate, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                metrics.count('suppressed', 'logging')
+                return False
+            site[0] -= 1
+            if site[2]:
+                record.suppressed = site[2]
+                site[2] = 0
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Sends records to the listener process.  The time it takes the logging call, once the level let the record
+    through, is kept in the 'logging' histogram.
+    """
+
+    def handle(self, record):
+        started = time.perf_counter()
+        emitted = super().handle(record)
+        metrics.observe('logging', time.perf_counter() - started)
+        return emitted
+
+    def prepare(self, record):
+        """ Format the message once, here, and keep only what pickles.  The traceback travels as 'exception'. """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exception = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES and not isinstance(value, PLAIN_TYPES):
+                record.__dict__[key] = str(value)
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, process, where it was logged, the message and any extra= fields """
+
+    def format(self, record):
+        line = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'process_name': record.processName,
+            'thread': record.threadName,
+            'file': record.filename,
+            'line': record.lineno,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                line[key] = value
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ The console format, followed by the traceback LogQueueHandler took off the record """
+
+    def format(self, record):
+        text = super().format(record)
+        exception = getattr(record, 'exception', None)
+        return f'{text}\n{exception}' if exception else text
+
+
+def listen(log_queue, log_file, console: bool, parent: int):
+    """
+    The listener process.  Writes every record the main process and the pool workers send to the console and
+    log_file until None comes, or the main process is gone.
+    """
+    # Ctrl-C goes to the whole process group.  The listener keeps writing until the main process is done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handlers = list()
+    if console:
+        console_writer = logging.StreamHandler()
+        console_writer.setFormatter(TextFormatter(ev.logging_format, ev.logging_date_format))
+        handlers.append(console_writer)
+    if log_file:
+        file_writer = logging.FileHandler(log_file, mode='w', encoding='utf-8')
+        if ev.logging_json:
+            file_writer.setFormatter(JsonFormatter())
+        else:
+            file_writer.setFormatter(TextFormatter('%(asctime)s %(levelname)5s %(message)s'))
+        handlers.append(file_writer)
+
+    while True:
+        try:
+            record = log_queue.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent:
+                break
+            continue
+        except (EOFError, OSError):
+            break
+        if record is None:
+            break
+        for handler in handlers:
+            handler.handle(record)
+    for handler in handlers:
+        handler.close()
+
+
+def configure(log_queue, rate_limit=None):
+    """ Send every record of this process to the listener.  The root logger gets the one handler. """
+    rate_limit = ev.logging_rate_limit if rate_limit is None else rate_limit
+    handler = LogQueueHandler(log_queue)
+    if rate_limit:
+        handler.addFilter(RateLimit(rate_limit))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    app_logger = logging.getLogger(ev.app_name)
+    for existing in list(app_logger.handlers):
+        app_logger.removeHandler(existing)
+    app_logger.setLevel(ev.logging_level)
+    app_logger.propagate = True
+
+
+def start_logging(log_file=None, rate_limit=None, console=True):
+    """
+    Start the listener process and send this process's records to it.  Pool workers started afterwards send
+    theirs to the same queue (see log_queue), so one process writes the console and log_file.  The listener is
+    stopped, after it wrote everything, when this process exits.
+    """
+    global _queue, _listener
+    if _queue is not None:
+        return _queue
+    context = multiprocessing.get_context()
+    _queue = context.Queue()
+    _listener = context.Process(target=listen, args=(_queue, log_file, console, os.getpid()), name='log-listener')
+    _listener.start()
+    configure(_queue, rate_limit)
+    # Runs before multiprocessing's own exit handler, which would wait for the listener forever
+    atexit.register(stop_logging)
+    return _queue
+
+
+def stop_logging():
+    """ Flush what is queued through the listener and stop it.  Records logged afterwards go to stderr. """
+    global _queue, _listener
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(logging.StreamHandler())
+    _queue.put(None)
+    _listener.join(timeout=30)
+    if _listener.is_alive():
+        _listener.terminate()
+    _queue.close()
+    _queue = None
+    _listener = None
+
+
+def log_queue():
+    """ The queue of the listener, None when this process did not start one """
+    return _queue
@@ -1,77 +1,70 @@
 import sys
 import os
 import logging
-from config import Environment
-from sec import SEC, download_master_zip
+from config import get_environment
 import db
-import differences
+import logs
+import metrics
+import export
+from workers import shared_pool
 from pathlib import Path
-import pandas
 from datetime import datetime
 
-try:
-    ev = Environment()
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+
+def setup():
+    """ Create the output folders and start logging through the listener process into this run's log file """
     Path(ev.output_log_files).mkdir(parents=True, exist_ok=True)
     Path(ev.output_db).mkdir(parents=True, exist_ok=True)
     Path(ev.output_cleaned_files).mkdir(parents=True, exist_ok=True)
 
-    logging.basicConfig(
-        format=ev.logging_format,
-        datefmt=ev.logging_date_format,
-    )
-    logger = logging.getLogger(ev.app_name)
-    logger.setLevel(level=ev.logging_level)
-
-    log_writer = logging.FileHandler(os.path.join(ev.output_log_files, f'{datetime.now()}-output.log'), mode='w')
-    log_writer.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)5s %(message)s'))
-    log_writer.setLevel('DEBUG')
-    logger.addHandler(log_writer)
-except Exception as error:
-    raise error
-
-
-def create_csv():
-    conn = db.connect_to_db()
-    sql = '''SELECT
-                 difference_from_last_report as differ,
-                 prc_change2 
-             FROM 
-                 marko_finance 
-             WHERE 
-                 prc_change2 IS NOT NULL AND
-                 difference_from_last_report IS NOT NULL'''
-    finance = pandas.read_sql_query(sql, conn)
-    finance['prc_change2'] = pandas.qcut(finance.prc_change2.astype(float), q=5, labels=range(5))
-    finance['differ'] = finance.differ.str.replace(r'\r|\n', ' ').replace(r'"', '')
-    finance.to_csv('training_data.csv', header=False, index=False)
-    conn.close()
+    extension = 'jsonl' if ev.logging_json else 'log'
+    logs.start_logging(os.path.join(ev.output_log_files, f'{datetime.now()}-output.{extension}'))
 
 
 def main():
     """
     This is the main part of the program.
-    1) Create output directories if they do not exist
+    1) Create the database tables if they do not exist
     2) Download the master zip files from sec
-    3) Process and clean the master index files
+    3) Download, clean, price and diff the filings in one pipeline
+    Every stage shares the same pool of warm worker processes.
+    With WATCH=1 it watches the latest filings instead, see watch.py.
     """
 
-    # Create output folder and database
+    # Create the database
     db.create_finance_table()
+    db.create_master_index_tables()
+    db.create_cik_ticker_tables()
 
     if ev.create_report:
-        create_csv()
-    elif ev.get_differences:
-        differences.get_differences()
-        create_csv()
-    else:
-        sec = SEC()
-        download_master_zip()
-        sec.process_master_index()
-        differences.get_differences()
-        create_csv()
+        export.export_training_data()
+        return
+
+    # One set of warm workers serves every stage of the run
+    with shared_pool():
+        if ev.get_differences:
+            import differences
+            differences.get_differences()
+            export.export_training_data()
+        elif ev.watch:
+            from sec import SEC
+            from watch import Watcher
+            Watcher(SEC()).run()
+        else:
+            # The download and cleaning modules are only loaded by the run that needs them
+            from sec import SEC, download_master_zip
+            from pipeline import Pipeline
+            sec = SEC()
+            download_master_zip()
+            Pipeline(sec).run()
+            export.export_training_data()
 
 
 if __name__ == "__main__":
+    setup()
     try:
         logger.info(f"{ev.app_name} - Begin")
         main()
@@ -80,3 +73,5 @@ if __name__ == "__main__":
     except Exception as error:
         logger.exception(f'Encountered an exception: {error}')
         sys.exit(1)
+    finally:
+        metrics.write_reports()
@@ -0,0 +1,153 @@
+import math
+import logging
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+
+from config import get_environment
+from fuzzywuzzy import process, fuzz, utils
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# A sentence is old when it scores 85 or better with fuzz.QRatio against any sentence of the older report
+SCORE_CUTOFF = 85
+
+# fuzzywuzzy rounds 100 * ratio, so anything above 84.5 scores 85.  The filters below use this slightly looser
+# bound so they can never throw away a sentence that would have scored 85.
+MIN_RATIO = (SCORE_CUTOFF - 0.5) / 100
+MAX_DISTANCE = 1 - MIN_RATIO
+
+
+def normalize(sentence: str):
+    """ The exact query string extractOne(scorer=fuzz.QRatio) ends up comparing: full_process, then force_ascii """
+    return utils.full_process(utils.full_process(sentence), force_ascii=True)
+
+
+def normalize_choice(sentence: str):
+    """
+    The exact choice string extractOne(scorer=fuzz.QRatio) ends up comparing.  Choices only get the force_ascii
+    pass, which drops NBSP, section signs and accents before they could become spaces.
+    """
+    return utils.full_process(sentence, force_ascii=True)
+
+
+def q_grams(text: str, q: int):
+    return Counter(text[i:i + q] for i in range(len(text) - q + 1))
+
+
+class SentenceIndex:
+    """
+    q-gram inverted index over the sentences of the older report.
+
+    has_match(sentence) answers the same question as
+    process.extractOne(sentence, sentences, score_cutoff=85, scorer=fuzz.QRatio) is not None,
+    but only runs fuzz.ratio on the few sentences that can still reach the cutoff:
+
+    1) Length filter.  ratio = (la + lb - d) / (la + lb) and the indel distance d is at least |la - lb|,
+       so sentences of very different length cannot match.
+    2) Count filter.  Two strings within edit distance k share at least max(la, lb) - q + 1 - k * q q-grams
+       (Ukkonen), and k is at most d <= 0.155 * (la + lb) for a match.  Candidates sharing fewer q-grams are
+       skipped.
+
+    Both filters are exact bounds, so with python-Levenshtein installed the result is identical to the brute force
+    search (tolerance 0).  Without it fuzzywuzzy falls back to difflib, whose ratio is never higher than the
+    Levenshtein one, so the filters are still safe.
+
+    q-grams found in more than half of the sentences are not indexed.  Their occurrences are taken off the count
+    a candidate needs instead, which keeps posting lists short without loosening the bound.
+    """
+
+    def __init__(self, sentences, q=3, common_gram_share=0.5):
+        self.q = q
+        self.sentences = list()
+        self.lengths = list()
+        self.grams = list()
+
+        processed = [normalize_choice(sentence) for sentence in sentences]
+        processed = sorted((p for p in processed if p), key=len)
+        for sentence in processed:
+            self.sentences.append(sentence)
+            self.lengths.append(len(sentence))
+
+        document_frequency = Counter()
+        for sentence in self.sentences:
+            grams = q_grams(sentence, q)
+            self.grams.append(grams)
+            document_frequency.update(grams.keys())
+
+        limit = max(20, int(len(self.sentences) * common_gram_share))
+        self.common_grams = {gram for gram, count in document_frequency.items() if count > limit}
+
+        self.postings = defaultdict(list)
+        for sentence_id, grams in enumerate(self.grams):
+            for gram, count in grams.items():
+                if gram not in self.common_grams:
+                    self.postings[gram].append((sentence_id, count))
+        self.grams = None
+
+    def required_shared(self, la: int, lb: int, skipped: int):
+        """ Fewest indexed q-grams a sentence of length lb must share with one of length la to possibly match """
+        max_distance = math.floor(MAX_DISTANCE * (la + lb) + 1e-9)
+        return max(la, lb) - self.q + 1 - self.q * max_distance - skipped
+
+    def candidates(self, sentence: str):
+        la = len(sentence)
+        low = bisect_left(self.lengths, math.ceil(la * MIN_RATIO / (2 - MIN_RATIO) - 1e-9))
+        high = bisect_right(self.lengths, math.floor(la * (2 - MIN_RATIO) / MIN_RATIO + 1e-9))
+        if low >= high:
+            return
+
+        grams = q_grams(sentence, self.q)
+        skipped = sum(count for gram, count in grams.items() if gram in self.common_grams)
+
+        shared = defaultdict(int)
+        for gram, count in grams.items():
+            for sentence_id, other_count in self.postings.get(gram, ()):
+                if low <= sentence_id < high:
+                    shared[sentence_id] += min(count, other_count)
+
+        # A lower bound of required_shared over every length in range.  When even that is positive a candidate
+        # has to share an indexed q-gram, so only sentences in the posting lists need a look.
+        if la - self.q + 1 - self.q * MAX_DISTANCE * 2 * la - skipped > 0:
+            sentence_ids = shared.keys()
+        else:
+            sentence_ids = range(low, high)
+
+        for sentence_id in sentence_ids:
+            if shared.get(sentence_id, 0) >= self.required_shared(la, self.lengths[sentence_id], skipped):
+                yield sentence_id
+
+    def has_match(self, sentence: str):
+        processed = normalize(sentence)
+        if not processed:
+            return False
+        for sentence_id in self.candidates(processed):
+            if fuzz.ratio(processed, self.sentences[sentence_id]) >= SCORE_CUTOFF:
+                return True
+        return False
+
+
+def brute_force_new_sentences(current_sentences, last_sentences):
+    """ Reference mode.  Scores every new sentence against every old one. """
+    new_sentences = list()
+    for sentence in current_sentences:
+        match = process.extractOne(sentence, last_sentences, score_cutoff=SCORE_CUTOFF, scorer=fuzz.QRatio)
+        if match is None:
+            new_sentences.append(sentence)
+    return new_sentences
+
+
+def indexed_new_sentences(current_sentences, last_sentences):
+    index = SentenceIndex(last_sentences)
+    return [sentence for sentence in current_sentences if not index.has_match(sentence)]
+
+
+def find_new_sentences(current_sentences, last_sentences, mode=None):
+    """
+    Sentences of the current report without a fuzzy match of 85% or better in the last report.
+    mode is 'index' (default) or 'brute', see DIFF_MATCHER.
+    """
+    mode = mode or ev.diff_matcher
+    if mode == 'brute':
+        return brute_force_new_sentences(current_sentences, last_sentences)
+    return indexed_new_sentences(current_sentences, last_sentences)
@@ -0,0 +1,329 @@
+import io
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+from config import get_environment
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# Upper bounds in seconds of the latency histogram buckets.  The last one catches everything.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+
+class Registry:
+    """
+    Counters and latency histograms of one process, labelled by stage and pid.
+
+    Everything is kept in plain dicts and lists so a snapshot pickles cheaply.  Pool workers send theirs back
+    with every result (see Instrumented) and the parent merges them, so the parent ends up with the numbers of
+    the whole run, per worker process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.reset()
+
+    def reset(self):
+        # (name, stage, pid) -> value
+        self.counters = defaultdict(float)
+        # (stage, pid) -> [bucket counts..., sum, max]
+        self.histograms = dict()
+        # (seconds, stage, key, text) of the slowest profiled work
+        self.profiles = list()
+
+    def count(self, name: str, stage: str, amount=1):
+        with self.lock:
+            self.counters[(name, stage, os.getpid())] += amount
+
+    def observe(self, stage: str, seconds: float):
+        key = (stage, os.getpid())
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-2] += seconds
+            histogram[-1] = max(histogram[-1], seconds)
+
+    def add_profile(self, seconds: float, stage: str, key: str, text: str):
+        with self.lock:
+            self.profiles.append((seconds, stage, key, text))
+            self.profiles.sort(key=lambda profile: profile[0], reverse=True)
+            del self.profiles[ev.profile_slowest:]
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'histograms': {key: list(histogram) for key, histogram in self.histograms.items()},
+                'profiles': list(self.profiles)
+            }
+            if reset:
+                self.reset()
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] += value
+            for key, other in snapshot['histograms'].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(other)
+                    continue
+                for i in range(len(BUCKETS) + 1):
+                    histogram[i] += other[i]
+                histogram[-1] = max(histogram[-1], other[-1])
+        for profile in snapshot['profiles']:
+            self.add_profile(*profile)
+
+
+registry = Registry()
+
+
+def reset_worker():
+    """
+    A forked pool worker starts with a copy of the parent's registry, numbers the parent already has and a lock a
+    parent thread may have held.  The worker starts over with its own.
+    """
+    global registry
+    registry = Registry()
+
+
+def count(name: str, stage: str, amount=1):
+    registry.count(name, stage, amount)
+
+
+def observe(stage: str, seconds: float):
+    registry.observe(stage, seconds)
+
+
+def total(name: str, stage: str):
+    """ A counter summed over every process """
+    with registry.lock:
+        return sum(value for (counter, counter_stage, _), value in registry.counters.items()
+                   if counter == name and counter_stage == stage)
+
+
+def add_bytes(stage: str, direction: str, amount: int):
+    """ direction is 'in' or 'out' """
+    registry.count(f'bytes_{direction}', stage, amount)
+
+
+@contextmanager
+def timed(stage: str):
+    """ Time the block as one item of stage.  An exception leaving the block counts as an error. """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        registry.count('errors', stage)
+        raise
+    finally:
+        registry.observe(stage, time.perf_counter() - started)
+
+
+def work_key(args):
+    """ Something to recognize a filing by in a profile """
+    for arg in args:
+        if isinstance(arg, dict):
+            for name in ('current_file', 'file_name', 'url'):
+                if arg.get(name):
+                    return str(arg[name])
+    return ''
+
+
+# Durations of the slowest work this worker profiled so far.  Only work that makes this list keeps its profile.
+_slowest = list()
+
+
+def is_slow(seconds: float):
+    if len(_slowest) < ev.profile_slowest or seconds > _slowest[0]:
+        bisect.insort(_slowest, seconds)
+        del _slowest[:-ev.profile_slowest]
+        return True
+    return False
+
+
+def profiled(func, args):
+    """ Run func(*args) under cProfile or tracemalloc.  Returns (result, seconds, report). """
+    started = time.perf_counter()
+    if ev.profile_mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            result = func(*args)
+            seconds = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+        finally:
+            tracemalloc.stop()
+        report = f'peak: {peak / 1024 / 1024:.1f} MiB\n' + '\n'.join(str(stat) for stat in top)
+        return result, seconds, report
+
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = func(*args)
+    finally:
+        profile.disable()
+    seconds = time.perf_counter() - started
+    report = io.StringIO()
+    pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(30)
+    return result, seconds, report.getvalue()
+
+
+class Instrumented:
+    """
+    Wraps a function sent to a multiprocessing pool.  In the worker it times the call under the function's
+    name and returns (result, metrics recorded in the worker since the last call).  unwrap() merges those into
+    the parent's registry and hands back the result.
+
+        pool.imap_unordered(Instrumented(create_diff), work)
+
+    With PROFILE_SLOWEST=N the call also runs under cProfile (or tracemalloc, see PROFILE_MODE) and the N
+    slowest calls of the run keep their profile.
+    """
+
+    def __init__(self, func, stage=None):
+        self.func = func
+        self.stage = stage or func.__name__
+
+    def __call__(self, *args):
+        if ev.profile_slowest and self.stage in ev.profile_stages:
+            with timed(self.stage):
+                result, seconds, report = profiled(self.func, args)
+            if is_slow(seconds):
+                registry.add_profile(seconds, self.stage, work_key(args), report)
+        else:
+            with timed(self.stage):
+                result = self.func(*args)
+        return result, registry.snapshot(reset=True)
+
+
+def unwrap(value):
+    result, snapshot = value
+    registry.merge(snapshot)
+    return result
+
+
+def quantile(histogram, q: float):
+    """ Upper bound of the bucket the q quantile falls in """
+    total = sum(histogram[:len(BUCKETS)])
+    if not total:
+        return 0.0
+    seen = 0
+    for bound, bucket in zip(BUCKETS, histogram):
+        seen += bucket
+        if seen >= q * total:
+            return bound if bound != float('inf') else histogram[-1]
+    return histogram[-1]
+
+
+def sample_value(value):
+    """ Exact text of a sample.  {:g} would round a byte counter to 6 digits and make it step back and forth. """
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def prometheus_text(snapshot: dict):
+    lines = [
+        '# HELP marko_polo_stage_seconds Latency of one item of a stage.',
+        '# TYPE marko_polo_stage_seconds histogram'
+    ]
+    for (stage, pid), histogram in sorted(snapshot['histograms'].items()):
+        labels = f'stage="{stage}",pid="{pid}"'
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, histogram):
+            cumulative += bucket
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'marko_polo_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'marko_polo_stage_seconds_sum{{{labels}}} {histogram[-2]}')
+        lines.append(f'marko_polo_stage_seconds_count{{{labels}}} {cumulative}')
+
+    names = sorted(set(name for name, _, _ in snapshot['counters']))
+    for name in names:
+        lines.append(f'# TYPE marko_polo_{name}_total counter')
+        for (counter, stage, pid), value in sorted(snapshot['counters'].items()):
+            if counter == name:
+                lines.append(f'marko_polo_{name}_total{{stage="{stage}",pid="{pid}"}} {sample_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def run_summary(snapshot: dict, started: float, finished: float):
+    """ Per stage totals over every process, plus the per process item counts """
+    wall = max(finished - started, 1e-9)
+    stages = dict()
+    for (stage, pid), histogram in snapshot['histograms'].items():
+        summary = stages.setdefault(stage, {'histogram': [0] * len(BUCKETS) + [0.0, 0.0], 'per_pid': dict()})
+        for i in range(len(BUCKETS) + 1):
+            summary['histogram'][i] += histogram[i]
+        summary['histogram'][-1] = max(summary['histogram'][-1], histogram[-1])
+        summary['per_pid'][str(pid)] = sum(histogram[:len(BUCKETS)])
+
+    result = dict()
+    for stage, summary in sorted(stages.items()):
+        histogram = summary['histogram']
+        items = sum(histogram[:len(BUCKETS)])
+        result[stage] = {
+            'items': items,
+            'seconds': round(histogram[-2], 3),
+            'mean': round(histogram[-2] / items, 4) if items else 0.0,
+            'p50': quantile(histogram, 0.5),
+            'p95': quantile(histogram, 0.95),
+            'p99': quantile(histogram, 0.99),
+            'max': round(histogram[-1], 4),
+            'per_second': round(items / wall, 3),
+            'per_pid': summary['per_pid']
+        }
+    for (name, stage, _), value in snapshot['counters'].items():
+        counters = result.setdefault(stage, {'items': 0}).setdefault('counters', dict())
+        counters[name] = counters.get(name, 0) + value
+
+    return {
+        'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+        'wall_seconds': round(wall, 3),
+        'stages': result,
+        'slowest': [{'stage': stage, 'key': key, 'seconds': round(seconds, 3)}
+                    for seconds, stage, key, _ in snapshot['profiles']]
+    }
+
+
+def write_atomic(path: str, text: str):
+    """ node_exporter must never read a half written textfile """
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+
+def write_reports(folder=None):
+    """ Write metrics.prom, run-summary.json and the profiles of the slowest work to output/metrics """
+    folder = folder or ev.output_metrics
+    os.makedirs(folder, exist_ok=True)
+    snapshot = registry.snapshot()
+    summary = run_summary(snapshot, registry.started, time.time())
+
+    write_atomic(os.path.join(folder, 'metrics.prom'), prometheus_text(snapshot))
+    write_atomic(os.path.join(folder, 'run-summary.json'), json.dumps(summary, indent=2))
+
+    if snapshot['profiles']:
+        profile_folder = os.path.join(folder, 'profiles')
+        os.makedirs(profile_folder, exist_ok=True)
+        for rank, (seconds, stage, key, text) in enumerate(snapshot['profiles'], start=1):
+            name = f'{rank:02d}-{stage}-{os.path.basename(key) or "unknown"}.txt'
+            with open(os.path.join(profile_folder, name), 'w') as profile_file:
+                profile_file.write(f'{stage} {key} {seconds:.3f}s\n\n{text}')
+
+    logger.info(f'Wrote metrics for {len(summary["stages"])} stage(s) to {folder}.')
+    return summary
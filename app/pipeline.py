@@ -0,0 +1,324 @@
+import time
+import asyncio
+import logging
+from collections import defaultdict
+
+from config import get_environment
+from fetch import Fetcher, run_in_pool
+from workers import shared_pool
+from sec import SEC, Filing, plan_cik_work, clean_filing, pad_string
+from work_queue import WorkQueue
+import differences
+import boilerplate
+import db
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+
+class Work:
+    """ One filing travelling through the stages """
+    __slots__ = ('filing', 'data_dict', 'text', 'started')
+
+    def __init__(self, filing: Filing):
+        self.filing = filing
+        self.data_dict = filing.to_dict()
+        self.text = None
+        self.started = time.monotonic()
+
+
+class Stage:
+    """ A bounded queue and the workers pulling from it """
+
+    def __init__(self, name: str, workers: int, handler, queue_size: int):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.handler = handler
+        self.queue_size = queue_size
+        self.queue = None
+        self.tasks = list()
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        # Created here, on the running loop.  Python 3.7 binds a queue to the loop current when it is made.
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def work(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                with metrics.timed(f'stage_{self.name}'):
+                    await self.handler(item)
+                self.processed += 1
+            except Exception as error:
+                self.failed += 1
+                logger.exception(f'Stage {self.name} failed on {item}: {error}')
+            finally:
+                self.queue.task_done()
+
+    async def stop(self):
+        """ Wait until everything queued is handled, then stop the workers """
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class Pipeline:
+    """
+    fetch -> clean -> enrich -> persist, with a diff stage fed as soon as two consecutive reports of a CIK
+    are in the database.
+
+    Every stage has its own bounded queue and worker count (PIPELINE_*_WORKERS), so a slow stage pushes back on
+    the ones before it instead of piling up work in memory.  Cleaning and diffing share one CPU pool.
+
+    Work is claimed a CIK at a time from the durable 'filing' work queue, so several processes, on one box or
+    several sharing the database, can split a backfill and a crashed run resumes where it stopped.  A CIK is
+    completed in the queue once all of its filings are through and committed.  A CIK with a filing that did not
+    make it is failed instead, so the filing is tried again, until the CIK used up WORK_MAX_ATTEMPTS.
+
+    A diff needs both reports and nothing in between still on its way.  A CIK is completely planned once all
+    of its pending filings are queued for fetch.  After that its diffs are scheduled as soon as no filing of
+    that CIK between the pair is still outstanding.
+    """
+
+    def __init__(self, sec: SEC):
+        self.sec = sec
+        self.pool = None
+        self.fetcher = None
+        self.writer = None
+
+        # cik -> date_filed of every planned filing not finished yet
+        self.outstanding = defaultdict(list)
+        self.work = None
+        self.planned_ciks = set()
+        self.finished_ciks = set()
+        # cik -> error of a filing that did not make it into the database
+        self.failed_filings = dict()
+        self.planning_done = False
+        self.dirty_ciks = set()
+        self.scheduled_diffs = set()
+
+        size = ev.pipeline_queue_size
+        self.fetch_stage = Stage('fetch', ev.pipeline_fetch_workers, self.fetch, size)
+        self.clean_stage = Stage('clean', ev.pipeline_clean_workers, self.clean, size)
+        self.enrich_stage = Stage('enrich', ev.pipeline_enrich_workers, self.enrich, size)
+        self.persist_stage = Stage('persist', 1, self.persist, size)
+        self.diff_stage = Stage('diff', ev.pipeline_diff_workers, self.diff, size)
+        self.stages = [self.fetch_stage, self.clean_stage, self.enrich_stage, self.persist_stage, self.diff_stage]
+
+    def release(self, work: Work, error=None):
+        """ The filing is done, whether it made it into the database or not.  error when it did not. """
+        cik = work.filing.cik
+        if error is not None:
+            self.failed_filings[cik] = error
+        self.outstanding[cik].remove(work.filing.date_filed)
+        if not self.outstanding[cik]:
+            del self.outstanding[cik]
+            if cik in self.planned_ciks:
+                self.finished_ciks.add(cik)
+        self.dirty_ciks.add(cik)
+
+    async def fetch(self, work: Work):
+        try:
+            work.text = await self.sec.download_filing(self.fetcher, self.pool, work.data_dict)
+        except Exception as error:
+            self.release(work, error)
+            raise
+        if work.text is None:
+            self.release(work, LookupError(f'Could not download {work.data_dict["url"]}'))
+            return
+        await self.clean_stage.queue.put(work)
+
+    async def clean(self, work: Work):
+        try:
+            file_name = await run_in_pool(self.pool, clean_filing, work.text, work.data_dict, size=len(work.text))
+        except Exception as error:
+            self.release(work, error)
+            raise
+        work.text = None
+        work.data_dict['file_name'] = file_name
+        await self.enrich_stage.queue.put(work)
+
+    async def enrich(self, work: Work):
+        loop = asyncio.get_event_loop()
+        try:
+            # yFinance / sqlite block, so this gets a thread
+            work.data_dict = await loop.run_in_executor(None, self.sec.get_financial, work.data_dict)
+        except Exception as error:
+            self.release(work, error)
+            raise
+        await self.persist_stage.queue.put(work)
+
+    async def persist(self, work: Work):
+        try:
+            self.writer.insert_finance(work.data_dict)
+        except Exception as error:
+            self.release(work, error)
+            raise
+        logger.debug('CIK: %s Filing done in %.1fs.', pad_string(work.data_dict['cik']),
+                     time.monotonic() - work.started)
+        self.release(work)
+
+    async def diff(self, data_dict: dict):
+        result = await run_in_pool(self.pool, differences.create_diff, data_dict, size=data_dict.get('size', 0))
+        if result:
+            self.writer.update_difference(*result)
+
+    def fully_planned(self, cik):
+        return self.planning_done or cik in self.planned_ciks
+
+    def blocked(self, cik, old_accepted: int, new_accepted: int):
+        """ True when a filing of cik that may land between the two reports (accepted, epoch seconds) is outstanding """
+        if not self.fully_planned(cik):
+            return True
+        # A report is accepted on or a few days before the day it is filed
+        low = db.from_epoch(old_accepted - 5 * 86400)[:10]
+        high = db.from_epoch(new_accepted + 5 * 86400)[:10]
+        return any(low <= date_filed <= high for date_filed in self.outstanding.get(cik, ()))
+
+    async def queue_diffs(self, rows):
+        """ Queue every diff planned from rows that is not blocked.  Returns the CIKs that had a blocked diff. """
+        dates = {row[2]: row[3] for row in rows}
+        blocked = set()
+        planned = differences.add_sizes(list(differences.plan_differences(rows)))
+        for data_dict in planned:
+            if data_dict['id'] in self.scheduled_diffs:
+                continue
+            cik = data_dict['cik']
+            if self.blocked(cik, dates[data_dict['old_file']], dates[data_dict['current_file']]):
+                blocked.add(cik)
+                continue
+            # Marked only once it is in the queue.  A scheduler cancelled while waiting on a full queue must leave
+            # the diff to the final pass.
+            await self.diff_stage.queue.put(data_dict)
+            self.scheduled_diffs.add(data_dict['id'])
+        return blocked
+
+    async def schedule_diffs(self):
+        """ Look for new diffs of the CIKs that had a filing finish since the last look """
+        ciks = [cik for cik in self.dirty_ciks if self.fully_planned(cik)]
+        if not ciks:
+            return
+
+        # The reports have to be committed before we can look them up
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.writer.flush)
+        for cik in ciks:
+            self.dirty_ciks.discard(cik)
+            rows = await loop.run_in_executor(None, db.select_difference_rows, cik)
+            self.dirty_ciks.update(await self.queue_diffs(rows))
+
+    async def complete_ciks(self):
+        """
+        Mark the CIKs whose filings are all through as done, once their rows are committed.  A CIK that had a
+        filing fail goes back in the queue, the next claim only plans the filings still missing.
+        """
+        if not self.finished_ciks:
+            return
+        finished = list(self.finished_ciks)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.writer.flush)
+        failed = {cik: self.failed_filings.pop(cik) for cik in finished if cik in self.failed_filings}
+        await loop.run_in_executor(None, self.work.complete, [cik for cik in finished if cik not in failed])
+        for cik, error in failed.items():
+            await loop.run_in_executor(None, self.work.fail, cik, error)
+        self.finished_ciks.difference_update(finished)
+
+    async def diff_scheduler(self):
+        while True:
+            await asyncio.sleep(ev.pipeline_diff_interval)
+            try:
+                await self.schedule_diffs()
+                await self.complete_ciks()
+            except Exception as error:
+                logger.exception(f'Could not schedule differences: {error}')
+
+    async def boilerplate_updater(self):
+        """ Count the sentences of the filings cleaned since the last update into the boilerplate dictionary """
+        while True:
+            await asyncio.sleep(ev.boilerplate_refresh_seconds)
+            try:
+                # In the pool, so rebuilding old artifacts never blocks the loop
+                await run_in_pool(self.pool, boilerplate.update_dictionary)
+            except Exception as error:
+                logger.exception(f'Could not update the boilerplate dictionary: {error}')
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(ev.pipeline_report_seconds)
+            depths = ' '.join(f'{stage.name}: {stage.queue.qsize()}/{stage.processed}' for stage in self.stages)
+            logger.info(f'Pipeline queue depth/processed {depths} outstanding CIKs: {len(self.outstanding)}')
+
+    async def source(self):
+        """
+        Queue every CIK with pending filings, then claim CIKs and feed their filings into the fetch stage until
+        the queue is empty.  Blocks while the fetch queue is full.
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.work.enqueue, plan_cik_work(ev.sec_form_types))
+        while True:
+            claimed = await loop.run_in_executor(None, self.work.claim, ev.work_claim_size)
+            if not claimed:
+                break
+            for key, payload in claimed:
+                cik = int(key)
+                try:
+                    rows = await loop.run_in_executor(None, db.select_cik_pending_filings, ev.sec_form_types, cik)
+                except Exception as error:
+                    await loop.run_in_executor(None, self.work.fail, key, error)
+                    continue
+                for row in rows:
+                    filing = Filing(*row)
+                    self.outstanding[cik].append(filing.date_filed)
+                    await self.fetch_stage.queue.put(Work(filing))
+                self.planned_ciks.add(cik)
+                self.dirty_ciks.add(cik)
+                if cik not in self.outstanding:
+                    self.finished_ciks.add(cik)
+        self.planning_done = True
+
+    async def run_stages(self):
+        self.work = WorkQueue('filing')
+        with shared_pool() as self.pool, db.BatchWriter() as self.writer, self.work:
+            async with Fetcher() as self.fetcher:
+                for stage in self.stages:
+                    stage.start()
+                helpers = [asyncio.ensure_future(self.diff_scheduler()), asyncio.ensure_future(self.monitor())]
+                if ev.boilerplate:
+                    helpers.append(asyncio.ensure_future(self.boilerplate_updater()))
+
+                await self.source()
+                for stage in self.stages[:-1]:
+                    await stage.stop()
+
+                # Everything is in.  Pick up whatever is left, including diffs missing from earlier runs.
+                for helper in helpers:
+                    helper.cancel()
+                await asyncio.gather(*helpers, return_exceptions=True)
+                self.writer.flush()
+                await self.complete_ciks()
+                if ev.boilerplate:
+                    await run_in_pool(self.pool, boilerplate.update_dictionary)
+                # Leave the CIKs other processes are working on to them
+                busy = self.work.busy_keys()
+                await self.queue_diffs([row for row in db.select_difference_rows() if str(row[1]) not in busy])
+                await self.diff_stage.stop()
+
+        for stage in self.stages:
+            logger.info(f'Stage {stage.name}: {stage.processed} processed, {stage.failed} failed.')
+        boilerplate.report()
+
+    def run(self):
+        """ Download, clean, enrich and diff every filing in master_index we have not processed yet """
+        self.sec.prefetch_prices()
+        # Before the diffs are planned, which skips reports without a price
+        self.sec.backfill_prices()
+        logger.info(f'Started pipeline. Workers fetch: {self.fetch_stage.workers} clean: {self.clean_stage.workers} '
+                    f'enrich: {self.enrich_stage.workers} diff: {self.diff_stage.workers} '
+                    f'CPU\'s: {ev.number_of_cores}')
+        asyncio.run(self.run_stages())
+        logger.info('Finished pipeline.')
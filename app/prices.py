@@ -0,0 +1,232 @@
+import os
+import csv
+import time
+import logging
+import threading
+from datetime import date, datetime, timedelta
+
+from config import get_environment
+import db
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+
+class PriceProvider:
+    """
+    Where daily bars come from.  fetch_many returns {ticker: [(date, open, close), ...]} for every day
+    in [start, end) that has a bar.
+    """
+
+    def fetch_many(self, tickers, start: date, end: date):
+        raise NotImplementedError
+
+
+class YahooPriceProvider(PriceProvider):
+    """ Batched yFinance download.  One call covers a whole batch of tickers. """
+
+    def fetch_many(self, tickers, start: date, end: date):
+        import yfinance as yf
+
+        history = yf.download(list(tickers), start=start, end=end, group_by='ticker', auto_adjust=True,
+                              threads=True, progress=False)
+        bars = dict()
+        for ticker in tickers:
+            # group_by='ticker' gives (ticker, column) columns.  Older yfinance left them flat for a single ticker.
+            try:
+                if len(tickers) == 1 and 'Open' in history.columns:
+                    frame = history
+                else:
+                    frame = history[ticker]
+                frame = frame.dropna(subset=['Open', 'Close'])
+                bars[ticker] = [(index.date(), float(row.Open), float(row.Close))
+                                for index, row in frame.iterrows()]
+            except KeyError:
+                continue
+        return bars
+
+
+class FilePriceProvider(PriceProvider):
+    """
+    Reads bars from <folder>/<TICKER>.csv files with Date,Open,Close columns.  For tests and offline runs.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder or ev.price_files_folder
+
+    def fetch_many(self, tickers, start: date, end: date):
+        bars = dict()
+        for ticker in tickers:
+            path = os.path.join(self.folder, f'{ticker}.csv')
+            if not os.path.exists(path):
+                continue
+            with open(path, newline='') as price_file:
+                bars[ticker] = [
+                    (to_date(row['Date']), float(row['Open']), float(row['Close']))
+                    for row in csv.DictReader(price_file)
+                    if start <= to_date(row['Date']) < end
+                ]
+        return bars
+
+
+def get_price_provider():
+    if ev.price_provider == 'file':
+        return FilePriceProvider()
+    return YahooPriceProvider()
+
+
+class PriceStore:
+    """
+    Local store of daily bars in the price_bars table, in front of a PriceProvider.
+
+    prefetch() downloads the whole date range every ticker needs in a few batched calls.  daily_bars() then
+    answers from memory, only going to the provider for ranges that were never fetched.  price_coverage
+    remembers which ranges were fetched so days without a bar (weekends, holidays) are not asked for again.
+    A ticker the provider returned nothing for is not covered, it is only left alone for price_empty_retry_seconds.
+    """
+
+    def __init__(self, provider: PriceProvider = None):
+        self.provider = provider or get_price_provider()
+        self.lock = threading.Lock()
+        self.bars = dict()
+        self.coverage = dict()
+        # ticker -> (start, end, when) of the last fetch that came back without a bar
+        self.empty = dict()
+        create_price_tables()
+
+    def covered(self, conn, ticker: str, start: date, end: date):
+        row = conn.execute('SELECT start_date, end_date FROM price_coverage WHERE ticker=?', (ticker,)).fetchone()
+        return row is not None and row[0] <= start.isoformat() and end.isoformat() <= row[1]
+
+    def recently_empty(self, ticker: str, start: date, end: date):
+        empty = self.empty.get(ticker)
+        return (empty is not None and empty[0] <= start and end <= empty[1]
+                and time.monotonic() - empty[2] < ev.price_empty_retry_seconds)
+
+    def store(self, conn, start: date, end: date, bars: dict, tickers):
+        # Days after today may still get a bar, so never mark them as covered
+        end = min(end, date.today())
+        with conn:
+            for ticker in tickers:
+                self.bars.pop(ticker, None)
+                self.coverage.pop(ticker, None)
+                if not bars.get(ticker):
+                    # Failed or unknown to the provider.  Covering it would keep it without a price for good.
+                    metrics.count('empty', 'prices_fetch')
+                    self.empty[ticker] = (start, end, time.monotonic())
+                    continue
+                self.empty.pop(ticker, None)
+                conn.executemany('INSERT OR REPLACE INTO price_bars (ticker, date, open, close) VALUES (?, ?, ?, ?)',
+                                 [(ticker, day.isoformat(), open_price, close_price)
+                                  for day, open_price, close_price in bars.get(ticker, ())])
+
+                row = conn.execute('SELECT start_date, end_date FROM price_coverage WHERE ticker=?', (ticker,)).fetchone()
+                new_start, new_end = start.isoformat(), end.isoformat()
+                if row and row[0] <= new_end and new_start <= row[1]:
+                    new_start, new_end = min(row[0], new_start), max(row[1], new_end)
+                conn.execute('INSERT OR REPLACE INTO price_coverage (ticker, start_date, end_date) VALUES (?, ?, ?)',
+                             (ticker, new_start, new_end))
+
+    def prefetch(self, ranges: dict, batch_size=None):
+        """
+        ranges is {ticker: (start, end)}.  Tickers are downloaded in batches, each batch over the union of its
+        ranges, skipping tickers whose range is already stored.
+        """
+        batch_size = batch_size or ev.price_batch_size
+        conn = db.connect_to_db()
+        missing = sorted(ticker for ticker, (start, end) in ranges.items()
+                         if not self.covered(conn, ticker, start, end))
+        logger.info(f'Prefetching prices for {len(missing)} of {len(ranges)} ticker(s).')
+
+        for i in range(0, len(missing), batch_size):
+            tickers = missing[i:i + batch_size]
+            start = min(ranges[ticker][0] for ticker in tickers)
+            end = max(ranges[ticker][1] for ticker in tickers)
+            try:
+                with metrics.timed('prices_fetch'):
+                    bars = self.provider.fetch_many(tickers, start, end)
+                metrics.count('tickers', 'prices_fetch', len(tickers))
+            except Exception as e:
+                logger.error(f'Could not prefetch prices for {tickers}. Error: {e}')
+                continue
+            with self.lock:
+                self.store(conn, start, end, bars, tickers)
+        conn.close()
+
+    def daily_bars(self, ticker: str, start: date, end: date):
+        """
+        {date: (open, close)} for the days in [start, end) that have a bar.  The lock is not held while the
+        provider is asked, so one slow download does not hold up the lookups of every other ticker.
+        """
+        with self.lock:
+            coverage = self.coverage.get(ticker)
+            if ticker in self.bars and coverage and coverage[0] <= start and end <= coverage[1]:
+                return {day: bar for day, bar in self.bars[ticker].items() if start <= day < end}
+            recently_empty = self.recently_empty(ticker, start, end)
+
+        conn = db.connect_to_db()
+        try:
+            if not self.covered(conn, ticker, start, end) and not recently_empty:
+                with metrics.timed('prices_fetch'):
+                    fetched = self.provider.fetch_many([ticker], start, end)
+                metrics.count('tickers', 'prices_fetch')
+                with self.lock:
+                    self.store(conn, start, end, fetched, [ticker])
+            else:
+                metrics.count('store_hits', 'prices')
+            with self.lock:
+                rows = conn.execute('SELECT date, open, close FROM price_bars WHERE ticker=?', (ticker,)).fetchall()
+                self.bars[ticker] = {to_date(day): (open_price, close_price) for day, open_price, close_price in rows}
+                row = conn.execute('SELECT start_date, end_date FROM price_coverage WHERE ticker=?', (ticker,)).fetchone()
+                self.coverage[ticker] = (to_date(row[0]), to_date(row[1])) if row else None
+                bars = self.bars[ticker]
+        finally:
+            conn.close()
+        return {day: bar for day, bar in bars.items() if start <= day < end}
+
+
+def create_price_tables():
+    conn = db.connect_to_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_bars(
+                        ticker text,
+                        date text,
+                        open real,
+                        close real,
+                        PRIMARY KEY (ticker, date)
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_coverage(
+                        ticker text PRIMARY KEY,
+                        start_date text,
+                        end_date text
+                    )''')
+    conn.commit()
+    conn.close()
+
+
+def price_ranges(cik_ranges, cik_to_ticker_dict):
+    """
+    Turn (cik, first date filed, last date filed) rows into {ticker: (start, end)}.
+
+    A 10-Q is accepted on or a few days before the day it is filed and we need the two days after it was
+    accepted, hence the padding on both ends.
+    """
+    ranges = dict()
+    for cik, first_filed, last_filed in cik_ranges:
+        ticker = cik_to_ticker_dict.get(str(cik))
+        if not ticker:
+            continue
+        start = to_date(first_filed) - timedelta(days=5)
+        end = to_date(last_filed) + timedelta(days=5)
+        if ticker in ranges:
+            start, end = min(start, ranges[ticker][0]), max(end, ranges[ticker][1])
+        ranges[ticker] = (start, end)
+    return ranges
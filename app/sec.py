@@ -1,67 +1,62 @@
-import os
+import io
+import re
+import html
+import asyncio
+import hashlib
 import logging
 import zipfile
-import multiprocessing
-import urllib.request
-import urllib.parse
-from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
 
-from config import Environment
-from laundry import FilingCleaner
+from config import get_environment
+from artifacts import write_artifact
+from store import get_store
+from workers import shared_pool
+from fetch import Fetcher, FetchResult, decode_body, drain, run_in_pool
 from finance import get_financial, generate_cik_to_ticker_dict
+from prices import PriceStore, price_ranges
 import db
+import metrics
 
-import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
-ev = Environment()
+ev = get_environment()
 logger = logging.getLogger(ev.app_name)
 
+# The SGML header of a complete submission has the acceptance time, every document after it a TYPE line
+ACCEPTANCE_DATETIME = re.compile(rb'<ACCEPTANCE-DATETIME>(\d{14})')
 
-def remove_master_index_file():
-    """ Remove the old master index file.  Since we append to the file we need to start with a fresh slate """
-    try:
-        os.remove(f'{ev.output_folder}/master.idx')
-        logger.info(f'Deleted {ev.output_folder}/master.idx file.')
-    except FileNotFoundError:
-        pass
+# The bits of the -index.html page we need
+INDEX_ACCEPTED = re.compile(r'<div class="infoHead">\s*Accepted\s*</div>\s*<div class="info">([^<]*)</div>')
+INDEX_DOCUMENT_TABLE = re.compile(
+    r'<table[^>]*class="tableFile"[^>]*summary="Document Format Files"[^>]*>(.*?)</table>', re.DOTALL)
+INDEX_ROW = re.compile(r'<tr[^>]*>(.*?)</tr>', re.DOTALL)
+INDEX_CELL = re.compile(r'<td[^>]*>(.*?)</td>', re.DOTALL)
+INDEX_HREF = re.compile(r'<a[^>]*href="([^"]+)"')
+TAG = re.compile(r'<[^>]+>')
 
 
 def remove_filing_files():
-    """ Remove previously downloaded files """
-    logger.info(f'Started deleting all cleaned files from {ev.output_cleaned_files}.')
-    file_list = os.listdir(ev.output_cleaned_files)
-    for file in file_list:
-        if file.endswith(".txt"):
-            os.remove(f'{ev.output_cleaned_files}/{file}')
-    logger.info(f'Finished deleting all cleaned files from {ev.output_cleaned_files}.')
+    """ Remove previously cleaned filings """
+    store = get_store()
+    logger.info(f'Started deleting all cleaned files from {store.folder}.')
+    store.clear()
+    logger.info(f'Finished deleting all cleaned files from {store.folder}.')
 
 
 def pad_string(string: str, padding_length=10, padding_character='0'):
     return string.rjust(padding_length, padding_character)
 
 
-def append_master_index(zip_file):
-    """
-    Here we extract the the master.idx from the the zip file and append it to the our master.idx
-    """
-    with zipfile.ZipFile(zip_file) as edgar_file:
-        logger.info(f'Started extracting {zip_file}.')
-        zip_data = edgar_file.read('master.idx').splitlines()
-        with open(f'{ev.output_folder}/master.idx', "a") as master_index:
-            for line in zip_data:
-                line = line.decode()
+def quarter_is_closed(year: int, quarter: str):
+    """ A quarter that has ended will never get new filings, so its master.zip can be cached for good """
+    today = datetime.today()
+    current_quarter = (today.month - 1) // 3 + 1
+    return (year, int(quarter[-1])) < (today.year, current_quarter)
 
-                # If this is a 10-Q filing then add it to the master index file
-                if '|' in line and ev.sec_form_type in line and not line.startswith('CIK'):
-                    master_index.write(f'{line}\n')
-        logger.info(f'Finished extracting {zip_file}.')
 
-
-def download_master_zip():
+def master_index_quarters():
     """
-    Retrieve quarter master.zip file from sec website for each given year and or quarter
+    Every (year, quarter) we want a master index for.
 
     This is controlled by setting two variables in either your .env file
     or modifying config.py file.  The two variables are:
@@ -71,132 +66,413 @@ def download_master_zip():
 
     Fiscal year says what years to get.  If sec_analyze_quarter is gone then it will default to QTR1, QTR2, QTR3, QTR4
     If you specify a quarter then it will process that quarter for the give fiscal year.
+    Quarters in the future are skipped.
+    """
+    today = datetime.today()
+    current_quarter = (today.year, (today.month - 1) // 3 + 1)
+
+    if ev.sec_analyze_quarter:
+        quarters = [ev.sec_analyze_quarter]
+    else:
+        quarters = ['QTR1', 'QTR2', 'QTR3', 'QTR4']
+
+    for year in range(int(ev.sec_analyze_since_fy), today.year + 1):
+        for quarter in quarters:
+            if (year, int(quarter[-1])) <= current_quarter:
+                yield year, quarter
 
-    The program defaults to 2020 and all quarters
+
+def parse_master_zip(content: bytes, form_types):
+    """
+    Stream master.idx out of a master.zip and keep the filings of the given form types.  Runs in the CPU pool.
     """
-    remove_master_index_file()
+    with zipfile.ZipFile(io.BytesIO(content)) as edgar_file:
+        with edgar_file.open('master.idx') as master_index:
+            return parse_master_lines(master_index, form_types)
 
-    logger.info(f'Started retrieving edgar master zip files since {ev.sec_analyze_since_fy}.')
-    year = int(ev.sec_analyze_since_fy)
-    while year <= datetime.today().year:
 
-        if ev.sec_analyze_quarter:
-            quarters = [ev.sec_analyze_quarter]
-        else:
-            quarters = ['QTR1', 'QTR2', 'QTR3', 'QTR4']
+def parse_master_lines(lines, form_types):
+    """
+    (file_name, cik, company_name, form_type, date_filed) of the filings of the given form types in the lines of
+    a master.idx, quarterly or daily.
+
+    Lines look like CIK|Company Name|Form Type|Date Filed|Filename.  The form type has to match exactly,
+    so 10-Q does not pick up 10-Q/A.  The daily index writes the date filed as YYYYMMDD.
+    """
+    records = list()
+    for line in lines:
+        fields = line.decode('utf-8', errors='replace').rstrip('\r\n').split('|')
+
+        # Skips the description at the top of the file and the CIK|Company Name|... header
+        if len(fields) != 5 or fields[2] not in form_types or not fields[0].isdigit():
+            continue
+        (cik, company_name, form_type, date_filed, file_name) = fields
+        if len(date_filed) == 8:
+            date_filed = f'{date_filed[:4]}-{date_filed[4:6]}-{date_filed[6:]}'
+        records.append((file_name, int(cik), company_name, form_type, date_filed))
+    return records
 
-        for quarter in quarters:
-            try:
-                # Download and save it
+
+async def ingest_master_index(form_types):
+    """
+    Download and parse the quarters we do not have yet, several at a time, straight into the master_index table.
+    """
+    ingested = db.get_ingested_quarters(form_types)
+    quarters = [(year, quarter) for year, quarter in master_index_quarters() if (year, quarter) not in ingested]
+    logger.info(f'{len(quarters)} quarter(s) of master index to retrieve. {len(ingested)} already ingested.')
+
+    loop = asyncio.get_event_loop()
+
+    # sqlite has one writer at a time anyway.  One thread keeps the inserts from fighting over the lock.
+    with ThreadPoolExecutor(max_workers=1) as db_writer, shared_pool() as pool:
+        async with Fetcher() as fetcher:
+            async def ingest(year_quarter):
+                year, quarter = year_quarter
+                closed = quarter_is_closed(year, quarter)
                 zip_file = f'{ev.sec_website}/Archives/edgar/full-index/{year}/{quarter}/master.zip'
-                save_to = f'{ev.output_folder}/{year}{quarter}.zip'
 
                 logger.info(f'Started processing and retrieving {year} {quarter} master.zip.')
+                response = await fetcher.get(zip_file, immutable=closed)
+                if response is None:
+                    logger.error(f'Could not retrieve the {year}{quarter} master.zip file.')
+                    return
 
-                urllib.request.urlretrieve(zip_file, save_to)
-                append_master_index(save_to)
-                os.remove(save_to)
+                records = await run_in_pool(pool, parse_master_zip, response.body, form_types,
+                                            size=len(response.body))
+                await loop.run_in_executor(db_writer, db.insert_master_index, year, quarter, closed, form_types,
+                                           records)
+                logger.info(f'Finished processing {year} {quarter} master.zip. {len(records)} filing(s).')
 
-                logger.info(f'Finished processing and retrieving master.zip.')
+            await drain(quarters, ingest, ev.master_index_concurrency)
 
-            except HTTPError as http_error:
-                # The file does not exist.  No worries.  Probably a quarter in the future.
-                logger.error(f'An error occurred while trying to retrieve the {year}{quarter} master.zip file. '
-                             f'Error: {http_error}')
-        year += 1
+
+def download_master_zip():
+    """
+    Retrieve quarter master.zip file from sec website for each given year and or quarter into the
+    master_index table.  See master_index_quarters for which quarters.
+
+    Quarters that have ended never change, so once ingested they are skipped.  Only the open quarter
+    is refreshed on every run.
+    """
+    logger.info(f'Started retrieving edgar master zip files since {ev.sec_analyze_since_fy}.')
+    asyncio.run(ingest_master_index(ev.sec_form_types))
     logger.info(f'Finished retrieving edgar master zip files.')
 
 
+class Filing:
+    """
+    A filing from the master index that still has to be downloaded and cleaned.
+    Slotted because a full history backfill plans hundreds of thousands of them.
+    """
+    __slots__ = ('cik', 'company_name', 'form_type', 'date_filed', 'file_name')
+
+    def __init__(self, cik, company_name, form_type, date_filed, file_name):
+        self.cik = cik
+        self.company_name = company_name
+        self.form_type = form_type
+        self.date_filed = date_filed
+        self.file_name = file_name
+
+    def __repr__(self):
+        return f'Filing({self.cik}, {self.form_type}, {self.date_filed}, {self.file_name})'
+
+    @property
+    def url(self):
+        return f'{ev.sec_website}/Archives/{self.file_name.replace(".txt", "-index.html")}'
+
+    @property
+    def submission_url(self):
+        """ The complete submission: SGML header and every document of the filing in one file """
+        return f'{ev.sec_website}/Archives/{self.file_name}'
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'submission_url': self.submission_url,
+            'cik': str(self.cik),
+            'date_filed': self.date_filed,
+            'company_name': self.company_name,
+            'form_type': self.form_type,
+            'ticker_symbol': None,
+            'prc_change': None,
+            'prc_change2': None
+        }
+
+
+def plan_filings(form_types, chunk_size=None):
+    """
+    Yield every filing of form_types in master_index that is not in marko_finance yet.
+
+    Each chunk is one anti-join query resumed from the last key of the previous chunk, so no read
+    transaction is held open while the downloads insert their results.
+    """
+    chunk_size = chunk_size or ev.plan_chunk_size
+    last_key = (-1, '', '')
+    planned = 0
+    while True:
+        rows = db.select_pending_filings(form_types, last_key, chunk_size)
+        if not rows:
+            break
+        for row in rows:
+            yield Filing(*row)
+        planned += len(rows)
+        last_key = (rows[-1][0], rows[-1][3], rows[-1][4])
+        logger.debug(f'Planned {planned} filing(s) so far.')
+    logger.info(f'Planned {planned} filing(s) to download and clean.')
+
+
+def plan_cik_work(form_types):
+    """
+    One work item per CIK with filings to download: (cik, payload, priority) for WorkQueue.enqueue.
+
+    A CIK is the unit of work because its diffs need every report of it.  The payload fingerprints the pending
+    filings, so a CIK that is done is only queued again when a new filing of it shows up or one of them failed.
+    """
+    cik = None
+    file_names = list()
+    for filing in plan_filings(form_types):
+        if filing.cik != cik and file_names:
+            yield cik, cik_payload(file_names), 0
+            file_names = list()
+        cik = filing.cik
+        file_names.append(filing.file_name)
+    if file_names:
+        yield cik, cik_payload(file_names), 0
+
+
+def cik_payload(file_names):
+    fingerprint = hashlib.sha1('\n'.join(file_names).encode('utf-8')).hexdigest()
+    return {'filings': len(file_names), 'fingerprint': fingerprint}
+
+
+def document_type_line(form_type: str):
+    """ <TYPE>10-Q on a line of its own, so 10-Q does not match 10-Q/A """
+    return re.compile(rb'<TYPE>' + re.escape(form_type.encode('utf-8')) + rb'[ \t]*\r?\n')
+
+
+class PrimaryDocumentRead:
+    """
+    until for Fetcher.get: True once the first document of form_type in a complete submission is complete.
+    The primary document comes first, so the exhibits and XBRL after it are never downloaded.
+    """
+
+    def __init__(self, form_type: str):
+        self.type_line = document_type_line(form_type)
+        self.document_start = None
+
+    def __call__(self, body, start: int):
+        if self.document_start is None:
+            # Back up a little in case the TYPE line is split between two chunks
+            match = self.type_line.search(body, max(0, start - 64))
+            if match is None:
+                return False
+            self.document_start = match.end()
+        return body.find(b'</DOCUMENT>', max(self.document_start, start - 16)) != -1
+
+
+def parse_submission(content: bytes, form_type: str):
+    """
+    Take the document of form_type and the acceptance time out of a complete submission .txt.
+    Returns (document bytes, date_accepted) or None.
+
+    iXBRL documents are wrapped in <XBRL> inside <TEXT>.  Without the wrapper they are the same bytes as the
+    document the index page links to.
+    """
+    header_end = content.find(b'<DOCUMENT>')
+    accepted = ACCEPTANCE_DATETIME.search(content, 0, header_end if header_end != -1 else len(content))
+    match = document_type_line(form_type).search(content)
+    if accepted is None or match is None:
+        return None
+
+    document_end = content.find(b'</DOCUMENT>', match.end())
+    if document_end == -1:
+        return None
+    text_start = content.find(b'<TEXT>', match.end(), document_end)
+    text_end = content.rfind(b'</TEXT>', match.end(), document_end)
+    if text_start == -1 or text_end == -1:
+        return None
+    document = content[text_start + len(b'<TEXT>'):text_end].strip()
+    if document[:6].upper() == b'<XBRL>' and document[-7:].upper() == b'</XBRL>':
+        document = document[6:-7].strip()
+
+    date_accepted = datetime.strptime(accepted.group(1).decode('ascii'), '%Y%m%d%H%M%S')
+    return document, date_accepted.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def document_href(filing_href: str):
+    """ iXBRL documents are linked through the viewer, /ix?doc=/Archives/...  We want the document itself. """
+    if 'ix?' in filing_href:
+        filing_href = '/' + '/'.join(filing_href.split('/')[2:])
+    return filing_href
+
+
+def scan_filing_index(content: bytes, form_type: str):
+    """
+    Read the -index.html overview of a filing with a few regular expressions aimed at the document table and
+    the Accepted field.  Returns (filing_href, date_accepted) of the document of form_type or None.
+    Raises LookupError when the page does not look like it should.
+    """
+    page = content.decode('utf-8', errors='replace')
+    table = INDEX_DOCUMENT_TABLE.search(page)
+    accepted = INDEX_ACCEPTED.search(page)
+    if table is None or accepted is None:
+        raise LookupError('Unknown filing index layout')
+
+    for row in INDEX_ROW.finditer(table.group(1)):
+        cells = INDEX_CELL.findall(row.group(1))
+        if len(cells) >= 4 and html.unescape(TAG.sub('', cells[3])).strip() == form_type:
+            href = INDEX_HREF.search(cells[2])
+            if href:
+                return document_href(html.unescape(href.group(1))), accepted.group(1).strip()
+    return None
+
+
+def parse_filing_index(content: bytes, form_type: str):
+    """ scan_filing_index, or BeautifulSoup when the layout is not what scan_filing_index expects """
+    try:
+        return scan_filing_index(content, form_type)
+    except LookupError:
+        metrics.count('soup_fallbacks', 'resolve')
+        return parse_filing_index_soup(content, form_type)
+
+
+def parse_filing_index_soup(content: bytes, form_type: str):
+    """
+    Parse the -index.html overview of a filing with BeautifulSoup.  Slow, but does not care about the layout.
+    Returns (filing_href, date_accepted) of the document of form_type or None.
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content.decode('utf-8'), "lxml")
+    documents = soup.find('table', {'class': 'tableFile', 'summary': 'Document Format Files'})
+    if documents:
+        for tr in documents.find_all('tr'):
+            td = tr.find_all('td')
+            if len(td) >= 4 and td[3].text == form_type:
+                filing_url = td[2].find('a', href=True)
+                filing_href = filing_url['href']
+                date_accepted = soup.find('div', attrs={'class': 'infoHead'}, text='Accepted')\
+                                    .findNext('div', {'class': 'info'}).text
+                return document_href(filing_href), date_accepted
+    return None
+
+
+def clean_filing(text: str, data_dict: dict):
+    """
+    Strip the 10-Q down to text and save it along with its sentence artifact for create_diff.
+    Runs in the CPU pool.
+    """
+    # bs4 and lxml are only loaded by the processes that clean
+    from laundry import FilingCleaner
+    laundry = FilingCleaner(text, data_dict)
+    file_name = laundry.wash()
+    with metrics.timed('write_artifact'):
+        write_artifact(file_name, laundry.text)
+    metrics.add_bytes('clean_filing', 'in', len(text))
+    metrics.add_bytes('clean_filing', 'out', len(laundry.text))
+    return file_name
+
+
 class SEC:
     def __init__(self):
-        # Had to make this a class just so I can generate the CIK -> ticker symbol dict one time.  Hate
-        # to use global.  Interested in doing this another way?  Could store in sqlite?
+        # The CIK -> ticker symbol map lives in the cik_ticker table.  It is refreshed there when it is older than
+        # SEC_TICKER_REFRESH_HOURS and read into this dict once per run.
         self.cik_to_ticker_dict = generate_cik_to_ticker_dict()
+        self.prices = PriceStore()
+
+    async def download_filing(self, fetcher: Fetcher, pool, data_dict: dict):
+        """
+        Returns the text of the 10-Q or None, and sets data_dict['date_accepted'].
+
+        With SEC_DOCUMENT_SOURCE=submission (the default) one request does it: the 10-Q and the acceptance time
+        are streamed out of the complete submission .txt.  When that does not work, or with
+        SEC_DOCUMENT_SOURCE=index, the -index.html overview is downloaded for the acceptance time and the link
+        to the 10-Q, and then the 10-Q itself.
+        """
+        if ev.sec_document_source == 'submission' and data_dict.get('submission_url'):
+            text = await self.download_submission(fetcher, data_dict)
+            if text is not None:
+                metrics.count('submission', 'resolve')
+                return text
+            metrics.count('index_fallbacks', 'resolve')
+        return await self.download_from_index(fetcher, pool, data_dict)
+
+    async def download_submission(self, fetcher: Fetcher, data_dict: dict):
+        url = data_dict['submission_url']
+        cik = pad_string(data_dict['cik'])
 
-    def download_and_clean_files(self, data_dict: dict):
+        logger.info('CIK: %s Processing %s', cik, url)
+        form_type = data_dict['form_type']
+        response = await fetcher.get(url, until=PrimaryDocumentRead(form_type))
+        if response is None:
+            return None
+        submission = parse_submission(response.body, form_type)
+        if submission is None:
+            logger.warning(f'CIK: {cik} No {form_type} document in {url}.  Trying the index page.')
+            return None
+        document, data_dict['date_accepted'] = submission
+        return decode_body(FetchResult(url, response.status, document, response.headers))
+
+    async def download_from_index(self, fetcher: Fetcher, pool, data_dict: dict):
         """
-        We are passed a dictionary that contains the url of the overview of the 10-Q report and the CIK of the company.
-        1) Download the overview 10-Q report
-        2) Parse the report and find the 'Accepted Date'
-        3) Gather any financial data from Yahoo about the 10-Q report
-        4) If financial data was found the download the 10-Q report and strip out most the HTML.  Used later
-           to compare to a previous quarter 10-Q report.  Used for the AI part.
+        1) Download the overview of the 10-Q report
+        2) Find the 'Accepted Date' and the link to the 10-Q.  The layout changed?  Then BeautifulSoup does it
+           in the CPU pool.
+        3) Download the 10-Q report itself
         """
         url = data_dict['url']
         cik = pad_string(data_dict['cik'])
 
-        logger.info(f'CIK: {cik} Processing {url}')
+        logger.info('CIK: %s Processing %s', cik, url)
+        response = await fetcher.get(url)
+        if response is None:
+            logger.error(f'CIK: {cik} Could not retrieve {url}.')
+            return None
+
         try:
-            response = requests.get(url)
-        except requests.exceptions.ConnectionError as connection_error:
-            logger.error(f'CIK: {cik} Encountered an error connecting to {url}.  Error: {connection_error}')
-            return
-
-        soup = BeautifulSoup(response.content.decode('utf-8'), "lxml")
-        documents = soup.find('table', {'class': 'tableFile', 'summary': 'Document Format Files'})
-        if documents:
-            for tr in documents.find_all('tr'):
-                td = tr.find_all('td')
-                if len(td) >= 4 and td[3].text == ev.sec_form_type:
-                    filing_url = td[2].find('a', href=True)
-                    filing_href = filing_url['href']
-                    data_dict['date_accepted'] = soup.find('div', attrs={'class': 'infoHead'}, text='Accepted')\
-                                                     .findNext('div', {'class': 'info'}).text
-
-                    # Get financial data, if any
-                    logger.debug(f'CIK: {cik} Started checking for financial data.')
-                    finance_data = get_financial(data_dict, self.cik_to_ticker_dict)
-                    logger.debug(f'CIK: {cik} Finished checking for financial data.')
-
-                    if 'ix?' in filing_href:
-                        filing_href = '/' + '/'.join(filing_href.split('/')[2:])
-
-                    response = requests.request('GET', ev.sec_website + filing_href)
-
-                    laundry = FilingCleaner(response.text, data_dict)
-                    finance_data['file_name'] = laundry.wash()
-                    db.insert_into_finance(finance_data)
-                    break
-        return
-
-    def process_master_index(self):
+            document = scan_filing_index(response.body, data_dict['form_type'])
+        except LookupError:
+            metrics.count('soup_fallbacks', 'resolve')
+            document = await run_in_pool(pool, parse_filing_index_soup, response.body, data_dict['form_type'],
+                                         size=len(response.body))
+        if document is None:
+            return None
+        filing_href, data_dict['date_accepted'] = document
+
+        response = await fetcher.get(ev.sec_website + filing_href)
+        if response is None:
+            logger.error(f'CIK: {cik} Could not retrieve {filing_href}.')
+            return None
+        return decode_body(response)
+
+    def get_financial(self, data_dict: dict):
+        """ Gather any financial data from Yahoo about the 10-Q report """
+        return get_financial(data_dict, self.cik_to_ticker_dict, self.prices)
+
+    def backfill_prices(self, days=None):
         """
-        Process the master.idx located in the output directory.
-
-        Process each line of the master.idx file.  This file in delimited by pipe symbol '|'
-        For each line we extract the data then we download and clean the 10-Q.
+        Price the reports stored before the days after them had a bar, the ones watch mode diffs the evening they
+        are accepted.  Every report of the last days (PRICE_BACKFILL_DAYS) without prc_change2 whose second day
+        after acceptance is over is looked up again.  Returns how many got a price.
         """
-        master_index = open(f'{ev.output_folder}/master.idx')
-        lines = master_index.read().splitlines()
-        master_index.close()
-
-        # Allow us to resume in case of error / power outage / mistake
-        conn = db.connect_to_db()
-        cursor = conn.cursor()
-
-        files_to_download_and_clean = list()
-        for line in lines:
-            (cik, company_name, form_type, date_filed, file_name) = line.split('|')
-
-            # Process it if we have not yet.
-            sql = 'select cik from marko_finance where cik=? and date_filed=?'
-            cursor.execute(sql, (cik, date_filed))
-            results = cursor.fetchall()
-            if form_type == ev.sec_form_type and len(results) == 0:
-                files_to_download_and_clean.append({
-                    'url': f'{ev.sec_website}/Archives/{file_name.replace(".txt", "-index.html")}',
-                    'cik': cik,
-                    'date_filed': date_filed,
-                    'company_name': company_name,
-                    'ticker_symbol': None,
-                    'prc_change': None,
-                    'prc_change2': None
-                })
-        conn.close()
-
-        with multiprocessing.Pool(processes=ev.number_of_cores) as pool:
-            logger.info(f'Started processing files. Number of CPU\'s: {ev.number_of_cores}')
-            pool.map(self.download_and_clean_files, files_to_download_and_clean)
-            logger.info('Finished processing files.')
-        pool.close()
-        pool.join()
+        days = ev.price_backfill_days if days is None else days
+        today = date.today()
+        rows = db.select_unpriced_reports(db.to_epoch(f'{today - timedelta(days=days)} 00:00:00'),
+                                          db.to_epoch(f'{today - timedelta(days=2)} 00:00:00'))
+        priced = 0
+        with db.BatchWriter() as writer:
+            for record_id, cik, date_accepted, form_type in rows:
+                data_dict = self.get_financial({'cik': str(cik), 'date_accepted': db.from_epoch(date_accepted),
+                                                'form_type': form_type, 'ticker_symbol': None, 'prc_change': None,
+                                                'prc_change2': None})
+                if data_dict['prc_change'] is not None:
+                    writer.update_prices(record_id, data_dict)
+                    priced += 1
+        metrics.count('backfilled', 'prices', priced)
+        if rows:
+            logger.info(f'Priced {priced} of {len(rows)} report(s) stored without prices.')
+        return priced
+
+    def prefetch_prices(self):
+        """ One batched price download per group of tickers instead of one per filing """
+        cik_ranges = db.select_pending_date_ranges(ev.sec_form_types)
+        self.prices.prefetch(price_ranges(cik_ranges, self.cik_to_ticker_dict))
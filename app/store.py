@@ -0,0 +1,242 @@
+import os
+import sys
+import mmap
+import time
+import uuid
+import zlib
+import struct
+import logging
+import threading
+
+from config import get_environment
+import db
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# Every record starts with a header so a segment can be walked without the index: magic, name length,
+# compressed length, raw length.  Then the name and the zlib compressed body.
+RECORD_MAGIC = b'FSR1'
+RECORD_HEADER = struct.Struct('<4sIII')
+
+
+class FilingStore:
+    """
+    Append-only packed store for cleaned filings and their sentence artifacts.
+
+    Every process appends to its own segment file, segment-<pid>-<token>.seg, so writers never share a file
+    and a worker killed halfway leaves nothing but an unindexed tail.  Each record is compressed on its own and
+    its location goes into the filing_store table, so a reader is one index lookup and one slice of an mmap away
+    from a record.  Segments roll over at store_segment_mb.
+
+        store = get_store()
+        store.put('320193-2020-05-01.txt', text)
+        text = store.get_text('320193-2020-05-01.txt')
+
+    Records are never rewritten.  Storing a name again points the index at the new record.
+    """
+
+    def __init__(self, folder=None, segment_bytes=None):
+        self.folder = folder or ev.output_filing_store
+        self.segment_bytes = segment_bytes or ev.store_segment_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_file = None
+        self.maps = dict()
+        self.conn = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def connection(self):
+        if self.conn is None:
+            create_store_table()
+            self.conn = db.connect_to_db()
+        return self.conn
+
+    def open_segment(self):
+        if self.segment_file:
+            self.segment_file.close()
+        self.segment = f'segment-{os.getpid()}-{uuid.uuid4().hex[:8]}.seg'
+        self.segment_file = open(os.path.join(self.folder, self.segment), 'ab')
+
+    def put(self, name: str, data, level=6):
+        """ Append a record and index it.  data is bytes or str. """
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        body = zlib.compress(raw, level)
+        encoded_name = name.encode('utf-8')
+
+        with self.lock:
+            if self.segment_file is None or self.segment_file.tell() >= self.segment_bytes:
+                self.open_segment()
+            offset = self.segment_file.tell()
+            self.segment_file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(encoded_name), len(body), len(raw)))
+            self.segment_file.write(encoded_name)
+            self.segment_file.write(body)
+            # Readers in other processes map the file, so the bytes have to be in it before the index says so
+            self.segment_file.flush()
+
+            body_offset = offset + RECORD_HEADER.size + len(encoded_name)
+            conn = self.connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO filing_store (name, segment, offset, length, raw_length, '
+                             'stored_at) VALUES (?, ?, ?, ?, ?, ?)',
+                             (name, self.segment, body_offset, len(body), len(raw), time.time()))
+        return self.segment, body_offset, len(body)
+
+    def view(self, segment: str, offset: int, length: int):
+        """ memoryview of a compressed record straight out of the segment's mmap """
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < offset + length:
+            # Not mapped yet, or mapped before this record was appended
+            if segment_map is not None:
+                segment_map.close()
+            with open(os.path.join(self.folder, segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return memoryview(segment_map)[offset:offset + length]
+
+    def locate(self, names):
+        conn = self.connection()
+        placeholders = ', '.join('?' * len(names))
+        return {row[0]: row[1:] for row in conn.execute(
+            f'SELECT name, segment, offset, length FROM filing_store WHERE name IN ({placeholders})', list(names))}
+
+    def get_many(self, names):
+        """ {name: bytes} for every name that is stored.  One index query for all of them. """
+        with self.lock:
+            records = dict()
+            for name, (segment, offset, length) in self.locate(names).items():
+                view = self.view(segment, offset, length)
+                try:
+                    records[name] = zlib.decompress(view)
+                finally:
+                    view.release()
+            return records
+
+    def get(self, name: str):
+        return self.get_many([name]).get(name)
+
+    def get_text(self, name: str):
+        data = self.get(name)
+        return None if data is None else data.decode('utf-8')
+
+    def sizes(self, names):
+        """ {name: uncompressed size} of the stored names """
+        names = list(names)
+        sizes = dict()
+        conn = self.connection()
+        # Older sqlite builds allow 999 parameters per statement
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            sizes.update(conn.execute(f'SELECT name, raw_length FROM filing_store WHERE name IN ({placeholders})',
+                                      chunk))
+        return sizes
+
+    def names(self, suffix=''):
+        return [row[0] for row in self.connection().execute(
+            'SELECT name FROM filing_store WHERE name LIKE ?', (f'%{suffix}',))]
+
+    def scan(self, segment: str):
+        """ (name, body offset, length, raw length) of every complete record in a segment, without the index """
+        with open(os.path.join(self.folder, segment), 'rb') as segment_file:
+            data = segment_file.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            magic, name_length, length, raw_length = RECORD_HEADER.unpack_from(data, offset)
+            body_offset = offset + RECORD_HEADER.size + name_length
+            if magic != RECORD_MAGIC or body_offset + length > len(data):
+                break
+            yield data[offset + RECORD_HEADER.size:body_offset].decode('utf-8'), body_offset, length, raw_length
+            offset = body_offset + length
+
+    def clear(self):
+        """ Drop every record and segment """
+        with self.lock:
+            self.close_files()
+            conn = self.connection()
+            with conn:
+                conn.execute('DELETE FROM filing_store')
+            for name in os.listdir(self.folder):
+                if name.endswith('.seg'):
+                    os.remove(os.path.join(self.folder, name))
+
+    def close_files(self):
+        for segment_map in self.maps.values():
+            segment_map.close()
+        self.maps.clear()
+        if self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+
+    def close(self):
+        with self.lock:
+            self.close_files()
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+_stores = dict()
+
+
+def get_store():
+    """
+    The store of this process.  Keyed by pid, so a forked pool worker opens its own segment and connection
+    instead of sharing the parent's.
+    """
+    store = _stores.get(os.getpid())
+    if store is None:
+        store = _stores[os.getpid()] = FilingStore()
+    return store
+
+
+def create_store_table():
+    conn = db.connect_to_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS filing_store(
+                        name text PRIMARY KEY,
+                        segment text,
+                        offset integer,
+                        length integer,
+                        raw_length integer,
+                        stored_at real
+                    )''')
+    conn.commit()
+    conn.close()
+
+
+def import_files(folder=None, delete=False):
+    """
+    Migrate the one-file-per-filing layout: every .txt and .sent in folder (output/cleaned_files) that is not
+    in the store yet goes in.  With delete the files are removed once stored.
+    """
+    folder = folder or ev.output_cleaned_files
+    store = get_store()
+    stored = set(store.names())
+    imported = 0
+    skipped = 0
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(('.txt', '.sent')):
+            continue
+        path = os.path.join(folder, name)
+        if name in stored:
+            skipped += 1
+        else:
+            with open(path, 'rb') as filing_file:
+                store.put(name, filing_file.read())
+            imported += 1
+            if imported % 1000 == 0:
+                logger.info(f'Imported {imported} file(s) so far.')
+        if delete:
+            os.remove(path)
+    logger.info(f'Imported {imported} file(s) from {folder} into {store.folder}. {skipped} already stored.')
+    return imported
+
+
+if __name__ == '__main__':
+    # python store.py import [folder] [--delete]
+    logging.basicConfig(level=logging.INFO, format=ev.logging_format)
+    if len(sys.argv) < 2 or sys.argv[1] != 'import':
+        print('usage: python store.py import [folder] [--delete]')
+        sys.exit(2)
+    arguments = [argument for argument in sys.argv[2:] if argument != '--delete']
+    import_files(arguments[0] if arguments else None, delete='--delete' in sys.argv)
@@ -0,0 +1,268 @@
+import re
+import time
+import asyncio
+import logging
+from urllib.parse import quote
+from xml.etree import ElementTree
+from datetime import datetime, timedelta
+
+from config import get_environment
+from fetch import Fetcher, run_in_pool
+from workers import shared_pool
+from sec import SEC, Filing, clean_filing, parse_master_lines, pad_string
+import differences
+import db
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+# The latest filings feed, https://www.sec.gov/cgi-bin/browse-edgar?action=getcurrent
+ATOM_PATH = '/cgi-bin/browse-edgar'
+ATOM = '{http://www.w3.org/2005/Atom}'
+# 10-Q - Apple Inc. (0000320193) (Filer)
+ATOM_TITLE = re.compile(r'^(.+?) - (.+) \((\d{10})\) \(([^)]+)\)$')
+ATOM_FILED = re.compile(r'Filed:\D*(\d{4}-\d{2}-\d{2})')
+ATOM_ACCESSION = re.compile(r'accession-number=(\d{10}-\d{2}-\d{6})')
+
+
+def eastern_offset(local: datetime):
+    """ Hours New York is behind UTC: EDT from 2am on the second Sunday of March to the first Sunday of November """
+    march = datetime(local.year, 3, 8, 2)
+    november = datetime(local.year, 11, 1, 2)
+    start = march + timedelta(days=(6 - march.weekday()) % 7)
+    end = november + timedelta(days=(6 - november.weekday()) % 7)
+    return 4 if start <= local < end else 5
+
+
+def accepted_epoch(date_accepted: str):
+    """ Epoch seconds of an EDGAR acceptance time, which is New York wall clock """
+    local = datetime.strptime(date_accepted, db.ACCEPTED_FORMAT)
+    return db.to_epoch(date_accepted) + eastern_offset(local) * 3600
+
+
+def eastern_today():
+    utc = datetime.utcnow()
+    return (utc - timedelta(hours=eastern_offset(utc - timedelta(hours=5)))).date()
+
+
+def parse_atom_feed(content: bytes, form_types):
+    """
+    (file_name, cik, company_name, form_type, date_filed) of the filings of form_types in the latest filings feed,
+    oldest first, the same records parse_master_lines gives.  A filing with several filers is listed once per
+    filer, it is kept once.
+    """
+    records = list()
+    accessions = set()
+    for entry in ElementTree.fromstring(content).iter(ATOM + 'entry'):
+        title = ATOM_TITLE.match((entry.findtext(ATOM + 'title') or '').strip())
+        accession = ATOM_ACCESSION.search(entry.findtext(ATOM + 'id') or '')
+        filed = ATOM_FILED.search(entry.findtext(ATOM + 'summary') or '')
+        if title is None or accession is None or filed is None or accession.group(1) in accessions:
+            continue
+        category = entry.find(ATOM + 'category')
+        entry_form_type = category.get('term') if category is not None else title.group(1)
+        if entry_form_type not in form_types:
+            continue
+        accessions.add(accession.group(1))
+        cik = int(title.group(3))
+        records.append((f'edgar/data/{cik}/{accession.group(1)}.txt', cik, title.group(2), entry_form_type,
+                        filed.group(1)))
+    # The feed lists the newest first
+    records.reverse()
+    return records
+
+
+class Watcher:
+    """
+    Watch mode.  Poll the latest filings feed, or today's daily index, every WATCH_INTERVAL seconds and push each
+    new filing through fetch, clean and create_diff against the report of its CIK before it right away, the same
+    evening it is accepted instead of with the next quarterly master index.
+
+    Filings are deduplicated by accession number through master_index: a filing is handled once, however often
+    the feed lists it and whether or not a batch run already has it.  The filings of one CIK are handled in order
+    so a diff always finds the report before it.  A filing that fails is left to the next batch run, it is in
+    master_index.  Prices are not looked up, the next day's open does not exist yet.  Once a day the reports
+    stored without prices are priced (SEC.backfill_prices), as is every batch run.
+
+    Latency from acceptance to the diff being stored is kept in the watch_latency histogram and logged per filing.
+    """
+
+    def __init__(self, sec: SEC, source=None, interval=None, concurrency=None):
+        self.sec = sec
+        self.source = source or ev.watch_source
+        self.interval = interval or ev.watch_interval
+        self.concurrency = concurrency or ev.watch_concurrency
+        # file names polled before, so an unchanged feed costs no database lookups
+        self.seen = set()
+        # cik -> task of the newest filing of that CIK in hand
+        self.chains = dict()
+        self.tasks = set()
+        self.processed = 0
+        self.failed = 0
+        self.semaphore = None
+        self.fetcher = None
+        self.pool = None
+        self.writer = None
+        self.backfilled = None
+
+    async def backfill_prices(self):
+        """ Price the reports of the days before, once a (New York) day """
+        today = eastern_today()
+        if self.backfilled == today:
+            return
+        self.backfilled = today
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.sec.backfill_prices)
+        except Exception as error:
+            logger.exception(f'Could not price the reports stored without prices: {error}')
+
+    def feed_urls(self):
+        """ Today's daily index lists every form.  The latest filings feed is asked once per form type. """
+        if self.source == 'daily':
+            day = eastern_today()
+            return [f'{ev.sec_website}/Archives/edgar/daily-index/{day.year}/QTR{(day.month - 1) // 3 + 1}/'
+                    f'master.{day.strftime("%Y%m%d")}.idx']
+        return [f'{ev.sec_website}{ATOM_PATH}?action=getcurrent&type={quote(form_type)}&company=&dateb='
+                f'&owner=include&start=0&count=100&output=atom' for form_type in ev.sec_form_types]
+
+    async def read_feed(self, url: str):
+        response = await self.fetcher.get(url, immutable=False)
+        if response is None:
+            return list()
+        try:
+            if self.source == 'daily':
+                return parse_master_lines(response.body.splitlines(), ev.sec_form_types)
+            return parse_atom_feed(response.body, ev.sec_form_types)
+        except ElementTree.ParseError as error:
+            logger.error(f'Could not parse the feed {response.url}.  Error: {error}')
+            return list()
+
+    async def poll(self):
+        """ The filings in the feeds nobody has seen yet, oldest first """
+        records = list()
+        for url in self.feed_urls():
+            records.extend(await self.read_feed(url))
+        # The feed of 10-Q lists the 10-Q/As as well.  Sorted stably by date filed the feeds stay in order.
+        records = list({record[0]: record for record in records if record[0] not in self.seen}.values())
+        records.sort(key=lambda record: record[4])
+        if not records:
+            return list()
+        self.seen.update(record[0] for record in records)
+        loop = asyncio.get_event_loop()
+        new = set(await loop.run_in_executor(None, db.insert_watched_filings, records))
+        metrics.count('new', 'watch_feed', len(new))
+        return [Filing(cik, company_name, form_type, date_filed, file_name)
+                for file_name, cik, company_name, form_type, date_filed in records if file_name in new]
+
+    def schedule(self, filing: Filing, seen_at: float):
+        """ Handle the filing as soon as the filing of its CIK before it is done """
+        task = asyncio.ensure_future(self.handle(filing, seen_at, self.chains.get(filing.cik)))
+        self.chains[filing.cik] = task
+        self.tasks.add(task)
+
+        def done(_):
+            self.tasks.discard(task)
+            if self.chains.get(filing.cik) is task:
+                del self.chains[filing.cik]
+        task.add_done_callback(done)
+
+    async def handle(self, filing: Filing, seen_at: float, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            try:
+                with metrics.timed('watch_filing'):
+                    await self.process(filing, seen_at)
+                self.processed += 1
+            except Exception as error:
+                self.failed += 1
+                logger.exception(f'Watch failed on {filing}: {error}')
+
+    async def process(self, filing: Filing, seen_at: float):
+        loop = asyncio.get_event_loop()
+        data_dict = filing.to_dict()
+        cik = pad_string(data_dict['cik'])
+
+        text = await self.sec.download_filing(self.fetcher, self.pool, data_dict)
+        if text is None:
+            raise LookupError(f'No {filing.form_type} document')
+        accepted = accepted_epoch(data_dict['date_accepted'])
+        metrics.observe('watch_detect', max(0.0, seen_at - accepted))
+
+        data_dict['file_name'] = await run_in_pool(self.pool, clean_filing, text, data_dict, size=len(text))
+        data_dict['ticker_symbol'] = self.sec.cik_to_ticker_dict.get(data_dict['cik'])
+        self.writer.insert_finance(data_dict)
+        await loop.run_in_executor(None, self.writer.flush)
+
+        date_accepted = db.to_epoch(data_dict['date_accepted'])
+        previous_forms, _, _ = differences.pairing(filing.form_type)
+        previous = await loop.run_in_executor(None, db.select_previous_report, filing.cik, date_accepted,
+                                              previous_forms)
+        if previous is None or not differences.consecutive(previous[1], date_accepted, filing.form_type):
+            logger.info(f'CIK: {cik} No report from the quarter before {data_dict["file_name"]} to diff against.')
+            return
+
+        record_id = await loop.run_in_executor(None, db.select_report_id, filing.cik, data_dict['file_name'])
+        result = await run_in_pool(self.pool, differences.create_diff, {
+            'id': record_id,
+            'cik': filing.cik,
+            'current_file': data_dict['file_name'],
+            'old_file': previous[0]
+        })
+        if result:
+            self.writer.update_difference(*result)
+            await loop.run_in_executor(None, self.writer.flush)
+
+        latency = time.time() - accepted
+        processing = time.time() - seen_at
+        metrics.observe('watch_latency', latency)
+        metrics.observe('watch_processing', processing)
+        # The latencies go into the JSON log line as fields of their own
+        logger.info('CIK: %s %s accepted %s diffed %s new sentences, stored %.1fs after acceptance and %.1fs after '
+                    'it showed up in the feed.', cik, filing.form_type, data_dict['date_accepted'],
+                    'with' if result else 'without', latency, processing,
+                    extra={'cik': filing.cik, 'latency': round(latency, 3), 'processing': round(processing, 3)})
+
+    async def watch(self, cycles=None):
+        """ Poll cycles times, forever when None, then wait for the filings still in hand """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        with shared_pool() as self.pool, db.BatchWriter() as self.writer:
+            async with Fetcher() as self.fetcher:
+                cycle = 0
+                reported = 0
+                while cycles is None or cycle < cycles:
+                    started = time.monotonic()
+                    try:
+                        filings = await self.poll()
+                    except Exception as error:
+                        logger.exception(f'Could not poll {", ".join(self.feed_urls())}: {error}')
+                        filings = list()
+                    seen_at = time.time()
+                    if filings:
+                        logger.info(f'{len(filings)} new filing(s) in the feed.')
+                    for filing in filings:
+                        self.schedule(filing, seen_at)
+                    await self.backfill_prices()
+
+                    # Keep metrics.prom current for the scraper
+                    if self.processed + self.failed != reported:
+                        reported = self.processed + self.failed
+                        metrics.write_reports()
+                    cycle += 1
+                    if cycles is None or cycle < cycles:
+                        await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+                if self.tasks:
+                    await asyncio.wait(list(self.tasks))
+
+    def run(self, cycles=None):
+        """ Watch until interrupted, or for WATCH_CYCLES polls """
+        logger.info(f'Watching {", ".join(self.feed_urls())} every {self.interval:g}s for new '
+                    f'{", ".join(ev.sec_form_types)} filings.')
+        try:
+            asyncio.run(self.watch(cycles or ev.watch_cycles or None))
+        except KeyboardInterrupt:
+            logger.info('Stopped watching.')
+        logger.info(f'Watched {self.processed} filing(s), {self.failed} failed.')
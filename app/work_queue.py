@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import logging
+import itertools
+import threading
+
+from config import get_environment
+import db
+import metrics
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def worker_id():
+    """ Who holds a lease: host, pid and a token, so a restarted process never inherits its old leases """
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+def create_work_queue_table():
+    conn = db.connect_to_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS work_queue(
+                        kind text,
+                        key text,
+                        payload text,
+                        priority integer,
+                        status text,
+                        attempts integer,
+                        owner text,
+                        lease_expires real,
+                        last_error text,
+                        updated_at real,
+                        PRIMARY KEY (kind, key)
+                    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS indx_work_queue_claim on work_queue(kind, status, priority)')
+    conn.commit()
+    conn.close()
+
+
+class WorkQueue:
+    """
+    Durable queue of work items in marko-polo.db, shared by every process that opens the same database file.
+
+    Items are (kind, key) with a JSON payload.  claim() leases a few items to this process for
+    work_lease_seconds.  A background thread renews the leases of everything still held, so only the items of a
+    process that died or hung expire and go to the next claimer.  complete() and fail() give an item back.  Each
+    claim counts as an attempt and an item that used up work_max_attempts ends up failed instead of being
+    retried forever.
+
+        work = WorkQueue('diff')
+        work.enqueue((str(row_id), data_dict, size) for ...)
+        with work:
+            for key, payload in work.claim(10):
+                ...
+                work.complete([key])
+
+    Enqueueing is idempotent.  A key that is already queued is left alone, a finished one only comes back when
+    its payload changed, so planning the same work twice never does it twice.
+    """
+
+    def __init__(self, kind: str, lease_seconds=None, max_attempts=None, owner=None):
+        self.kind = kind
+        self.lease_seconds = lease_seconds or ev.work_lease_seconds
+        self.max_attempts = max_attempts or ev.work_max_attempts
+        self.owner = owner or worker_id()
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+        create_work_queue_table()
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=self.keep_alive, name=f'lease-{self.kind}', daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        # Whatever we still hold goes back for somebody else instead of waiting for the lease to run out
+        self.release(list(self.held))
+
+    def enqueue(self, items, chunk_size=1000):
+        """ items are (key, payload, priority).  Higher priority is claimed first.  Returns the new + revived. """
+        items = iter(items)
+        queued = 0
+        conn = db.connect_to_db()
+        while True:
+            chunk = [(str(key), json.dumps(payload, sort_keys=True), priority)
+                     for key, payload, priority in itertools.islice(items, chunk_size)]
+            if not chunk:
+                break
+            now = time.time()
+            # One transaction per chunk, so other processes can claim while a big plan is going in
+            with conn:
+                inserted = conn.executemany(
+                    'INSERT OR IGNORE INTO work_queue (kind, key, payload, priority, status, attempts, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, 0, ?)',
+                    ((self.kind, key, payload, priority, PENDING, now) for key, payload, priority in chunk)).rowcount
+                revived = conn.executemany(
+                    'UPDATE work_queue SET status=?, payload=?, priority=?, attempts=0, last_error=NULL, updated_at=? '
+                    'WHERE kind=? AND key=? AND status IN (?, ?) AND payload != ?',
+                    ((PENDING, payload, priority, now, self.kind, key, DONE, FAILED, payload)
+                     for key, payload, priority in chunk)).rowcount
+            queued += inserted + revived
+        conn.close()
+        logger.info(f'Queued {queued} new or changed {self.kind} item(s).')
+        return queued
+
+    def claim(self, limit: int):
+        """ Lease up to limit items to this process.  Returns [(key, payload)], empty when nothing is left. """
+        now = time.time()
+        conn = db.connect_to_db()
+        conn.isolation_level = None
+        try:
+            # IMMEDIATE takes the write lock up front, so two processes can never select the same rows
+            conn.execute('BEGIN IMMEDIATE')
+            expired = conn.execute(
+                'UPDATE work_queue SET status=?, last_error=?, owner=NULL, updated_at=? '
+                'WHERE kind=? AND status=? AND lease_expires < ? AND attempts >= ?',
+                (FAILED, 'Lease expired on the last attempt', now, self.kind, LEASED, now, self.max_attempts)).rowcount
+            rows = conn.execute(
+                'SELECT rowid, key, payload FROM work_queue '
+                'WHERE kind=? AND attempts < ? AND (status=? OR (status=? AND lease_expires < ?)) '
+                'ORDER BY priority DESC, rowid LIMIT ?',
+                (self.kind, self.max_attempts, PENDING, LEASED, now, limit)).fetchall()
+            if rows:
+                placeholders = ', '.join('?' * len(rows))
+                conn.execute(f'UPDATE work_queue SET status=?, owner=?, lease_expires=?, attempts=attempts + 1, '
+                             f'updated_at=? WHERE rowid IN ({placeholders})',
+                             (LEASED, self.owner, now + self.lease_seconds, now) + tuple(row[0] for row in rows))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        if expired:
+            metrics.count('expired', 'work_queue', expired)
+            logger.error(f'{expired} {self.kind} item(s) failed: their lease expired on the last attempt.')
+        metrics.count('claimed', 'work_queue', len(rows))
+        with self.lock:
+            self.held.update(row[1] for row in rows)
+        return [(key, json.loads(payload)) for _, key, payload in rows]
+
+    def finish(self, keys, status: str, error=None):
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        conn = db.connect_to_db()
+        with conn:
+            conn.executemany('UPDATE work_queue SET status=?, owner=NULL, last_error=?, updated_at=? '
+                             'WHERE kind=? AND key=? AND owner=?',
+                             ((status, error, time.time(), self.kind, key, self.owner) for key in keys))
+        conn.close()
+        with self.lock:
+            self.held.difference_update(keys)
+
+    def complete(self, keys):
+        self.finish(keys, DONE)
+
+    def fail(self, key, error):
+        """ Back in line for another attempt, or failed for good once it used up its attempts """
+        conn = db.connect_to_db()
+        attempts = conn.execute('SELECT attempts FROM work_queue WHERE kind=? AND key=?',
+                                (self.kind, str(key))).fetchone()
+        conn.close()
+        status = FAILED if attempts and attempts[0] >= self.max_attempts else PENDING
+        metrics.count('failed' if status == FAILED else 'retried', 'work_queue')
+        logger.error(f'{self.kind} {key} failed, {"giving up" if status == FAILED else "will retry"}. '
+                     f'Error: {error!r}')
+        self.finish([key], status, repr(error))
+
+    def release(self, keys):
+        """ Give items back before their lease runs out.  The attempt still counts. """
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        conn = db.connect_to_db()
+        with conn:
+            conn.executemany('UPDATE work_queue SET status=?, owner=NULL, updated_at=? '
+                             'WHERE kind=? AND key=? AND owner=? AND status=?',
+                             ((PENDING, time.time(), self.kind, key, self.owner, LEASED) for key in keys))
+        conn.close()
+        with self.lock:
+            self.held.difference_update(keys)
+
+    def heartbeat(self):
+        """ Extend the lease of every item this process still holds """
+        with self.lock:
+            keys = list(self.held)
+        if not keys:
+            return
+        conn = db.connect_to_db()
+        with conn:
+            renewed = conn.executemany(
+                'UPDATE work_queue SET lease_expires=? WHERE kind=? AND key=? AND owner=? AND status=?',
+                ((time.time() + self.lease_seconds, self.kind, key, self.owner, LEASED) for key in keys)).rowcount
+        conn.close()
+        if renewed < len(keys):
+            logger.warning(f'Lost the lease of {len(keys) - renewed} {self.kind} item(s).  Another process may be '
+                           f'working on them.')
+
+    def keep_alive(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except Exception as error:
+                logger.error(f'Could not renew {self.kind} leases: {error!r}')
+
+    def busy_keys(self):
+        """ Keys other processes hold a live lease on """
+        conn = db.connect_to_db()
+        keys = {row[0] for row in conn.execute(
+            'SELECT key FROM work_queue WHERE kind=? AND status=? AND lease_expires >= ? AND owner != ?',
+            (self.kind, LEASED, time.time(), self.owner))}
+        conn.close()
+        return keys
+
+
+def status():
+    """ {kind: {status: count}} """
+    create_work_queue_table()
+    conn = db.connect_to_db()
+    counts = dict()
+    for kind, item_status, count in conn.execute(
+            'SELECT kind, status, COUNT(*) FROM work_queue GROUP BY kind, status ORDER BY kind, status'):
+        counts.setdefault(kind, dict())[item_status] = count
+    conn.close()
+    return counts
+
+
+def retry_failed(kind=None):
+    """ Give failed items a fresh set of attempts """
+    create_work_queue_table()
+    conn = db.connect_to_db()
+    with conn:
+        sql = 'UPDATE work_queue SET status=?, attempts=0, updated_at=? WHERE status=?'
+        params = (PENDING, time.time(), FAILED)
+        if kind:
+            sql += ' AND kind=?'
+            params += (kind,)
+        retried = conn.execute(sql, params).rowcount
+    conn.close()
+    logger.info(f'{retried} failed item(s) queued again.')
+    return retried
+
+
+if __name__ == '__main__':
+    # python work_queue.py status | retry [kind]
+    logging.basicConfig(level=logging.INFO, format=ev.logging_format)
+    if len(sys.argv) < 2 or sys.argv[1] not in ('status', 'retry'):
+        print('usage: python work_queue.py status | retry [kind]')
+        sys.exit(2)
+    if sys.argv[1] == 'retry':
+        retry_failed(sys.argv[2] if len(sys.argv) > 2 else None)
+    for kind, counts in status().items():
+        print(f'{kind:<10} ' + '  '.join(f'{item_status}: {count}' for item_status, count in sorted(counts.items())))
@@ -0,0 +1,468 @@
+import os
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+
+from config import get_environment
+import metrics
+import logs
+
+ev = get_environment()
+logger = logging.getLogger(ev.app_name)
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class WorkerLost(Exception):
+    pass
+
+
+def current_rss():
+    """ Resident set size of this process in bytes """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def default_memory_budget():
+    """ Half of physical memory """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError):
+        return 4 * 1024 * 1024 * 1024
+
+
+def warm_stop_words():
+    from laundry import load_stop_words, stop_word_pattern
+    load_stop_words()
+    stop_word_pattern()
+
+
+def warm_punkt():
+    from artifacts import sentence_detector
+    sentence_detector()
+
+
+def warm_matcher():
+    import matcher  # noqa: F401
+
+
+def warm_store():
+    from store import get_store
+    get_store().connection()
+
+
+def warm_worker():
+    """
+    Initializer of the pool workers.  Loads what cleaning and diffing would otherwise load in the first task that
+    needs it: the stop words and their pattern, punkt, the matcher and the filing store's connection.  What does
+    not load is left to the task, which reports it as it always did.  The boilerplate dictionary is not loaded
+    here, the run may still be adding to it.
+    """
+    started = time.perf_counter()
+    for warm in (warm_stop_words, warm_punkt, warm_matcher, warm_store):
+        try:
+            warm()
+        except Exception as error:
+            logger.debug('Worker %s skipped %s: %r', os.getpid(), warm.__name__, error)
+    seconds = time.perf_counter() - started
+    metrics.observe('worker_warm', seconds)
+    logger.debug('Worker %s warm in %.3fs.', os.getpid(), seconds)
+
+
+def run_chunk(func, items):
+    """
+    Runs func over a chunk of items in a worker.  Returns ([(ok, result or exception) per item], seconds), so one
+    failing item does not take the rest of its chunk with it.
+    """
+    started = time.perf_counter()
+    results = list()
+    for item in items:
+        try:
+            results.append((True, func(item)))
+        except Exception as error:
+            results.append((False, error))
+    return results, time.perf_counter() - started
+
+
+def worker_main(conn, log_queue=None, initializer=None):
+    """
+    Run tasks from the supervisor until told to stop.  Reports its RSS with every result.  Logs through the
+    listener of the main process, never to the file handles it may have inherited.  initializer runs once, before
+    the first task.
+    """
+    metrics.reset_worker()
+    if log_queue is not None:
+        logs.configure(log_queue)
+    if initializer is not None:
+        try:
+            initializer()
+        except Exception:
+            logger.exception(f'Initializer of worker {os.getpid()} failed.')
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        task_id, func, args = task
+        try:
+            message = (task_id, True, func(*args), current_rss())
+        except Exception as error:
+            message = (task_id, False, error, current_rss())
+        try:
+            conn.send(message)
+        except Exception as error:
+            # The result or the exception would not pickle
+            conn.send((task_id, False, RuntimeError(f'Could not send result back: {error!r}'), current_rss()))
+
+
+class Task:
+    __slots__ = ('task_id', 'func', 'args', 'size', 'cost', 'callback', 'error_callback', 'started', 'done', 'value',
+                 'ok')
+
+    def __init__(self, task_id, func, args, size, cost, callback, error_callback):
+        self.task_id = task_id
+        self.func = func
+        self.args = args
+        self.size = size
+        self.cost = cost
+        self.callback = callback
+        self.error_callback = error_callback
+        self.started = None
+        self.done = threading.Event()
+        self.value = None
+        self.ok = False
+
+    def get(self, timeout=None):
+        """ Same as multiprocessing's AsyncResult.get """
+        if not self.done.wait(timeout):
+            raise multiprocessing.TimeoutError
+        if not self.ok:
+            raise self.value
+        return self.value
+
+
+class Worker:
+    def __init__(self, context, initializer=None):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, logs.log_queue(), initializer),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.tasks_done = 0
+        self.timed_out = False
+
+
+class WorkerPool:
+    """
+    Process pool that knows how big its tasks are.  Drop-in for the parts of multiprocessing.Pool we use
+    (apply_async, imap_unordered, context manager).
+
+    - Tasks carry a size (bytes of the document).  Waiting tasks are handed out largest first, one task per
+      worker at a time, so no worker sits on a chunk of giants while the others idle.
+    - size * worker_memory_factor estimates what a task needs.  A task only starts while the estimates of
+      everything running stay under worker_memory_budget_mb.  A task bigger than the budget runs alone.
+    - Workers are replaced after worker_max_tasks tasks or once their RSS passes worker_max_rss_mb, which gives
+      back what a large BeautifulSoup tree left fragmented.
+    - A task running longer than worker_task_timeout seconds gets its worker killed and fails with TaskTimeout.
+      A worker that dies (OOM killer) fails its task with WorkerLost.  Either way a new worker takes its place.
+    - Every worker, the ones that take a retired worker's place too, runs initializer before its first task.
+      It defaults to warm_worker with WORKER_WARM=1.
+    """
+
+    def __init__(self, processes=None, memory_budget=None, memory_factor=None, max_tasks=None, max_rss=None,
+                 task_timeout=None, initializer=None):
+        self.processes = processes or ev.number_of_cores
+        self.memory_budget = memory_budget or (ev.worker_memory_budget_mb * 1024 * 1024) or default_memory_budget()
+        self.memory_factor = memory_factor or ev.worker_memory_factor
+        self.max_tasks = ev.worker_max_tasks if max_tasks is None else max_tasks
+        self.max_rss = (ev.worker_max_rss_mb * 1024 * 1024) if max_rss is None else max_rss
+        self.task_timeout = ev.worker_task_timeout if task_timeout is None else task_timeout
+        self.initializer = initializer or (warm_worker if ev.worker_warm else None)
+
+        self.context = multiprocessing.get_context()
+        self.lock = threading.Lock()
+        self.pending = list()
+        self.counter = itertools.count()
+        self.cost_in_flight = 0
+        self.closed = False
+        self.wake_reader, self.wake_writer = self.context.Pipe(duplex=False)
+        self.workers = [Worker(self.context, self.initializer) for _ in range(self.processes)]
+        self.supervisor = threading.Thread(target=self.supervise, name='worker-supervisor', daemon=True)
+        self.supervisor.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.terminate()
+
+    def wake(self):
+        self.wake_writer.send_bytes(b'')
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None, size=0):
+        task_id = next(self.counter)
+        task = Task(task_id, func, tuple(args), size, size * self.memory_factor, callback, error_callback)
+        with self.lock:
+            if self.closed:
+                raise ValueError('Pool not running')
+            # Largest first, then in the order they came
+            heapq.heappush(self.pending, (-size, task_id, task))
+        self.wake()
+        return task
+
+    def imap_unordered(self, func, items, size=None, failed=None, chunk_seconds=None):
+        """
+        Results as they finish, like Pool.imap_unordered.  size(item) gives the size of an item.  A failed item is
+        handed to failed(item, error), or logged, and skipped instead of ending the whole iteration.
+
+        Items go out largest first in chunks, a chunk being one task.  The chunk size adapts: chunks hold as many
+        items as the seconds per byte (per item without size) of the chunks done so far say fit in chunk_seconds
+        (worker_chunk_seconds), and at most twice as many as the largest chunk done so far.  Until the first chunk
+        is back, and for anything that large, a chunk is one item.  At most two chunks per worker are out at a
+        time, so the estimate is used as soon as it is known.  The items of a chunk that lost its worker or timed
+        out are tried again one by one, so only the item that did it fails.
+        """
+        items = list(items)
+        sizes = [max(size(item), 1) if size else 1 for item in items]
+        order = sorted(range(len(items)), key=lambda index: -sizes[index])
+        target = ev.worker_chunk_seconds if chunk_seconds is None else chunk_seconds
+        results = queue.Queue()
+        retry = list()
+        state = {'next': 0, 'in_flight': 0, 'per_unit': None, 'longest': 0}
+
+        def failed_item(item, error):
+            if failed is not None:
+                failed(item, error)
+            else:
+                logger.error(f'Task failed: {error!r}')
+
+        def submit():
+            if retry:
+                chunk = [retry.pop()]
+            else:
+                start = state['next']
+                stop = start + 1
+                if state['per_unit'] is not None:
+                    units = sizes[order[start]]
+                    # Grows gradually, and the last chunks are spread over every worker
+                    most = min(state['longest'] * 2, max(1, (len(order) - start) // self.processes))
+                    while (stop < len(order) and stop - start < most
+                           and (units + sizes[order[stop]]) * state['per_unit'] <= target):
+                        units += sizes[order[stop]]
+                        stop += 1
+                chunk = order[start:stop]
+                state['next'] = stop
+            state['in_flight'] += 1
+            # The whole chunk counts against the memory budget, the worker holds the results of all of it
+            self.apply_async(run_chunk, (func, [items[index] for index in chunk]),
+                             callback=lambda value: results.put((chunk, True, value)),
+                             error_callback=lambda error: results.put((chunk, False, error)),
+                             size=sum(sizes[index] for index in chunk))
+
+        def fill():
+            while (retry or state['next'] < len(order)) and state['in_flight'] < self.processes * 2:
+                submit()
+
+        fill()
+        while state['in_flight']:
+            chunk, ok, value = results.get()
+            state['in_flight'] -= 1
+            metrics.count('chunks', 'workers')
+            if ok:
+                chunk_results, seconds = value
+                per_unit = seconds / sum(sizes[index] for index in chunk)
+                state['per_unit'] = per_unit if state['per_unit'] is None else \
+                    0.7 * state['per_unit'] + 0.3 * per_unit
+                state['longest'] = max(state['longest'], len(chunk))
+            elif len(chunk) > 1:
+                retry.extend(reversed(chunk))
+                chunk_results = []
+            else:
+                chunk_results = [(False, value)]
+            fill()
+            for index, (item_ok, result) in zip(chunk, chunk_results):
+                if item_ok:
+                    yield result
+                else:
+                    failed_item(items[index], result)
+
+    def finish(self, task, ok, value):
+        task.ok = ok
+        task.value = value
+        task.done.set()
+        try:
+            if ok and task.callback:
+                task.callback(value)
+            elif not ok and task.error_callback:
+                task.error_callback(value)
+        except Exception:
+            logger.exception(f'Callback of task {task.task_id} failed.')
+
+    def dispatch(self):
+        """ Hand waiting tasks to idle workers, largest first, within the memory budget """
+        with self.lock:
+            for worker in self.workers:
+                if not self.pending:
+                    return
+                if worker.task is not None:
+                    continue
+                _, _, task = self.pending[0]
+                if self.cost_in_flight and self.cost_in_flight + task.cost > self.memory_budget:
+                    return
+                heapq.heappop(self.pending)
+                task.started = time.monotonic()
+                worker.task = task
+                self.cost_in_flight += task.cost
+                try:
+                    worker.conn.send((task.task_id, task.func, task.args))
+                except Exception as error:
+                    worker.task = None
+                    self.cost_in_flight -= task.cost
+                    self.finish(task, False, error)
+
+    def replace(self, worker: Worker, reason: str):
+        """ Retire a worker and start a fresh one in its place """
+        if worker.process.is_alive():
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+        worker.process.join()
+        worker.conn.close()
+        metrics.count('worker_restarts', 'workers')
+        logger.debug(f'Replacing worker {worker.process.pid}: {reason}')
+        with self.lock:
+            index = self.workers.index(worker)
+            self.workers[index] = Worker(self.context, self.initializer)
+
+    def complete(self, worker: Worker, ok: bool, value, rss: int):
+        task = worker.task
+        worker.task = None
+        worker.tasks_done += 1
+        with self.lock:
+            self.cost_in_flight -= task.cost
+        self.finish(task, ok, value)
+
+        if self.max_tasks and worker.tasks_done >= self.max_tasks:
+            self.replace(worker, f'{worker.tasks_done} tasks done')
+        elif self.max_rss and rss > self.max_rss:
+            metrics.count('rss_recycles', 'workers')
+            self.replace(worker, f'RSS {rss / 1024 / 1024:.0f} MiB')
+
+    def lost(self, worker: Worker):
+        """ The worker died or was killed with a task in hand """
+        task = worker.task
+        worker.task = None
+        if task is not None:
+            with self.lock:
+                self.cost_in_flight -= task.cost
+            worker.process.join(1)
+            name = getattr(task.func, 'stage', None) or getattr(task.func, '__name__', 'task')
+            key = f'{name} {metrics.work_key(task.args)}'.strip()
+            if worker.timed_out:
+                metrics.count('timeouts', 'workers')
+                error = TaskTimeout(f'Task {key} ran longer than {self.task_timeout:.0f}s and was killed.')
+            else:
+                metrics.count('lost', 'workers')
+                error = WorkerLost(f'Worker {worker.process.pid} died running {key}. '
+                                   f'Exit code {worker.process.exitcode}.')
+            logger.error(str(error))
+            self.finish(task, False, error)
+        if not self.closed:
+            self.replace(worker, 'lost')
+
+    def check_deadlines(self):
+        if not self.task_timeout:
+            return
+        now = time.monotonic()
+        for worker in list(self.workers):
+            if worker.task is not None and not worker.timed_out and now - worker.task.started > self.task_timeout:
+                worker.timed_out = True
+                worker.process.kill()
+
+    def supervise(self):
+        while True:
+            self.dispatch()
+            connections = {worker.conn: worker for worker in self.workers}
+            ready = wait(list(connections) + [self.wake_reader], timeout=1.0)
+            if self.closed:
+                return
+            for conn in ready:
+                if conn is self.wake_reader:
+                    while self.wake_reader.poll():
+                        self.wake_reader.recv_bytes()
+                    continue
+                worker = connections[conn]
+                try:
+                    _, ok, value, rss = conn.recv()
+                except (EOFError, OSError):
+                    self.lost(worker)
+                    continue
+                self.complete(worker, ok, value, rss)
+            self.check_deadlines()
+
+    def terminate(self):
+        """ Stop every worker.  Tasks that did not run fail with WorkerLost. """
+        with self.lock:
+            self.closed = True
+            pending = [task for _, _, task in self.pending]
+            self.pending = list()
+        self.wake()
+        self.supervisor.join()
+        for task in pending:
+            self.finish(task, False, WorkerLost('Pool was shut down before the task ran.'))
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            if worker.task is not None:
+                self.finish(worker.task, False, WorkerLost('Pool was shut down while the task ran.'))
+            worker.conn.close()
+
+
+_shared = None
+
+
+@contextmanager
+def shared_pool():
+    """
+    The WorkerPool of the run.  The outermost shared_pool() starts it and terminates it at the end.  Every stage
+    inside it (master index, pipeline, diffs, watch) uses the same warm workers instead of starting its own.
+
+        with shared_pool() as pool:
+            ...
+    """
+    global _shared
+    if _shared is not None:
+        yield _shared
+        return
+    _shared = WorkerPool()
+    try:
+        yield _shared
+    finally:
+        pool, _shared = _shared, None
+        pool.terminate()